@@ -1,37 +1,119 @@
+import os
+
+import numpy as np
 import torch
 
 from .training_point import TextTokensIdsTarget, TrainingPoint
-from reward_analyzer.utils.transformer_utils import batch
+from reward_analyzer.utils.hook_manager import HookManager
+from reward_analyzer.utils.transformer_utils import token_budget_batches
 
 class ActivationsHook:
     def __init__(self):
         self.activations = []
 
+        # When gathering target tokens, only the target position of each sample is kept,
+        # and written into one preallocated [num_samples, d] array.
+        self.target_activations = None
+        self.num_samples = 0
+        self.memmap_path = None
+        self.sample_indices = None
+        self.target_positions = None
+
     def clear_activations(self):
         for tensor in self.activations:
             tensor = tensor.detach().cpu()
         self.activations.clear()
         self.activations = []
 
+    def start_target_gather(self, num_samples: int, memmap_path: str = None):
+        """
+        Switches the hook to gathering target tokens for num_samples samples.
+        If memmap_path is given, the array is backed by a memory-mapped .npy file there.
+        """
+        self.target_activations = None
+        self.num_samples = num_samples
+        self.memmap_path = memmap_path
+
+    def set_target_batch(self, sample_indices: list[int], target_positions: torch.Tensor):
+        """
+        Sets the sample indices and target token positions of the rows of the next batch.
+        """
+        self.sample_indices = np.asarray(sample_indices)
+        self.target_positions = target_positions
+
+    def stop_target_gather(self):
+        """
+        Switches the hook back to keeping full activations, and returns the gathered array.
+        """
+        target_activations = self.target_activations
+        if isinstance(target_activations, np.memmap):
+            target_activations.flush()
+        self.target_positions = None
+        self.sample_indices = None
+        self.target_activations = None
+        return target_activations
+
+    def _allocate_target_activations(self, hidden_size: int):
+        shape = (self.num_samples, hidden_size)
+        if self.memmap_path:
+            self.target_activations = np.lib.format.open_memmap(
+                self.memmap_path, mode='w+', dtype=np.float32, shape=shape
+            )
+        else:
+            self.target_activations = np.empty(shape, dtype=np.float32)
+
     def hook_fn(self, module, input, output):
+        if self.target_positions is not None:
+            # Gather on the model's device, so only [batch, d] is copied to the host.
+            rows = torch.arange(len(self.target_positions), device=output.device)
+            gathered = output[rows, self.target_positions.to(output.device)].detach()
+            if self.target_activations is None:
+                self._allocate_target_activations(hidden_size=gathered.size(-1))
+            self.target_activations[self.sample_indices] = gathered.to(dtype=torch.float32).cpu().numpy()
+            return
+
         new_activations = torch.split(output.detach().cpu(), 1, dim=0)
         self.activations.extend(new_activations)
 
 class ActivationsExtractor:
-    def __init__(self, model, tokenizer, target_layers):
+    def __init__(self, model, tokenizer, target_layers, early_exit=True):
         self.model = model
         self.target_layers = target_layers
         self.tokenizer = tokenizer
 
+        # Stop forward passes after the deepest target layer, since later layers are never read.
+        self.early_exit = early_exit
+
+        # Batches of several texts need padding, so tokenizers without a pad_token (eg. GPT-2's)
+        # fall back to one text per forward pass.
+        self.max_batch_size = None if tokenizer.pad_token is not None else 1
+        if self.max_batch_size == 1:
+            print('Tokenizer has no pad_token, so activations are extracted one text at a time.')
+
+        # Dictionary of layer name to the [num_samples, d] target token activations of the last call.
+        self.target_token_activations = {}
+
         # Create an instance of ActivationHook
         self.activation_hooks = {}
+        self.hook_manager = HookManager(model)
 
         for layer_name in self.target_layers:
             activation_hook = ActivationsHook()
             self.activation_hooks[layer_name] = activation_hook
-            layer = dict(model.named_modules())[layer_name]
             # Register the forward hook to the chosen layer
-            hook_handle = layer.register_forward_hook(activation_hook.hook_fn)
+            self.hook_manager.add_hook(layer_name, activation_hook.hook_fn)
+
+        if self.early_exit:
+            self.hook_manager.add_stop_hook(self.target_layers)
+
+    def remove_hooks(self):
+        """
+        Removes all hooks this extractor registered on the model.
+        """
+        self.hook_manager.remove_all_hooks()
+
+    def get_live_hooks(self):
+        return self.hook_manager.get_live_hooks()
 
     def clear_all_activations(self):
         for layer_name, activation_hook in self.activation_hooks.items():
@@ -45,14 +127,42 @@ class ActivationsExtractor:
             layer_name: activation_hook.activations for layer_name, activation_hook in self.activation_hooks.items()
         }
 
-    def compute_activations_from_raw_texts(self, raw_texts: str):
+    def _compute_activations_in_token_budget_batches(self, lengths, get_model_inputs, max_batch_tokens):
+        """
+        Runs the model over length-bucketed batches that fit within max_batch_tokens, and then
+        restores the original sample order in the cached activations, dropping padding positions.
+        get_model_inputs maps a list of sample indices to the model inputs of that batch.
+        """
+        batches = token_budget_batches(lengths, max_tokens=max_batch_tokens, max_batch_size=self.max_batch_size)
+        attention_masks = []
+
+        for index_batch in batches:
+            model_inputs = get_model_inputs(index_batch)
+            attention_masks.append(model_inputs['attention_mask'].detach().cpu().bool())
+            self.hook_manager.run_forward(**model_inputs)
+
+        for activation_hook in self.activation_hooks.values():
+            ordered_activations = [None] * len(lengths)
+            position = 0
+            for index_batch, attention_mask in zip(batches, attention_masks):
+                for row, index in enumerate(index_batch):
+                    sample_activations = activation_hook.activations[position + row]
+                    ordered_activations[index] = sample_activations[:, attention_mask[row], :]
+                position += len(index_batch)
+            activation_hook.activations = ordered_activations
+
+    def compute_activations_from_raw_texts(self, raw_texts: str, max_batch_tokens: int = 4096):
         self.clear_all_activations()
 
-        # Forward pass your input through the model
-        for text_batch in batch(raw_texts):
-            input_data = self.tokenizer(text_batch, return_tensors='pt', padding=True)  # Example input shape
-            with torch.no_grad():
-                output = self.model(**input_data)
+        lengths = [len(input_ids) for input_ids in self.tokenizer(raw_texts)['input_ids']]
+
+        def get_model_inputs(index_batch):
+            text_batch = [raw_texts[index] for index in index_batch]
+            return self.tokenizer(text_batch, return_tensors='pt', padding=len(text_batch) > 1)
+
+        self._compute_activations_in_token_budget_batches(
+            lengths=lengths, get_model_inputs=get_model_inputs, max_batch_tokens=max_batch_tokens
+        )
 
         return self.get_activations()
 
@@ -67,38 +177,82 @@ class ActivationsExtractor:
 
         return flattened_activations
 
-    def compute_activations_from_text_tokens_ids_target(
-            self, samples: list[TextTokensIdsTarget], target_token_only=True, flatten=True
-    ):
-        self.clear_all_activations()
+    @staticmethod
+    def get_padded_target_positions(attention_mask: torch.Tensor, target_positions: torch.Tensor) -> torch.Tensor:
+        """
+        Maps target token positions within each unpadded sample to positions in the padded batch, through the
+        attention mask, so that they hold for left as well as right padding.
+        """
+        attention_mask = attention_mask.bool()
+        token_positions = attention_mask.long().cumsum(dim=1) - 1
+        is_target = attention_mask & (token_positions == target_positions.to(attention_mask.device).unsqueeze(1))
+        return is_target.long().argmax(dim=1)
 
-        # Forward pass your input through the model
-        for text_batch in batch(samples):
-            tensorized = TextTokensIdsTarget.get_tensorized(text_batch)
+    def _compute_target_token_activations(self, samples: list[TextTokensIdsTarget], max_batch_tokens, memmap_dir):
+        """
+        Gathers the activations at each sample's target token position, in the hooks and on the model's device,
+        into one preallocated [num_samples, d] array per layer. Arrays are memory-mapped if memmap_dir is given.
+        """
+        if memmap_dir:
+            os.makedirs(memmap_dir, exist_ok=True)
 
-            with torch.no_grad():
-                output = self.model(**tensorized)
+        for layer_name, activation_hook in self.activation_hooks.items():
+            memmap_path = os.path.join(memmap_dir, f'{layer_name}.npy') if memmap_dir else None
+            activation_hook.start_target_gather(num_samples=len(samples), memmap_path=memmap_path)
 
-        all_activations = self.get_activations()
-        activations_per_layer = [len(value) for value in all_activations.values()]
+        try:
+            batches = token_budget_batches(
+                [len(sample.ids) for sample in samples], max_tokens=max_batch_tokens, max_batch_size=self.max_batch_size
+            )
+            for index_batch in batches:
+                sample_batch = [samples[index] for index in index_batch]
+                tensorized = TextTokensIdsTarget.get_tensorized(sample_batch, tokenizer=self.tokenizer, device=self.model.device)
+                target_positions = self.get_padded_target_positions(
+                    tensorized['attention_mask'], torch.tensor([sample.target_token_position for sample in sample_batch])
+                )
+                for activation_hook in self.activation_hooks.values():
+                    activation_hook.set_target_batch(index_batch, target_positions)
 
-        assert max(activations_per_layer) == min(activations_per_layer) == len(
-            samples), 'Each layer should have num_samples activations'
+                self.hook_manager.run_forward(**tensorized)
+        finally:
+            self.target_token_activations = {
+                layer_name: activation_hook.stop_target_gather()
+                for layer_name, activation_hook in self.activation_hooks.items()
+            }
 
-        if target_token_only:
-            all_target_token_activations = {layer_num: [] for layer_num in all_activations}
-            for layer_num, layer_activations in all_activations.items():
-                assert len(layer_activations) == len(samples), "Each layer should have same activations as num samples!"
+        return self.target_token_activations
 
-                zipped_layer_activations_and_samples = zip(layer_activations, samples)
-                for activations, sample in zipped_layer_activations_and_samples:
-                    relevant_token_activations = activations[:, sample.target_token_position, :]
-                    all_target_token_activations[layer_num].append(relevant_token_activations)
+    def compute_activations_from_text_tokens_ids_target(
+            self, samples: list[TextTokensIdsTarget], target_token_only=True, flatten=True, max_batch_tokens: int = 4096,
+            memmap_dir: str = None
+    ):
+        self.clear_all_activations()
 
-            final_activations = all_target_token_activations
+        if target_token_only:
+            target_token_activations = self._compute_target_token_activations(
+                samples, max_batch_tokens=max_batch_tokens, memmap_dir=memmap_dir
+            )
+            # Per sample [1, d] views into the contiguous arrays, rather than copies.
+            final_activations = {
+                layer_name: list(torch.from_numpy(layer_activations).split(1, dim=0))
+                for layer_name, layer_activations in target_token_activations.items()
+            }
 
         else:
-            final_activations = all_activations
+            def get_model_inputs(index_batch):
+                sample_batch = [samples[index] for index in index_batch]
+                return TextTokensIdsTarget.get_tensorized(sample_batch, tokenizer=self.tokenizer, device=self.model.device)
+
+            self._compute_activations_in_token_budget_batches(
+                lengths=[len(sample.ids) for sample in samples], get_model_inputs=get_model_inputs,
+                max_batch_tokens=max_batch_tokens
+            )
+
+            final_activations = self.get_activations()
+            activations_per_layer = [len(value) for value in final_activations.values()]
+
+            assert max(activations_per_layer) == min(activations_per_layer) == len(
+                samples), 'Each layer should have num_samples activations'
 
         if flatten:
             final_activations = self._flatten_activations(final_activations, num_samples=len(samples))
@@ -1,3 +1,6 @@
+from typing import Union
+
+import numpy as np
 from scipy.sparse import csr_matrix
 from torch import FloatTensor, LongTensor, Tensor
 
@@ -10,22 +13,114 @@ class AutoencoderManager:
         self.tokenizer = tokenizer
         self.autoencoders_dict = autoencoders_dict
 
+    def get_autoencoder_device(self, layer_name):
+        return next(self.autoencoders_dict[layer_name].parameters()).device
+
     def get_dictionary_features(self, activations, layer_name):
         """
         Returns raw dictionary features for activations at a layer number.
         """
         with torch.no_grad():
-            features = self.autoencoders_dict[layer_name](activations.cuda())
+            features = self.autoencoders_dict[layer_name](activations.to(self.get_autoencoder_device(layer_name)))
             return features
 
+    @staticmethod
+    def sparsify_features(features: Tensor, top_k: int = None):
+        """
+        Converts a [n, hidden] batch of dense features into CSR arrays, built on the features' device.
+        If top_k is given, only the top_k largest features of each row are kept.
+
+        Returns:
+        The crow_indices, col_indices and values tensors of a CSR matrix.
+        """
+        if top_k is not None and top_k < features.size(-1):
+            values, col_indices = torch.topk(features, k=top_k, dim=-1)
+            # Keep column order within each row, as CSR expects.
+            col_indices, order = torch.sort(col_indices, dim=-1)
+            values = torch.gather(values, -1, order)
+            mask = values != 0
+            values, col_indices = values[mask], col_indices[mask]
+        else:
+            mask = features != 0
+            values, col_indices = features[mask], mask.nonzero()[:, 1]
+
+        crow_indices = torch.zeros(features.size(0) + 1, dtype=torch.long, device=features.device)
+        crow_indices[1:] = torch.cumsum(mask.sum(dim=-1), dim=0)
+        return crow_indices, col_indices, values
+
+    def get_sparse_dictionary_features(
+            self, activations: Union[Tensor, np.ndarray], layer_name: str, top_k: int = None, batch_size: int = 4096
+    ) -> csr_matrix:
+        """
+        Encodes activations of any leading shape, flattened to [n, d], into one [n, hidden] sparse matrix.
+        Only the encoder is run, batch_size rows at a time, and only the nonzero features are copied to the host.
+        """
+        autoencoder = self.autoencoders_dict[layer_name]
+        device = self.get_autoencoder_device(layer_name)
+        if isinstance(activations, np.ndarray):
+            activations = torch.from_numpy(activations)
+        activations = activations.reshape(-1, activations.size(-1))
+
+        all_crow_indices, all_col_indices, all_values = [np.zeros(1, dtype=np.int64)], [], []
+        num_nonzero = 0
+        with torch.no_grad():
+            for start in range(0, activations.size(0), batch_size):
+                features = autoencoder.encode(activations[start:start + batch_size].to(device))
+                crow_indices, col_indices, values = self.sparsify_features(features, top_k=top_k)
+
+                all_crow_indices.append(crow_indices[1:].cpu().numpy() + num_nonzero)
+                all_col_indices.append(col_indices.cpu().numpy())
+                all_values.append(values.float().cpu().numpy())
+                num_nonzero += len(values)
+
+        hidden_size = autoencoder.encoder[0].weight.size(0)
+        return csr_matrix(
+            (
+                np.concatenate(all_values) if all_values else np.zeros(0, dtype=np.float32),
+                np.concatenate(all_col_indices) if all_col_indices else np.zeros(0, dtype=np.int64),
+                np.concatenate(all_crow_indices)
+            ), shape=(activations.size(0), hidden_size)
+        )
+
+    def get_all_sparse_dictionary_features(
+            self, activations_by_layer: dict[str, Union[list[Tensor], Tensor, np.ndarray]], top_k: int = None
+    ) -> dict[str, csr_matrix]:
+        """
+        Encodes a whole dataset of activations with one call per layer, eg. the target token activations
+        of ActivationsExtractor (a [num_samples, d] array per layer, or a list of [1, d] tensors per layer).
+
+        Returns:
+        A dictionary of layer name to a stacked [num_samples, hidden] sparse matrix, with one row per sample.
+        """
+        all_features = {}
+        for layer_name in self.autoencoders_dict:
+            activations = activations_by_layer[layer_name]
+            if isinstance(activations, list):
+                activations = torch.cat([activation.reshape(1, -1) for activation in activations], dim=0)
+            all_features[layer_name] = self.get_sparse_dictionary_features(activations, layer_name, top_k=top_k)
+        return all_features
+
     def get_all_dictionary_features_for_list(self, activations_dict_list: list[dict[str, list[Tensor]]]):
-        return [self.get_all_dictionary_features_for_point(point) for point in activations_dict_list]
+        """
+        Returns the per point features of get_all_dictionary_features_for_point, encoding all points at once.
+        """
+        for activations_dict in activations_dict_list:
+            for layer_name in self.autoencoders_dict:
+                assert len(activations_dict[layer_name]) == 1, "Can only do conversion for single elements right now"
+
+        stacked_features = self.get_all_sparse_dictionary_features({
+            layer_name: [activations_dict[layer_name][0] for activations_dict in activations_dict_list]
+            for layer_name in self.autoencoders_dict
+        })
+        return [
+            {layer_name: features[index:index + 1] for layer_name, features in stacked_features.items()}
+            for index in range(len(activations_dict_list))
+        ]
 
     def get_all_dictionary_features_for_point(self, activations_dict: dict[str, list[Tensor]]):
         all_features = {}
         for layer_name, autoencoder in self.autoencoders_dict.items():
             activations = activations_dict[layer_name]
             assert len(activations) == 1, "Can only do conversion for single elements right now"
-            curr_dict_features = self.get_dictionary_features(activations[0], layer_name)[0].tolist()
-            all_features[layer_name] = csr_matrix(curr_dict_features)
-        return all_features
\ No newline at end of file
+            all_features[layer_name] = self.get_sparse_dictionary_features(activations[0], layer_name)
+        return all_features
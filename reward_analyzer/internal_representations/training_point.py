@@ -5,6 +5,7 @@ import torch
 from torch import Tensor
 
 from nltk.sentiment.vader import SentimentIntensityAnalyzer
+from reward_analyzer.utils.gpu_utils import get_default_device_planner
 from reward_analyzer.utils.transformer_utils import get_single_target_token_id, get_tokens_and_ids
 
 
@@ -26,26 +27,36 @@ class TextTokensIdsTarget:
 
 
     @staticmethod
-    def get_tensorized(datapoints: "TextTokensIdsTarget", tokenizer):
+    def get_tensorized(datapoints: "TextTokensIdsTarget", tokenizer, device=None):
+        device = device or get_default_device_planner().get_device()
         max_length = max([len(datapoint.tokens) for datapoint in datapoints])
 
         input_ids = [datapoint.ids for datapoint in datapoints]
         attention_masks = [datapoint.attention_mask for datapoint in datapoints]
 
-        input_ids_padded = TextTokensIdsTarget.pad_list_of_lists(input_ids, tokenizer.encode(tokenizer.pad_token)[0])
+        if tokenizer.pad_token is None and any(len(ids) != max_length for ids in input_ids):
+            raise ValueError(
+                'Batching samples of different lengths needs a tokenizer with a pad_token, '
+                'eg. tokenizer.pad_token = tokenizer.eos_token.'
+            )
+        pad_token_id = tokenizer.encode(tokenizer.pad_token)[0] if tokenizer.pad_token is not None else 0
+        input_ids_padded = TextTokensIdsTarget.pad_list_of_lists(input_ids, pad_token_id)
         attention_masks_padded = TextTokensIdsTarget.pad_list_of_lists(attention_masks, 0)
         all_tokenized = {
-            "input_ids": torch.IntTensor(input_ids_padded).cuda(),
-            "attention_mask": torch.ByteTensor(attention_masks_padded).cuda()
+            "input_ids": torch.IntTensor(input_ids_padded).to(device),
+            "attention_mask": torch.ByteTensor(attention_masks_padded).to(device)
         }
         return all_tokenized
 
 class TrainingPoint:
 
-    intenisty_analyzer = SentimentIntensityAnalyzer()
-    lexicon = intenisty_analyzer.lexicon
+    # The vader lexicon is loaded with the first training point, so importing this module needs no nltk data.
+    lexicon = None
 
     def __init__(self, input_dict: dict, tokenizer, mappings: dict = None, verbose=False):
+        if TrainingPoint.lexicon is None:
+            TrainingPoint.lexicon = SentimentIntensityAnalyzer().lexicon
+
         self.mappings = mappings or {
             "positive_key": "input_text",
             "negative_key": "output_text",
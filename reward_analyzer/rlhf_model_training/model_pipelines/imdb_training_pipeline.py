@@ -112,11 +112,11 @@ class IMDBTrainingPipeline(RLHFModelPipeline):
         for i in range(bs):
             gen_len = 100
             output = self.ref_model.generate(
-                torch.tensor(query_tensors[i]).unsqueeze(dim=0).to('cuda'),**gen_kwargs
+                torch.tensor(query_tensors[i]).unsqueeze(dim=0).to(self.device),**gen_kwargs
             ).squeeze()[-gen_len:]
             response_tensors_ref.append(output)
             output = self.policy_model.generate(
-                torch.tensor(query_tensors[i]).unsqueeze(dim=0).to('cuda'), **gen_kwargs
+                torch.tensor(query_tensors[i]).unsqueeze(dim=0).to(self.device), **gen_kwargs
             ).squeeze()[-gen_len:]
             response_tensors.append(output)
 
@@ -17,7 +17,7 @@ from transformers.optimization import get_linear_schedule_with_warmup
 from trl import AutoModelForCausalLMWithValueHead
 
 from configs.rlhf_training_config import RLHFTrainingConfig
-from utils.gpu_utils import find_gpu_with_most_memory
+from utils.gpu_utils import DevicePlanner
 
 class RLHFModelPipeline:
     """
@@ -32,7 +32,8 @@ class RLHFModelPipeline:
         self.model_name = model_name
         self.rlhf_type = rlhf_type
 
-        self.device = find_gpu_with_most_memory()
+        self.device_planner = DevicePlanner()
+        self.device = self.device_planner.get_device()
         self.full_hyperparams_dict = {}
 
         self.rlhf_training_config = RLHFTrainingConfig()
@@ -55,7 +56,7 @@ class RLHFModelPipeline:
 
     def set_model_and_tokenizer(self):
         self.policy_model = AutoModelForCausalLMWithValueHead.from_pretrained(
-            self.model_name, load_in_8bit=False).cuda(device=self.device)
+            self.model_name, load_in_8bit=False).to(self.device)
 
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
         self.tokenizer.pad_token = self.tokenizer.eos_token
@@ -63,7 +64,7 @@ class RLHFModelPipeline:
         if self.rlhf_type == 'ppo':
             self.ref_model = AutoModelForCausalLMWithValueHead.from_pretrained(
                 self.model_name, load_in_8bit=False
-            ).cuda(device=self.device)
+            ).to(self.device)
 
     def set_config(self, dataset: Dataset, model_name: str):
         """
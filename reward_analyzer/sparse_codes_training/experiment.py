@@ -39,6 +39,37 @@ parser.add_argument(
     "--base_model_name", default='pythia-70m', type=str, help="The model name you want to use.", required=False)
 parser.add_argument(
     "--wandb_project_name", default=None, type=str, help="The wandb project name you wish to use", required=False)
+parser.add_argument(
+    "--activation_cache_dir", default=None, type=str,
+    help="The directory to cache layer activations in across epochs and runs.", required=False)
+parser.add_argument(
+    "--activation_cache_max_gb", default=None, type=float,
+    help="The size budget of the activation cache, after which old entries are evicted.", required=False)
+parser.add_argument(
+    "--tokenized_dataset_dir", default=None, type=str,
+    help="The directory to save the tokenized training dataset in, so that reruns skip tokenization.",
+    required=False)
+parser.add_argument(
+    "--checkpoint_dir", default=None, type=str,
+    help="The directory to checkpoint training in, so that a relaunched run resumes.", required=False)
+parser.add_argument(
+    "--shuffle_buffer_tokens", default=None, type=int,
+    help="Train on token batches shuffled across cache shards through a buffer of this many tokens, "
+         "eg. 32768. Needs --activation_cache_dir.", required=False)
+parser.add_argument(
+    "--sweep_l1_coefs", default=None, type=str,
+    help="Comma separated l1_coefs to also train stacked autoencoders for, eg. 0.0005,0.001,0.002.",
+    required=False)
+parser.add_argument(
+    "--metrics_backends", default=None, type=str,
+    help="Comma separated metrics backends out of jsonl, sqlite and wandb, eg. jsonl,sqlite to run offline.",
+    required=False)
+parser.add_argument(
+    "--mmcs_num_workers", default=None, type=int,
+    help="The number of processes to match MMCS layers in, 0 for every core.", required=False)
+parser.add_argument(
+    "--report_storage_formats", action="store_true",
+    help="Whether to measure the error of each activation storage format on the sorted layers.", required=False)
 parser.add_argument(
     "--task_config", default='hh', type=str,
     help="The task config you want to apply.", required=False)
@@ -74,7 +105,16 @@ def parse_args():
         "l1_coef": args.l1_coef,
         "num_epochs": args.num_epochs,
         "tied_weights": args.tied_weights,
-        "split": args.split
+        "split": args.split,
+        "activation_cache_dir": args.activation_cache_dir,
+        "activation_cache_max_gb": args.activation_cache_max_gb,
+        "tokenized_dataset_dir": args.tokenized_dataset_dir,
+        "checkpoint_dir": args.checkpoint_dir,
+        "shuffle_buffer_tokens": args.shuffle_buffer_tokens,
+        "metrics_backends": args.metrics_backends.split(',') if args.metrics_backends else None,
+        "mmcs_num_workers": args.mmcs_num_workers,
+        "report_storage_formats": args.report_storage_formats,
+        "sweep_l1_coefs": [float(l1_coef) for l1_coef in args.sweep_l1_coefs.split(',')] if args.sweep_l1_coefs else None
     }
     for key, value in parsed_hyperparams.items():
         if value is not None:
@@ -90,6 +130,8 @@ def parse_args():
 
     return default_experiment_config
 
-chosen_experiment_config = parse_args()
-print(f'Running experiment now for experiment config {chosen_experiment_config}')
-run_experiment(experiment_config=chosen_experiment_config)
\ No newline at end of file
+if __name__ == '__main__':
+    # Guarded, since spawned worker processes (eg. of the MMCS pool) import the main module again.
+    chosen_experiment_config = parse_args()
+    print(f'Running experiment now for experiment config {chosen_experiment_config}')
+    run_experiment(experiment_config=chosen_experiment_config)
\ No newline at end of file
@@ -40,7 +40,34 @@ hyperparameters_fast = {
     'split': 'test',
     'num_layers_to_keep': 5,
     'tied_weights': True,
-    'divergence_choice': 'highest_divergence'
+    'divergence_choice': 'highest_divergence',
+    'activation_cache_dir': None,
+    'activation_cache_max_gb': 100.0,
+    'single_pass_extraction': True,
+    'paired_extraction': False,
+    'pack_tokens': True,
+    'early_exit': True,
+    'tokenized_dataset_dir': None,
+    'prefetch_batches': 2,
+    'activation_storage_format': 'float32',
+    'report_storage_formats': False,
+    'metrics_flush_steps': 100,
+    'metrics_backends': ['jsonl', 'wandb'],
+    'metrics_dir': 'metrics',
+    'sparse_decode_min_sparsity': None,
+    'shuffle_buffer_tokens': None,
+    'loader_batch_tokens': 4096,
+    'loader_num_workers': 2,
+    'checkpoint_dir': None,
+    'checkpoint_every_steps': 500,
+    'mmcs_method': 'hungarian',
+    'mmcs_tile_size': 4096,
+    'mmcs_candidates_k': 10,
+    'mmcs_exact_max_size': 4096 * 8192,
+    'mmcs_num_workers': 1,
+    'streaming_divergence': True,
+    'divergence_chunk_bytes': 64 * 2 ** 20,
+    'divergence_num_workers': 4
 }
 
 
@@ -55,7 +82,34 @@ hyperparameters_full = {
     'split': 'test',
     'num_layers_to_keep': 5,
     'tied_weights': True,
-    'divergence_choice': 'highest_divergence'
+    'divergence_choice': 'highest_divergence',
+    'activation_cache_dir': None,
+    'activation_cache_max_gb': 100.0,
+    'single_pass_extraction': True,
+    'paired_extraction': False,
+    'pack_tokens': True,
+    'early_exit': True,
+    'tokenized_dataset_dir': None,
+    'prefetch_batches': 2,
+    'activation_storage_format': 'float32',
+    'report_storage_formats': False,
+    'metrics_flush_steps': 100,
+    'metrics_backends': ['jsonl', 'wandb'],
+    'metrics_dir': 'metrics',
+    'sparse_decode_min_sparsity': None,
+    'shuffle_buffer_tokens': None,
+    'loader_batch_tokens': 8192,
+    'loader_num_workers': 4,
+    'checkpoint_dir': None,
+    'checkpoint_every_steps': 500,
+    'mmcs_method': 'hungarian',
+    'mmcs_tile_size': 4096,
+    'mmcs_candidates_k': 10,
+    'mmcs_exact_max_size': 4096 * 8192,
+    'mmcs_num_workers': 1,
+    'streaming_divergence': True,
+    'divergence_chunk_bytes': 64 * 2 ** 20,
+    'divergence_num_workers': 4
 }
 
 all_models = [
@@ -0,0 +1,186 @@
+"""
+This module persists layer activations to disk, so that later epochs, reruns and sweeps
+over the same model, layer and dataset read them back instead of re-running the LLM.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import List
+
+import numpy as np
+import torch
+
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_storage import (
+    decode_activations, encode_activations, get_storage_format
+)
+
+
+def hash_texts(input_texts: List[str]) -> str:
+    """
+    Hashes the texts of a dataset, in order.
+    """
+    hasher = hashlib.sha1()
+    for text in input_texts:
+        hasher.update(text.encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+class ActivationCache:
+    """
+    A sharded, memory-mapped store of layer activations.
+
+    Each entry is a directory holding one .npy shard per batch, keyed by the model name and revision,
+    the layer name, the tokenizer settings and a hash of the dataset. An entry only becomes readable
+    once all of its shards are written. Least recently used entries are evicted to stay within max_size_gb.
+    """
+    manifest_name = 'manifest.json'
+
+    def __init__(self, cache_dir: str, max_size_gb: float = 100.0):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_gb * 1024 * 1024 * 1024)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(
+            self, model, layer_name: str, hyperparameters: dict, input_texts: List[str], tokenizer,
+            dataset_hash: str = None
+    ) -> str:
+        """
+        Builds the cache key for activations of a layer of a model on a dataset.
+        The batch size and token budget are part of the key, since they decide what each shard holds,
+        and so is token packing, since packed shards hold [n_tokens, d] rather than [batch, seq, d].
+        The tokenizer is part of the key too, since the same texts tokenized differently give other activations.
+        Callers building keys for several layers should hash the texts once and pass dataset_hash.
+        """
+        key_parts = {
+            'model_name': model.config.name_or_path,
+            'revision': getattr(model.config, '_commit_hash', None),
+            'tokenizer_name': tokenizer.name_or_path,
+            'tokenizer_revision': getattr(tokenizer, 'init_kwargs', {}).get('_commit_hash'),
+            'tokenizer_vocab_size': len(tokenizer),
+            'padding_side': tokenizer.padding_side,
+            'layer_name': layer_name,
+            'max_input_length': hyperparameters['max_input_length'],
+            'batch_size': hyperparameters['batch_size'],
+            'pack_tokens': hyperparameters.get('pack_tokens', False),
+            'max_batch_tokens': hyperparameters.get('max_batch_tokens'),
+            'storage_format': get_storage_format(hyperparameters, layer_name),
+            'dataset_hash': dataset_hash or hash_texts(input_texts)
+        }
+        serialized = json.dumps(key_parts, sort_keys=True)
+        return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+    def get_entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def get_shard_path(self, key: str, shard_index: int) -> str:
+        return os.path.join(self.get_entry_dir(key), f'shard_{shard_index:06d}.npy')
+
+    def get_scales_path(self, key: str, shard_index: int) -> str:
+        return os.path.join(self.get_entry_dir(key), f'scales_{shard_index:06d}.npy')
+
+    def get_offsets_path(self, key: str, shard_index: int) -> str:
+        return os.path.join(self.get_entry_dir(key), f'offsets_{shard_index:06d}.npy')
+
+    def is_complete(self, key: str) -> bool:
+        """
+        An entry is complete once its manifest has been written.
+        """
+        return os.path.exists(os.path.join(self.get_entry_dir(key), self.manifest_name))
+
+    def get_num_shards(self, key: str) -> int:
+        with open(os.path.join(self.get_entry_dir(key), self.manifest_name), 'r') as f_in:
+            return json.load(f_in)['num_shards']
+
+    def start_entry(self, key: str):
+        """
+        Clears any partially written entry for this key, and evicts old entries to make room.
+        """
+        entry_dir = self.get_entry_dir(key)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        self.evict(protected_key=key)
+        os.makedirs(entry_dir, exist_ok=True)
+
+    @staticmethod
+    def save_atomically(path: str, array: np.ndarray):
+        temp_path = f'{path}.tmp.npy'
+        np.save(temp_path, array)
+        os.replace(temp_path, path)
+
+    def write_shard(
+            self, key: str, shard_index: int, activations: torch.Tensor, sequence_offsets: torch.Tensor = None,
+            storage_format: str = 'float32'
+    ):
+        """
+        Writes one batch of activations atomically, in the given storage format.
+        int8 shards have their per-row scales, and packed activations their per-sequence offsets, stored next to them.
+        """
+        if sequence_offsets is not None:
+            self.save_atomically(self.get_offsets_path(key, shard_index), sequence_offsets.cpu().numpy())
+
+        encoded = encode_activations(activations, storage_format)
+        if 'scales' in encoded:
+            self.save_atomically(self.get_scales_path(key, shard_index), encoded['scales'])
+        self.save_atomically(self.get_shard_path(key, shard_index), encoded['values'])
+
+    def read_shard(self, key: str, shard_index: int, storage_format: str = 'float32') -> torch.Tensor:
+        """
+        Reads one batch of activations through a memory map, dequantizing it to float32.
+        """
+        encoded = {'values': np.load(self.get_shard_path(key, shard_index), mmap_mode='r')}
+        if storage_format == 'int8':
+            encoded['scales'] = np.load(self.get_scales_path(key, shard_index))
+        return decode_activations(encoded, storage_format)
+
+    def read_offsets(self, key: str, shard_index: int) -> torch.Tensor:
+        """
+        Reads the per-sequence offsets of a packed shard, or None if the shard is not packed.
+        """
+        offsets_path = self.get_offsets_path(key, shard_index)
+        if not os.path.exists(offsets_path):
+            return None
+        return torch.from_numpy(np.load(offsets_path))
+
+    def mark_complete(self, key: str, num_shards: int, metadata: dict = None):
+        """
+        Writes the manifest of an entry, after which it is served from disk.
+        """
+        manifest = {'num_shards': num_shards, 'created': time.time()}
+        manifest.update(metadata or {})
+        with open(os.path.join(self.get_entry_dir(key), self.manifest_name), 'w') as f_out:
+            json.dump(manifest, f_out)
+        self.evict(protected_key=key)
+
+    def touch(self, key: str):
+        """
+        Marks an entry as recently used.
+        """
+        os.utime(os.path.join(self.get_entry_dir(key), self.manifest_name))
+
+    @staticmethod
+    def get_dir_size(path: str) -> int:
+        total_size = 0
+        for root, _, files in os.walk(path):
+            for filename in files:
+                total_size += os.path.getsize(os.path.join(root, filename))
+        return total_size
+
+    def evict(self, protected_key: str = None):
+        """
+        Removes least recently used complete entries until the cache fits in its size budget.
+        Incomplete entries belong to in-flight writers and are never evicted.
+        """
+        entry_sizes = {key: self.get_dir_size(self.get_entry_dir(key)) for key in os.listdir(self.cache_dir)}
+        total_size = sum(entry_sizes.values())
+
+        evictable_keys = [key for key in entry_sizes if key != protected_key and self.is_complete(key)]
+        evictable_keys.sort(key=lambda key: os.path.getmtime(os.path.join(self.get_entry_dir(key), self.manifest_name)))
+
+        for key in evictable_keys:
+            if total_size <= self.max_size_bytes:
+                break
+            print(f'Evicting activation cache entry {key}')
+            shutil.rmtree(self.get_entry_dir(key), ignore_errors=True)
+            total_size -= entry_sizes[key]
@@ -0,0 +1,115 @@
+"""
+This module overlaps the production of activation batches (tokenization, the LLM forward pass
+and host/device copies) with the autoencoder training steps that consume them.
+"""
+import queue
+import threading
+import time
+from typing import Callable, Iterable
+
+
+class ActivationPrefetcher:
+    """
+    Iterates over a batch iterator on a background thread, keeping up to max_prefetch batches
+    ready in a bounded queue while the consumer trains on the previous batch.
+
+    Records how long the consumer waited for batches (consumer stalls, meaning extraction is the bottleneck),
+    how long the producer waited for room in the queue (producer stalls, meaning training is the bottleneck),
+    and the queue depth seen by the consumer.
+    """
+    _end_of_batches = object()
+
+    def __init__(self, batches: Iterable, max_prefetch: int = 2, transform: Callable = None):
+        self.batches = batches
+        self.max_prefetch = max_prefetch
+        self.transform = transform
+
+        self.queue = queue.Queue(maxsize=max_prefetch)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.num_batches = 0
+        self.consumer_stall_seconds = 0.0
+        self.producer_stall_seconds = 0.0
+        self.total_queue_depth = 0
+
+    def _put(self, item):
+        """
+        Puts an item on the queue, giving up if the consumer has stopped. Returns whether the item was put.
+        """
+        start_time = time.perf_counter()
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                self.producer_stall_seconds += time.perf_counter() - start_time
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            for item in self.batches:
+                if self.transform is not None:
+                    item = self.transform(item)
+                if not self._put(item):
+                    return
+            self._put(self._end_of_batches)
+        except Exception as exception:  # pylint: disable=broad-except
+            # Re-raised on the consumer's thread.
+            self._put(exception)
+        finally:
+            # Lets generators release their resources (eg. hooks) on the thread that ran them.
+            if hasattr(self.batches, 'close'):
+                self.batches.close()
+
+    def __iter__(self):
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+        try:
+            while True:
+                self.total_queue_depth += self.queue.qsize()
+                start_time = time.perf_counter()
+                item = self.queue.get()
+                self.consumer_stall_seconds += time.perf_counter() - start_time
+
+                if item is self._end_of_batches:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+
+                self.num_batches += 1
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stops the producer, eg. if the consumer ends iteration early.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def get_metrics(self, label: str = None) -> dict:
+        suffix = f'_{label}' if label else ''
+        num_gets = max(self.num_batches, 1)
+        return {
+            f'prefetch_consumer_stall_seconds{suffix}': self.consumer_stall_seconds,
+            f'prefetch_producer_stall_seconds{suffix}': self.producer_stall_seconds,
+            f'prefetch_mean_queue_depth{suffix}': self.total_queue_depth / num_gets,
+            f'prefetch_num_batches{suffix}': self.num_batches
+        }
+
+    def report(self, label: str = None) -> dict:
+        """
+        Prints a summary of the stall metrics, and returns them for logging.
+        """
+        metrics = self.get_metrics(label)
+        print(
+            f'Prefetching for {label}: consumer stalled {self.consumer_stall_seconds:.1f}s, '
+            f'producer stalled {self.producer_stall_seconds:.1f}s, '
+            f'mean queue depth {self.total_queue_depth / max(self.num_batches, 1):.2f} over {self.num_batches} batches'
+        )
+        return metrics
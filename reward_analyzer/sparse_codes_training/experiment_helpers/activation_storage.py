@@ -0,0 +1,103 @@
+"""
+This module encodes activations in reduced precision formats for storage,
+and reports how much each format perturbs the activations and autoencoder reconstructions.
+"""
+from typing import Dict
+
+import numpy as np
+import torch
+from torch import nn
+
+ACTIVATION_STORAGE_FORMATS = ('float32', 'float16', 'bfloat16', 'int8')
+
+
+def get_storage_format(hyperparameters: dict, layer_name: str) -> str:
+    """
+    Returns the storage format for a layer. hyperparameters['activation_storage_format'] is either
+    one format for all layers, or a dictionary of layer name to format, defaulting to float32.
+    """
+    storage_format = hyperparameters.get('activation_storage_format') or 'float32'
+    if isinstance(storage_format, dict):
+        storage_format = storage_format.get(layer_name, 'float32')
+
+    if storage_format not in ACTIVATION_STORAGE_FORMATS:
+        raise ValueError(f'Activation storage format {storage_format} not supported!')
+    return storage_format
+
+
+def quantize_int8_per_row(activations: torch.Tensor):
+    """
+    Symmetric int8 quantization with one float32 scale per row (over the last dimension).
+    """
+    activations = activations.to(dtype=torch.float32)
+    scales = activations.abs().amax(dim=-1, keepdim=True) / 127.0
+    scales = torch.where(scales > 0, scales, torch.ones_like(scales))
+    quantized = torch.clamp(torch.round(activations / scales), -127, 127).to(dtype=torch.int8)
+    return quantized, scales
+
+
+def encode_activations(activations: torch.Tensor, storage_format: str) -> Dict[str, np.ndarray]:
+    """
+    Encodes activations as numpy arrays: 'values', plus 'scales' for int8.
+    bfloat16 has no numpy dtype, so its bits are stored as int16.
+    """
+    activations = activations.detach()
+    if storage_format == 'float32':
+        return {'values': activations.to(dtype=torch.float32).cpu().numpy()}
+    if storage_format == 'float16':
+        return {'values': activations.to(dtype=torch.float16).cpu().numpy()}
+    if storage_format == 'bfloat16':
+        return {'values': activations.to(dtype=torch.bfloat16).view(torch.int16).cpu().numpy()}
+    if storage_format == 'int8':
+        quantized, scales = quantize_int8_per_row(activations)
+        return {'values': quantized.cpu().numpy(), 'scales': scales.cpu().numpy()}
+    raise ValueError(f'Activation storage format {storage_format} not supported!')
+
+
+def decode_activations(encoded: Dict[str, np.ndarray], storage_format: str) -> torch.Tensor:
+    """
+    Decodes activations encoded by encode_activations back into a float32 tensor.
+    """
+    values = torch.from_numpy(np.array(encoded['values']))
+    if storage_format == 'bfloat16':
+        values = values.view(torch.bfloat16)
+    if storage_format == 'int8':
+        return values.to(dtype=torch.float32) * torch.from_numpy(np.array(encoded['scales']))
+    return values.to(dtype=torch.float32)
+
+
+def get_storage_format_report(activations: torch.Tensor, autoencoders: list = None) -> Dict[str, dict]:
+    """
+    For each storage format, measures the error that a round trip through the format adds to
+    a batch of activations, and if autoencoders are given, their reconstruction loss on the
+    round tripped activations next to their loss on the originals.
+    """
+    criterion = nn.MSELoss()
+    activations = activations.detach().to(dtype=torch.float32).cpu()
+    activations_norm = activations.pow(2).mean().item()
+
+    report = {}
+    for storage_format in ACTIVATION_STORAGE_FORMATS:
+        encoded = encode_activations(activations, storage_format)
+        decoded = decode_activations(encoded, storage_format)
+        storage_mse = criterion(decoded, activations).item()
+
+        format_report = {
+            'bytes_per_value': sum(array.nbytes for array in encoded.values()) / activations.numel(),
+            'storage_mse': storage_mse,
+            'relative_storage_mse': storage_mse / activations_norm if activations_norm > 0 else 0.0,
+        }
+
+        for index, autoencoder in enumerate(autoencoders or []):
+            device = next(autoencoder.parameters()).device
+            with torch.no_grad():
+                _, reconstruction = autoencoder(activations.to(device))
+                _, decoded_reconstruction = autoencoder(decoded.to(device))
+            format_report[f'reconstruction_loss_{index}'] = criterion(reconstruction.cpu(), activations).item()
+            format_report[f'decoded_reconstruction_loss_{index}'] = criterion(
+                decoded_reconstruction.cpu(), activations
+            ).item()
+
+        report[storage_format] = format_report
+
+    return report
@@ -2,10 +2,23 @@
 This class is responsible for extracting feature dictionaries from models,
 given hyperparameters and input texts.
 """
-from typing import List
+from typing import Callable, Dict, Iterator, List, Tuple
 
+import torch
+from torch import optim
+from tqdm import tqdm
+
+from reward_analyzer.sparse_codes_training.models.multi_sparse_autoencoder import MultiSparseAutoencoder
 from reward_analyzer.sparse_codes_training.models.sparse_autoencoder import SparseAutoencoder
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_cache import ActivationCache
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_prefetcher import ActivationPrefetcher
+from reward_analyzer.sparse_codes_training.experiment_helpers.sharded_activation_loader import (
+    ShardedActivationLoader, write_missing_cache_entries
+)
+from reward_analyzer.sparse_codes_training.experiment_helpers.tokenized_dataset import TokenizedDataset
+from reward_analyzer.sparse_codes_training.experiment_helpers.training_checkpointer import TrainingCheckpointer
 from reward_analyzer.sparse_codes_training.experiment_helpers.layer_activations_handler import LayerActivationsHandler
+from reward_analyzer.utils.metrics_sink import log_metrics
 
 class AutoencoderDataPreparerAndTrainer:
     """
@@ -14,11 +27,14 @@ class AutoencoderDataPreparerAndTrainer:
     the autoencoders.
     """
     def __init__(
-            self, model, tokenizer, hyperparameters: dict, autoencoder_device: str
+            self, model, tokenizer, hyperparameters: dict, autoencoder_device: str,
+            activation_cache: ActivationCache = None, checkpointer: TrainingCheckpointer = None
     ):
         self.model = model
         self.tokenizer = tokenizer
         self.hyperparameters = hyperparameters
+        self.activation_cache = activation_cache
+        self.checkpointer = checkpointer
 
         self.layer_activations_handler = LayerActivationsHandler(model=self.model)
 
@@ -27,7 +43,7 @@ class AutoencoderDataPreparerAndTrainer:
 
     def train_autoencoder_on_text_activations(
         self, layer_name: str, input_texts: List[str],
-        hidden_size_multiple: int, label: str ='default',
+        hidden_size_multiple: int, label: str ='default', tokenized_dataset: TokenizedDataset = None
     ):
         """
         Trains and returns an autoencoder list on text
@@ -51,7 +67,8 @@ class AutoencoderDataPreparerAndTrainer:
         autoencoder = SparseAutoencoder(
             input_size, hidden_size=hidden_size,
             l1_coef=self.hyperparameters['l1_coef'],
-            tied_weights=self.hyperparameters['tied_weights']
+            tied_weights=self.hyperparameters['tied_weights'],
+            sparse_decode_min_sparsity=self.hyperparameters.get('sparse_decode_min_sparsity')
         )
 
         print(f'Placing autoencoder for {local_label} on {self.autoencoder_device}')
@@ -61,7 +78,320 @@ class AutoencoderDataPreparerAndTrainer:
             input_texts=input_texts, hyperparameters=self.hyperparameters,
             model_device=self.model_device, autoencoder_device=self.autoencoder_device,
             label=local_label, layer_name=layer_name,
-            activations_handler=self.layer_activations_handler, tokenizer=self.tokenizer
+            activations_handler=self.layer_activations_handler, tokenizer=self.tokenizer,
+            activation_cache=self.activation_cache, tokenized_dataset=tokenized_dataset,
+            checkpointer=self.checkpointer, checkpoint_label=f'{local_label}_x{hidden_size_multiple}'
         )
 
         return [autoencoder]
+
+    def build_multi_layer_autoencoders(
+        self, layer_names: List[str], input_texts: List[str], hidden_size_multiples: Dict[int, str], label: str
+    ):
+        """
+        Creates one autoencoder and optimizer per (layer, hidden size multiple) pair, sized from a first batch.
+
+        Returns:
+        Dictionaries keyed by (label, layer_name, hidden_size_multiple), of autoencoders, optimizers and their labels.
+        """
+        batch_size = self.hyperparameters['batch_size']
+        first_activations = self.layer_activations_handler.get_multi_layer_activations(
+            layer_names=layer_names, input_texts=input_texts[:batch_size], tokenizer=self.tokenizer,
+            device=self.model_device, hyperparameters=self.hyperparameters
+        )
+
+        autoencoders, optimizers, local_labels = {}, {}, {}
+        for layer_name in layer_names:
+            input_size = first_activations[layer_name].size(-1)
+            for hidden_size_multiple, multiple_label in hidden_size_multiples.items():
+                key = (label, layer_name, hidden_size_multiple)
+                local_labels[key] = f'{layer_name}_{label}_{multiple_label}'
+
+                autoencoder = SparseAutoencoder(
+                    input_size, hidden_size=input_size * hidden_size_multiple,
+                    l1_coef=self.hyperparameters['l1_coef'],
+                    tied_weights=self.hyperparameters['tied_weights'],
+                    sparse_decode_min_sparsity=self.hyperparameters.get('sparse_decode_min_sparsity')
+                )
+                print(f'Placing autoencoder for {local_labels[key]} on {self.autoencoder_device}')
+                autoencoder.to(self.autoencoder_device)
+                autoencoder.define_metrics(local_labels[key])
+
+                autoencoders[key] = autoencoder
+                optimizers[key] = optim.Adam(autoencoder.parameters(), lr=self.hyperparameters['learning_rate'])
+
+        return autoencoders, optimizers, local_labels
+
+    def get_cache_keys(
+        self, layer_names: List[str], input_texts: List[str], source: str, tokenized_dataset: TokenizedDataset = None
+    ):
+        """
+        Returns a dictionary of (source, layer_name) to this model's activation cache key, or None without a cache.
+        """
+        if self.activation_cache is None:
+            return None
+        cache_keys = self.layer_activations_handler.get_cache_keys(
+            layer_names, input_texts, self.tokenizer, self.hyperparameters, activation_cache=self.activation_cache,
+            dataset_hash=tokenized_dataset.dataset_hash if tokenized_dataset is not None else None
+        )
+        return {(source, layer_name): cache_key for layer_name, cache_key in cache_keys.items()}
+
+    def get_shuffled_activations_loader(self, cache_keys: dict, get_activations_batches: Callable):
+        """
+        Returns a loader of shuffled token batches from the cache entries, writing any missing entries first,
+        if hyperparameters['shuffle_buffer_tokens'] is set. Otherwise returns None, and batches are read in order.
+        """
+        if not cache_keys or not self.hyperparameters.get('shuffle_buffer_tokens'):
+            return None
+        write_missing_cache_entries(self.activation_cache, cache_keys, get_activations_batches)
+        return ShardedActivationLoader.from_hyperparameters(self.activation_cache, cache_keys, self.hyperparameters)
+
+    def train_autoencoders_on_activation_batches(
+        self, autoencoders: dict, optimizers: dict, local_labels: dict, get_activations_batches: Callable,
+        num_batches: int, label: str, cache_keys: dict = None
+    ):
+        """
+        Trains autoencoders keyed by (source, layer_name, hidden_size_multiple) for num_epochs.
+        get_activations_batches(start_batch) returns a new iterator per epoch from batch start_batch on,
+        over dictionaries of source (eg. 'base' or 'rlhf') to dictionaries of layer name to activations.
+        Each batch of a source and layer is fanned out to all autoencoders of that source and layer.
+
+        If cache_keys of (source, layer_name) to activation cache keys are given and shuffling is enabled,
+        the activations are instead streamed as shuffled token batches from the cache, see get_shuffled_activations_loader.
+
+        With a checkpointer, training states are saved under label, and training resumes from the last one,
+        skipping it entirely if all epochs were done.
+        """
+        num_epochs = self.hyperparameters['num_epochs']
+
+        start_epoch, start_batch = 0, 0
+        if self.checkpointer is not None:
+            start_epoch, start_batch = self.checkpointer.restore_training_state(label, autoencoders, optimizers)
+        if start_epoch >= num_epochs:
+            return
+
+        loader = self.get_shuffled_activations_loader(cache_keys, get_activations_batches)
+        if loader is not None:
+            num_batches = len(loader)
+
+        for epoch in range(start_epoch, num_epochs):
+            for autoencoder in autoencoders.values():
+                autoencoder.start_epoch(metrics_flush_steps=self.hyperparameters.get('metrics_flush_steps', 100))
+
+            # A resumed epoch starts at the checkpointed batch, without reading or extracting the batches before it.
+            first_batch = start_batch if epoch == start_epoch else 0
+            if loader is not None:
+                loader.set_epoch(epoch)
+                activations_batches = by_source(loader.iterate(start_batch=first_batch))
+            else:
+                activations_batches = get_activations_batches(start_batch=first_batch)
+
+            prefetcher = None
+            if self.hyperparameters.get('prefetch_batches'):
+                prefetcher = ActivationPrefetcher(
+                    activations_batches, max_prefetch=self.hyperparameters['prefetch_batches'],
+                    transform=lambda activations_by_source: {
+                        source: {
+                            layer_name: activations.to(self.autoencoder_device, dtype=torch.float32)
+                            for layer_name, activations in activations_by_layer.items()
+                        } for source, activations_by_layer in activations_by_source.items()
+                    }
+                )
+                activations_batches = prefetcher
+
+            for batch_index, activations_by_source in enumerate(
+                tqdm(activations_batches, total=num_batches, initial=first_batch), start=first_batch
+            ):
+                for source, activations_by_layer in activations_by_source.items():
+                    for layer_name, activations_batch in activations_by_layer.items():
+                        data = activations_batch.to(self.autoencoder_device, dtype=torch.float32)
+                        for key, autoencoder in autoencoders.items():
+                            if key[:2] == (source, layer_name):
+                                autoencoder.training_step(data, optimizer=optimizers[key], label=local_labels[key])
+
+                if self.checkpointer is not None and self.checkpointer.should_save(batch_index + 1):
+                    self.checkpointer.save_training_state(
+                        label, autoencoders, optimizers, epoch=epoch, batch_index=batch_index + 1
+                    )
+
+            if prefetcher is not None:
+                log_metrics(prefetcher.report(label))
+
+            for key, autoencoder in autoencoders.items():
+                autoencoder.end_epoch(epoch, num_epochs=num_epochs, label=local_labels[key])
+
+            if self.checkpointer is not None:
+                self.checkpointer.save_training_state(label, autoencoders, optimizers, epoch=epoch + 1, batch_index=0)
+
+    def train_autoencoders_on_multi_layer_text_activations(
+        self, layer_names: List[str], input_texts: List[str],
+        hidden_size_multiples: Dict[int, str], label: str = 'default', tokenized_dataset: TokenizedDataset = None
+    ):
+        """
+        Trains one autoencoder per (layer, hidden size multiple) pair, from a single forward pass
+        of the model per batch. Each batch's activations are fanned out to all autoencoders of that layer.
+
+        Args:
+        layer_names: The layers to hook at once.
+        input_texts: The texts to train on.
+        hidden_size_multiples: Maps each hidden size multiple to its label, eg. {1: 'small', 2: 'big'}.
+        label: Prefix for the labels of the autoencoders.
+        tokenized_dataset: If given, the pre-tokenized input texts, used instead of re-tokenizing.
+
+        Returns:
+        A dictionary mapping (layer_name, hidden_size_multiple) to an autoencoder list.
+        """
+        num_batches = int(len(input_texts) / self.hyperparameters['batch_size'])
+        autoencoders, optimizers, local_labels = self.build_multi_layer_autoencoders(
+            layer_names, input_texts=input_texts, hidden_size_multiples=hidden_size_multiples, label=label
+        )
+
+        def get_activations_batches(start_batch=0):
+            activations_batches = self.layer_activations_handler.iterate_multi_layer_activations(
+                layer_names=layer_names, input_texts=input_texts, tokenizer=self.tokenizer,
+                device=self.model_device, hyperparameters=self.hyperparameters,
+                activation_cache=self.activation_cache, tokenized_dataset=tokenized_dataset, start_batch=start_batch
+            )
+            return with_source(activations_batches, source=label)
+
+        self.train_autoencoders_on_activation_batches(
+            autoencoders, optimizers, local_labels, get_activations_batches=get_activations_batches,
+            num_batches=num_batches, label=label,
+            cache_keys=self.get_cache_keys(layer_names, input_texts, source=label, tokenized_dataset=tokenized_dataset)
+        )
+
+        return {(layer_name, multiple): [autoencoder] for (_, layer_name, multiple), autoencoder in autoencoders.items()}
+
+    def train_paired_autoencoders_on_multi_layer_text_activations(
+        self, other: "AutoencoderDataPreparerAndTrainer", layer_names: List[str], input_texts: List[str],
+        hidden_size_multiples: Dict[int, str], tokenized_dataset: TokenizedDataset = None
+    ):
+        """
+        Trains the autoencoders of this (base) model and another (rlhf) model together, from paired batches:
+        each batch is tokenized once and run through both models, see iterate_paired_multi_layer_activations.
+
+        Returns:
+        A dictionary with 'base' and 'rlhf' dictionaries of (layer_name, hidden_size_multiple) to an autoencoder list.
+        """
+        num_batches = int(len(input_texts) / self.hyperparameters['batch_size'])
+        autoencoders, optimizers, local_labels = self.build_multi_layer_autoencoders(
+            layer_names, input_texts=input_texts, hidden_size_multiples=hidden_size_multiples, label='base'
+        )
+        other_autoencoders, other_optimizers, other_local_labels = other.build_multi_layer_autoencoders(
+            layer_names, input_texts=input_texts, hidden_size_multiples=hidden_size_multiples, label='rlhf'
+        )
+        autoencoders.update(other_autoencoders)
+        optimizers.update(other_optimizers)
+        local_labels.update(other_local_labels)
+
+        def get_activations_batches(start_batch=0):
+            return self.layer_activations_handler.iterate_paired_multi_layer_activations(
+                other_handler=other.layer_activations_handler, layer_names=layer_names, input_texts=input_texts,
+                tokenizer=self.tokenizer, device=self.model_device, other_device=other.model_device,
+                hyperparameters=self.hyperparameters, activation_cache=self.activation_cache,
+                tokenized_dataset=tokenized_dataset, start_batch=start_batch
+            )
+
+        cache_keys = self.get_cache_keys(layer_names, input_texts, source='base', tokenized_dataset=tokenized_dataset)
+        if cache_keys is not None:
+            cache_keys.update(
+                other.get_cache_keys(layer_names, input_texts, source='rlhf', tokenized_dataset=tokenized_dataset)
+            )
+
+        self.train_autoencoders_on_activation_batches(
+            autoencoders, optimizers, local_labels, get_activations_batches=get_activations_batches,
+            num_batches=num_batches, label='paired', cache_keys=cache_keys
+        )
+
+        trained_autoencoders = {'base': {}, 'rlhf': {}}
+        for (source, layer_name, multiple), autoencoder in autoencoders.items():
+            trained_autoencoders[source][(layer_name, multiple)] = [autoencoder]
+        return trained_autoencoders
+
+    def train_autoencoder_sweep_on_multi_layer_text_activations(
+        self, layer_names: List[str], input_texts: List[str], sweep_settings: List[Tuple[int, float]],
+        label: str = 'default', tokenized_dataset: TokenizedDataset = None
+    ):
+        """
+        Trains one autoencoder per layer and sweep setting, from a single extraction per batch.
+        The autoencoders of each layer are stacked into one MultiSparseAutoencoder with a single optimizer.
+
+        Args:
+        layer_names: The layers to hook at once.
+        input_texts: The texts to train on.
+        sweep_settings: The (hidden_size_multiple, l1_coef) of each autoencoder per layer.
+        label: Prefix for the labels of the autoencoders.
+        tokenized_dataset: If given, the pre-tokenized input texts, used instead of re-tokenizing.
+
+        Returns:
+        A dictionary mapping (layer_name, hidden_size_multiple, l1_coef) to an autoencoder list.
+        """
+        batch_size = self.hyperparameters['batch_size']
+        num_batches = int(len(input_texts) / batch_size)
+        first_activations = self.layer_activations_handler.get_multi_layer_activations(
+            layer_names=layer_names, input_texts=input_texts[:batch_size], tokenizer=self.tokenizer,
+            device=self.model_device, hyperparameters=self.hyperparameters
+        )
+
+        autoencoders, optimizers, local_labels = {}, {}, {}
+        for layer_name in layer_names:
+            key = (label, layer_name, 'sweep')
+            input_size = first_activations[layer_name].size(-1)
+            local_labels[key] = [
+                f'{layer_name}_{label}_x{hidden_size_multiple}_l1_{l1_coef}'
+                for hidden_size_multiple, l1_coef in sweep_settings
+            ]
+
+            autoencoder = MultiSparseAutoencoder(
+                input_size, hidden_sizes=[input_size * hidden_size_multiple for hidden_size_multiple, _ in sweep_settings],
+                l1_coefs=[l1_coef for _, l1_coef in sweep_settings], tied_weights=self.hyperparameters['tied_weights'],
+                sparse_decode_min_sparsity=self.hyperparameters.get('sparse_decode_min_sparsity')
+            )
+            print(f'Placing {len(sweep_settings)} stacked autoencoders for {layer_name}_{label} on {self.autoencoder_device}')
+            autoencoder.to(self.autoencoder_device)
+            autoencoder.define_metrics(local_labels[key])
+
+            autoencoders[key] = autoencoder
+            optimizers[key] = optim.Adam(autoencoder.parameters(), lr=self.hyperparameters['learning_rate'])
+
+        def get_activations_batches(start_batch=0):
+            activations_batches = self.layer_activations_handler.iterate_multi_layer_activations(
+                layer_names=layer_names, input_texts=input_texts, tokenizer=self.tokenizer,
+                device=self.model_device, hyperparameters=self.hyperparameters,
+                activation_cache=self.activation_cache, tokenized_dataset=tokenized_dataset, start_batch=start_batch
+            )
+            return with_source(activations_batches, source=label)
+
+        self.train_autoencoders_on_activation_batches(
+            autoencoders, optimizers, local_labels, get_activations_batches=get_activations_batches,
+            num_batches=num_batches, label=f'{label}_sweep',
+            cache_keys=self.get_cache_keys(layer_names, input_texts, source=label, tokenized_dataset=tokenized_dataset)
+        )
+
+        trained_autoencoders = {}
+        for (_, layer_name, _), autoencoder in autoencoders.items():
+            for (hidden_size_multiple, l1_coef), split_autoencoder in zip(sweep_settings, autoencoder.to_autoencoders()):
+                trained_autoencoders[(layer_name, hidden_size_multiple, l1_coef)] = [split_autoencoder]
+        return trained_autoencoders
+
+
+def with_source(activations_batches: Iterator, source: str):
+    """
+    Wraps each batch of a dictionary of layer name to activations as {source: batch}.
+    """
+    try:
+        for activations_by_layer in activations_batches:
+            yield {source: activations_by_layer}
+    finally:
+        activations_batches.close()
+
+
+def by_source(activations_batches: Iterator):
+    """
+    Regroups each batch of a dictionary of (source, layer_name) to activations as {source: {layer_name: activations}}.
+    """
+    for activations_by_name in activations_batches:
+        activations_by_source = {}
+        for (source, layer_name), activations in activations_by_name.items():
+            activations_by_source.setdefault(source, {})[layer_name] = activations
+        yield activations_by_source
@@ -0,0 +1,193 @@
+"""
+This module computes the weight divergences between the base and rlhf models straight from their safetensors
+checkpoints, instead of from both models loaded in memory. Checkpoints are memory mapped and every matching pair
+of tensors is streamed in chunks of rows, so memory use is bounded by the chunk size and the number of workers,
+even for checkpoints larger than memory, and int8 checkpoints are dequantized rather than compared as storage.
+"""
+import glob
+import math
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from huggingface_hub import snapshot_download
+from safetensors import safe_open
+
+
+class UnsupportedCheckpointError(ValueError):
+    """
+    Raised for checkpoint tensors whose stored values cannot be turned back into weights,
+    eg. quantized tensors without row scales of the expected shape.
+    Divergences can then still be computed from the loaded models.
+    """
+
+
+def find_safetensors_files(model_path_or_name: str) -> List[str]:
+    """
+    Returns the safetensors files of a local model directory, or of a hub model, downloading only those files.
+    """
+    if not os.path.isdir(model_path_or_name):
+        model_path_or_name = snapshot_download(model_path_or_name, allow_patterns=['*.safetensors'])
+    safetensors_files = sorted(glob.glob(os.path.join(model_path_or_name, '*.safetensors')))
+    if not safetensors_files:
+        raise FileNotFoundError(f'No safetensors checkpoint found for {model_path_or_name}.')
+    return safetensors_files
+
+
+def get_tensor_locations(safetensors_files: List[str]) -> Dict[str, str]:
+    """
+    Maps every tensor name of a possibly sharded checkpoint to its file. Only headers are read.
+    """
+    tensor_locations = {}
+    for safetensors_file in safetensors_files:
+        with safe_open(safetensors_file, framework='pt') as f_in:
+            for name in f_in.keys():
+                tensor_locations[name] = safetensors_file
+    return tensor_locations
+
+
+def normalize_parameter_name(name: str, layer_name_stem: str) -> Optional[str]:
+    """
+    Returns a layer parameter name from its layer stem on, eg. layers.3.mlp.dense_h_to_4h.weight for
+    gpt_neox.layers.3.mlp.dense_h_to_4h.weight, so checkpoints of models with and without heads line up.
+    Returns None for parameters outside the layers.
+    """
+    name_parts = name.split('.')
+    for index in range(len(name_parts) - 2):
+        if name_parts[index] == layer_name_stem and name_parts[index + 1].isdigit():
+            return '.'.join(name_parts[index:])
+    return None
+
+
+class CheckpointDivergence:
+    """
+    Computes the L2 norm of the difference of each pair of matching layer tensors in a base and an rlhf checkpoint.
+
+    Tensors are compared by num_workers threads at once, each reading rows of both tensors through the memory maps
+    in chunks of about chunk_bytes as float32. bitsandbytes int8 weights are dequantized with their row scales
+    (the .SCB tensor next to the weight), so quantized checkpoints give divergences of the actual weights.
+    int8 tensors without one row scale per row raise an UnsupportedCheckpointError, rather than being compared
+    as their stored values.
+    """
+    quantization_suffixes = ('.SCB', '.weight_format')
+
+    def __init__(
+            self, base_files: List[str], rlhf_files: List[str], layer_name_stem: str,
+            chunk_bytes: int = 64 * 2 ** 20, num_workers: int = 4
+    ):
+        self.layer_name_stem = layer_name_stem
+        self.chunk_bytes = chunk_bytes
+        self.num_workers = max(num_workers, 1)
+
+        self.base_locations = get_tensor_locations(base_files)
+        self.rlhf_locations = get_tensor_locations(rlhf_files)
+        self.base_names = self.get_layer_tensor_names(self.base_locations)
+        self.rlhf_names = self.get_layer_tensor_names(self.rlhf_locations)
+
+        if set(self.base_names) != set(self.rlhf_names):
+            raise ValueError(
+                'Base and rlhf checkpoints should have the same layer tensors! '
+                f'Only in base: {sorted(set(self.base_names) - set(self.rlhf_names))[:5]}, '
+                f'only in rlhf: {sorted(set(self.rlhf_names) - set(self.base_names))[:5]}'
+            )
+
+    def get_layer_tensor_names(self, tensor_locations: Dict[str, str]) -> Dict[str, str]:
+        """
+        Maps the normalized name of every layer tensor of a checkpoint to its name in the checkpoint.
+        """
+        layer_tensor_names = {}
+        for name in tensor_locations:
+            normalized_name = normalize_parameter_name(name, self.layer_name_stem)
+            if normalized_name is not None and not name.endswith(self.quantization_suffixes):
+                layer_tensor_names[normalized_name] = name
+        return layer_tensor_names
+
+    @staticmethod
+    def read_rows(tensor_slice, row_scales, start: int, end: int) -> torch.Tensor:
+        rows = tensor_slice[start:end]
+        if row_scales is not None:
+            return rows.to(torch.float32) * (row_scales[start:end] / 127.0).reshape(-1, *[1] * (rows.dim() - 1))
+        return rows.to(torch.float32)
+
+    def open_tensor(self, stack, tensor_locations: Dict[str, str], name: str):
+        """
+        Returns the open file of a tensor, a memory mapped slice of it, and its int8 row scales (or None).
+        """
+        tensor_file = stack.enter_context(safe_open(tensor_locations[name], framework='pt'))
+        tensor_slice = tensor_file.get_slice(name)
+        scales_name = f'{name[:-len("weight")]}SCB' if name.endswith('weight') else None
+
+        if tensor_slice.get_dtype() != 'I8':
+            return tensor_file, tensor_slice, None
+
+        if scales_name not in tensor_locations:
+            raise UnsupportedCheckpointError(f'{name} is stored as int8, but has no {scales_name} row scales.')
+        scales_file = stack.enter_context(safe_open(tensor_locations[scales_name], framework='pt'))
+        row_scales = scales_file.get_tensor(scales_name).to(torch.float32)
+
+        shape = tensor_slice.get_shape()
+        if not shape or row_scales.numel() != shape[0]:
+            raise UnsupportedCheckpointError(
+                f'{name} is stored as int8 with shape {shape}, but its row scales {scales_name} have shape '
+                f'{list(row_scales.shape)}, not one scale per row.'
+            )
+        return tensor_file, tensor_slice, row_scales.reshape(-1)
+
+    def get_difference_norm(self, normalized_name: str) -> float:
+        """
+        Streams both tensors of a normalized name in chunks of rows, accumulating the squared differences.
+        """
+        base_name, rlhf_name = self.base_names[normalized_name], self.rlhf_names[normalized_name]
+        with ExitStack() as stack:
+            base_file, base_slice, base_scales = self.open_tensor(stack, self.base_locations, base_name)
+            rlhf_file, rlhf_slice, rlhf_scales = self.open_tensor(stack, self.rlhf_locations, rlhf_name)
+            shape = base_slice.get_shape()
+            if shape != rlhf_slice.get_shape():
+                raise ValueError(f'{normalized_name} has shape {shape} in base and {rlhf_slice.get_shape()} in rlhf.')
+            if not shape:
+                # Scalars cannot be sliced by rows, and are read whole.
+                difference = base_file.get_tensor(base_name).to(torch.float32) - rlhf_file.get_tensor(rlhf_name)
+                return abs(difference.item())
+
+            row_bytes = 4 * math.prod(shape[1:])
+            chunk_rows = max(self.chunk_bytes // row_bytes, 1)
+            squared_norm = 0.0
+            for start in range(0, shape[0], chunk_rows):
+                end = min(start + chunk_rows, shape[0])
+                difference = (
+                    self.read_rows(base_slice, base_scales, start, end)
+                    - self.read_rows(rlhf_slice, rlhf_scales, start, end)
+                )
+                squared_norm += torch.sum(difference.to(torch.float64) ** 2).item()
+            return math.sqrt(squared_norm)
+
+    def get_tensor_divergences(self) -> Dict[str, float]:
+        """
+        Returns the difference norm of every layer tensor, computed in parallel across tensors.
+        """
+        names = sorted(self.base_names)
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            return dict(zip(names, executor.map(self.get_difference_norm, names)))
+
+    def get_layer_divergences(self) -> Tuple[Dict[int, Dict[str, float]], Dict[int, float]]:
+        """
+        Sums the tensor divergences per layer and module type (eg. attention, mlp), like
+        LayerActivationsHandler.find_divergences.
+
+        Returns:
+        The divergences per layer and module type, and the total divergence per layer.
+        """
+        layer_divergences = defaultdict(lambda: defaultdict(float))
+        for normalized_name, divergence in self.get_tensor_divergences().items():
+            _, layer_num, layer_type = normalized_name.split('.')[:3]
+            layer_divergences[int(layer_num)][layer_type] += divergence
+
+        layer_divergences = {layer_num: dict(layer_types) for layer_num, layer_types in layer_divergences.items()}
+        layer_total_divergences = {
+            layer_num: sum(layer_types.values()) for layer_num, layer_types in layer_divergences.items()
+        }
+        return layer_divergences, layer_total_divergences
@@ -0,0 +1,92 @@
+"""
+Times the dense and sparse tied-weight decoders of SparseAutoencoder over a range of feature sparsities,
+to find the sparsity above which the sparse decoder is faster (and so the sparse_decode_min_sparsity to use).
+
+Run with eg. python -m reward_analyzer.sparse_codes_training.experiment_helpers.decode_benchmark --input_size 2048
+"""
+import argparse
+import time
+from typing import List
+
+import torch
+
+from reward_analyzer.sparse_codes_training.models.sparse_autoencoder import SparseAutoencoder
+
+
+def time_decode(autoencoder: SparseAutoencoder, features, sparse: bool, backward: bool, num_repeats: int):
+    """
+    Returns the mean milliseconds of one decode (and its backward pass, if backward is set).
+    """
+    def run():
+        if backward:
+            features.grad = None
+            autoencoder.zero_grad()
+            autoencoder.decode(features, sparse=sparse).sum().backward()
+        else:
+            with torch.no_grad():
+                autoencoder.decode(features, sparse=sparse)
+        if features.is_cuda:
+            torch.cuda.synchronize()
+
+    run()
+    start_time = time.perf_counter()
+    for _ in range(num_repeats):
+        run()
+    return (time.perf_counter() - start_time) / num_repeats * 1000
+
+
+def benchmark_decode(
+        input_size: int, hidden_size_multiple: int = 2, batch_size: int = 256,
+        sparsities: List[float] = (0.5, 0.8, 0.9, 0.95, 0.97, 0.98, 0.99, 0.995, 0.999),
+        backward: bool = False, num_repeats: int = 10, device: str = 'cpu', seed: int = 0
+):
+    """
+    Decodes random features with the given fractions of zeros, with both decoders.
+
+    Returns:
+    A list of dictionaries with the sparsity and the dense and sparse milliseconds per decode, and the crossover,
+    the lowest sparsity from which on the sparse decoder was always faster (None if it never was).
+    """
+    generator = torch.Generator().manual_seed(seed)
+    autoencoder = SparseAutoencoder(
+        input_size, hidden_size=input_size * hidden_size_multiple, l1_coef=0.0, tied_weights=True
+    ).to(device)
+
+    results = []
+    for sparsity in sorted(sparsities):
+        features = torch.rand(batch_size, autoencoder.hidden_size, generator=generator)
+        features = features * (torch.rand(batch_size, autoencoder.hidden_size, generator=generator) >= sparsity)
+        features = features.to(device).requires_grad_(backward)
+
+        results.append({
+            'sparsity': sparsity,
+            'dense_ms': time_decode(autoencoder, features, sparse=False, backward=backward, num_repeats=num_repeats),
+            'sparse_ms': time_decode(autoencoder, features, sparse=True, backward=backward, num_repeats=num_repeats)
+        })
+
+    crossover = None
+    for result in reversed(results):
+        if result['sparse_ms'] >= result['dense_ms']:
+            break
+        crossover = result['sparsity']
+    return results, crossover
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the dense and sparse tied-weight decoders.")
+    parser.add_argument("--input_size", default=2048, type=int, help="The activation size, eg. 2048 for gemma-2b.")
+    parser.add_argument("--hidden_size_multiple", default=2, type=int, help="The dictionary size multiple.")
+    parser.add_argument("--batch_size", default=256, type=int, help="The number of activations per decode.")
+    parser.add_argument("--backward", action="store_true", help="Whether to also time the backward pass.")
+    parser.add_argument("--num_repeats", default=10, type=int, help="The number of timed decodes per setting.")
+    parser.add_argument("--device", default='cpu', type=str, help="The device to benchmark on.")
+    args = parser.parse_args()
+
+    results, crossover = benchmark_decode(
+        input_size=args.input_size, hidden_size_multiple=args.hidden_size_multiple, batch_size=args.batch_size,
+        backward=args.backward, num_repeats=args.num_repeats, device=args.device
+    )
+    for result in results:
+        print(f"Sparsity {result['sparsity']:.3f}: dense {result['dense_ms']:.2f} ms, sparse {result['sparse_ms']:.2f} ms")
+    print(f"Sparse decoding is faster from sparsity {crossover} on." if crossover is not None
+          else "Sparse decoding was never faster.")
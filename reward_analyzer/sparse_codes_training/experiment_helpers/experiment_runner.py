@@ -1,7 +1,7 @@
 """
 This class runs the actual experiments
 """
-import random
+from datetime import datetime
 
 import wandb
 
@@ -10,13 +10,22 @@ from transformers import AutoModel
 from transformers import AutoTokenizer
 
 from reward_analyzer.sparse_codes_training.experiment_configs import ExperimentConfig
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_cache import ActivationCache
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_storage import get_storage_format_report
 from reward_analyzer.configs.task_configs import TaskConfig
 from reward_analyzer.sparse_codes_training.experiment_helpers.autoencoder_trainer_and_preparer import AutoencoderDataPreparerAndTrainer
+from reward_analyzer.sparse_codes_training.experiment_helpers.checkpoint_divergence import UnsupportedCheckpointError
 from reward_analyzer.sparse_codes_training.experiment_helpers.layer_activations_handler import LayerActivationsHandler
-from reward_analyzer.sparse_codes_training.metrics.mmcs import compare_autoencoders
+from reward_analyzer.sparse_codes_training.experiment_helpers.text_dataset_view import TextDatasetView
+from reward_analyzer.sparse_codes_training.experiment_helpers.tokenized_dataset import TokenizedDataset
+from reward_analyzer.sparse_codes_training.experiment_helpers.training_checkpointer import (
+    TrainingCheckpointer, autoencoder_from_checkpoint, autoencoder_to_checkpoint
+)
+from reward_analyzer.sparse_codes_training.metrics.mmcs import compare_autoencoder_pairs
 
-from reward_analyzer.utils.gpu_utils import  find_gpu_with_most_memory
-from reward_analyzer.utils.model_storage_utils import save_autoencoders_for_artifact, load_latest_model_from_hub
+from reward_analyzer.utils.gpu_utils import DevicePlanner
+from reward_analyzer.utils.metrics_sink import MetricsSink, log_metrics, set_metrics_sink
+from reward_analyzer.utils.model_storage_utils import save_autoencoders_for_artifact, download_latest_model_from_hub
 
 class ExperimentRunner:
     """
@@ -60,22 +69,41 @@ class ExperimentRunner:
         # Autoencoders of smaller hidden size for policy model
         self.autoencoders_rlhf_small = {}
 
+        # Activations are shared on disk across epochs, hidden size multiples and reruns.
+        activation_cache_dir = self.hyperparameters.get('activation_cache_dir')
+        self.activation_cache = ActivationCache(
+            cache_dir=activation_cache_dir, max_size_gb=self.hyperparameters.get('activation_cache_max_gb', 100.0)
+        ) if activation_cache_dir else None
+
+        # Checkpoints are keyed by the config and dataset, so relaunching the same run resumes it.
+        checkpoint_dir = self.hyperparameters.get('checkpoint_dir')
+        self.checkpointer = TrainingCheckpointer(
+            checkpoint_dir=checkpoint_dir,
+            run_config={
+                'hyperparameters': self.hyperparameters, 'task_config': self.task_config.name,
+                'dataset_hash': self.tokenized_dataset.dataset_hash
+            },
+            checkpoint_every_steps=self.hyperparameters.get('checkpoint_every_steps', 500)
+        ) if checkpoint_dir else None
+
         self.ae_extractor_base = AutoencoderDataPreparerAndTrainer(
             model=self.m_base, tokenizer=self.tokenizer, hyperparameters=self.hyperparameters,
-            autoencoder_device=self.autoencoder_device
+            autoencoder_device=self.autoencoder_device, activation_cache=self.activation_cache,
+            checkpointer=self.checkpointer
         )
 
         self.ae_extractor_rlhf = AutoencoderDataPreparerAndTrainer(
             model=self.m_rlhf, tokenizer=self.tokenizer, hyperparameters=self.hyperparameters,
-            autoencoder_device=self.autoencoder_device
+            autoencoder_device=self.autoencoder_device, activation_cache=self.activation_cache,
+            checkpointer=self.checkpointer
         )
 
     def initialize_run_and_hyperparameters(self, experiment_config: ExperimentConfig):
         """
-        This initializes the wandb run, the hyperparameters, model names and datasets.
+        This initializes the wandb run, the metrics sink, the hyperparameters, model names and datasets.
+        Without 'wandb' among hyperparameters['metrics_backends'], the wandb run is disabled and
+        no login or network access is needed.
         """
-        wandb.login()
-
         self.hyperparameters = self.experiment_config.hyperparameters
         self.base_model_name = experiment_config.base_model_name
         self.policy_model_name = experiment_config.policy_model_name
@@ -86,11 +114,23 @@ class ExperimentRunner:
             {'base_model_name': self.base_model_name, 'policy_model_name': self.policy_model_name}
         )
 
-        self.run = wandb.init(project=self.wandb_project_name, config=self.hyperparameters)
+        metrics_backends = self.hyperparameters.get('metrics_backends') or ['jsonl', 'wandb']
+        if 'wandb' in metrics_backends:
+            wandb.login()
+            self.run = wandb.init(project=self.wandb_project_name, config=self.hyperparameters)
+        else:
+            self.run = wandb.init(project=self.wandb_project_name, config=self.hyperparameters, mode='disabled')
+
+        self.metrics_sink = MetricsSink.from_backend_names(
+            metrics_backends, metrics_dir=self.hyperparameters.get('metrics_dir', 'metrics'),
+            run_name=f'{self.wandb_project_name}_{datetime.now().strftime("%Y-%m-%d_%H:%M:%S")}'
+        )
+        set_metrics_sink(self.metrics_sink)
 
         self.is_fast = self.hyperparameters['fast']
         self.input_device = self.experiment_config.device
-        self.model_device = self.input_device if self.input_device else find_gpu_with_most_memory()
+        self.device_planner = DevicePlanner(device=self.input_device)
+        self.model_device = self.device_planner.get_device('model')
 
         self.num_layers_to_keep = self.hyperparameters['num_layers_to_keep']
         self.hidden_size_multiples = sorted(self.hyperparameters['hidden_size_multiples'].copy())
@@ -107,17 +147,25 @@ class ExperimentRunner:
             raise Exception(f'Unsupported model type {self.base_model_name}')
 
     def initialize_models(
-        self, base_model_name: str, task_config: TaskConfig, model_device: str = find_gpu_with_most_memory()
+        self, base_model_name: str, task_config: TaskConfig, model_device: str = None
     ):
         """
         Initialize base and policy models.
+        Models are loaded in 8 bit on GPUs, and in full precision on the CPU.
         """
         task_name = task_config.name
-        m_base = AutoModel.from_pretrained(base_model_name, load_in_8bit=True)
-        m_rlhf = load_latest_model_from_hub(model_name=base_model_name, task_config=task_config)
+        model_device = model_device or self.device_planner.get_device('model')
+        load_in_8bit = model_device.startswith('cuda')
+
+        m_base = AutoModel.from_pretrained(base_model_name, load_in_8bit=load_in_8bit)
+        # Keep the checkpoint directory, to stream divergences from its weights rather than the quantized model.
+        self.rlhf_model_dir = download_latest_model_from_hub(model_name=base_model_name, task_config=task_config)
+        m_rlhf = AutoModel.from_pretrained(self.rlhf_model_dir, load_in_8bit=load_in_8bit)
+        if not load_in_8bit:
+            m_base, m_rlhf = m_base.to(model_device), m_rlhf.to(model_device)
 
         # We may need to train autoencoders on different device after loading models.
-        autoencoder_device = self.input_device if self.input_device else find_gpu_with_most_memory()
+        autoencoder_device = self.device_planner.get_device('autoencoder')
 
         tokenizer = AutoTokenizer.from_pretrained(base_model_name)
         tokenizer.pad_token = tokenizer.eos_token
@@ -132,37 +180,42 @@ class ExperimentRunner:
         print('Processing texts')
 
 
+        # Texts stay in the memory-mapped Arrow dataset, and are only read when batches are formed.
         if self.task_config == TaskConfig.IMDB:
             print(f'Loading imdb dataset for {self.task_config.name}')
             self.dataset_name = 'imdb'
-            self.test_dataset_base = load_dataset(self.dataset_name, split=self.split)
-            self.test_dataset_base = [x['text'] for x in self.test_dataset_base]
+            dataset = load_dataset(self.dataset_name, split=self.split)
+            self.test_dataset_base = TextDatasetView(dataset, columns=['text'])
 
         elif self.task_config in [TaskConfig.HH_RLHF, TaskConfig.UNALIGNED]:
             print(f'Loading anthropic dataset for {self.task_config.name}')
             self.dataset_name = 'anthropic/hh-rlhf'
 
-            self.test_dataset_base = load_dataset(self.dataset_name, split=self.split)
-            result_dataset = []
-            for item in self.test_dataset_base:
-                result_dataset.extend([item['chosen'], item['rejected']])
-
-            random.seed(self.seed)
-
-            result_dataset = random.sample(result_dataset, k=75000)
-            self.test_dataset_base = result_dataset
+            # Sample 75000 of the chosen and rejected texts, by index.
+            dataset = load_dataset(self.dataset_name, split=self.split)
+            self.test_dataset_base = TextDatasetView.sample(
+                dataset, columns=['chosen', 'rejected'], k=75000, seed=self.seed
+            )
 
         else:
             raise Exception(f'Parsing dataset {self.dataset_name} is not supported')
 
         if self.is_fast:
             self.hyperparameters['batch_size'] = 4
-            self.test_dataset_base = self.test_dataset_base[:12]
+            self.test_dataset_base = self.test_dataset_base.select(range(12))
 
-        self.test_dataset_rlhf = self.test_dataset_base.copy()
+        # The view is immutable, so base and rlhf models share it.
+        self.test_dataset_rlhf = self.test_dataset_base
         self.num_examples = len(self.test_dataset_base)
         print(f'Working with {self.num_examples} texts.')
 
+        # Tokenize once. Base and rlhf models share a tokenizer and texts, so they share the token ids too.
+        self.tokenized_dataset = TokenizedDataset.load_or_build(
+            input_texts=self.test_dataset_base, tokenizer=self.tokenizer,
+            max_input_length=self.hyperparameters['max_input_length'],
+            cache_dir=self.hyperparameters.get('tokenized_dataset_dir')
+        )
+
         wandb.run.config['seed'] = self.seed
         wandb.run.config['num_examples'] = self.num_examples
         self.hyperparameters['num_examples'] = self.num_examples
@@ -172,8 +225,25 @@ class ExperimentRunner:
         """
         Finds most divergence layers between base_model and rlhf_model
         """
-        sorted_layers, divergences_by_layer = self.activations_handler.find_divergences(
-            other_model=self.m_rlhf, hyperparameters=self.hyperparameters)
+        if self.checkpointer is not None and self.checkpointer.is_stage_done('divergences'):
+            sorted_layers, divergences_by_layer = self.checkpointer.load_stage_results('divergences')
+        else:
+            sorted_layers = None
+            if self.hyperparameters.get('streaming_divergence', False):
+                try:
+                    sorted_layers, divergences_by_layer = self.activations_handler.find_divergences_from_checkpoints(
+                        base_model_path=self.base_model_name, rlhf_model_path=self.rlhf_model_dir,
+                        hyperparameters=self.hyperparameters
+                    )
+                except (FileNotFoundError, UnsupportedCheckpointError) as error:
+                    # Eg. models uploaded as pytorch_model.bin, before safetensors became the default,
+                    # or quantized in a format that cannot be dequantized from the checkpoint.
+                    print(f'{error} Computing divergences from the loaded models instead.')
+            if sorted_layers is None:
+                sorted_layers, divergences_by_layer = self.activations_handler.find_divergences(
+                    other_model=self.m_rlhf, hyperparameters=self.hyperparameters)
+            if self.checkpointer is not None:
+                self.checkpointer.mark_stage_done('divergences', results=(sorted_layers, divergences_by_layer))
         wandb.config['sorted_layers'] = sorted_layers
 
         sorted_layers = sorted_layers[:num_layers_to_keep]
@@ -184,33 +254,197 @@ class ExperimentRunner:
     ):
         """
         Extracts autoencoders for a given layer index from base and rlhf model.
+        Each trained pair is checkpointed as a stage, and restored instead of retrained when resuming.
         """
+        stage = f'layer_{layer_index}_multiple_{hidden_size_multiple}'
+        if self.checkpointer is not None and self.checkpointer.is_stage_done(stage):
+            print(f'Restoring autoencoders of layer {layer_index} with hidden size multiple {hidden_size_multiple}')
+            for model_label, checkpoints in self.checkpointer.load_stage_results(stage).items():
+                self.get_target_autoencoders(model_label, hidden_size_multiple)[str(layer_index)] = [
+                    self.restore_autoencoder(checkpoint) for checkpoint in checkpoints
+                ]
+            return
 
         print(f'Training base model autoencoder')
         autoencoder_base = self.ae_extractor_base.train_autoencoder_on_text_activations(
             layer_name=f'{self.layer_name_stem}.{layer_index}.mlp',
             input_texts=self.test_dataset_base, hidden_size_multiple=hidden_size_multiple,
-            label=f'base_{label}'
+            label=f'base_{label}', tokenized_dataset=self.tokenized_dataset
         )
 
         print(f'Training rlhf model autoencoder')
         autoencoder_rlhf = self.ae_extractor_rlhf.train_autoencoder_on_text_activations(
             layer_name=f'{self.layer_name_stem}.{layer_index}.mlp',
             input_texts=self.test_dataset_rlhf, hidden_size_multiple=hidden_size_multiple,
-            label=f'rlhf_{label}'
+            label=f'rlhf_{label}', tokenized_dataset=self.tokenized_dataset
         )
 
-        target_autoencoders_base = (
-            self.autoencoders_base_big if hidden_size_multiple > self.small_hidden_size_multiple
-            else self.autoencoders_base_small
+        self.get_target_autoencoders('base', hidden_size_multiple)[str(layer_index)] = autoencoder_base
+        self.get_target_autoencoders('rlhf', hidden_size_multiple)[str(layer_index)] = autoencoder_rlhf
+
+        if self.checkpointer is not None:
+            self.checkpointer.mark_stage_done(stage, results={
+                'base': [autoencoder_to_checkpoint(autoencoder) for autoencoder in autoencoder_base],
+                'rlhf': [autoencoder_to_checkpoint(autoencoder) for autoencoder in autoencoder_rlhf]
+            })
+
+    def restore_autoencoder(self, checkpoint: dict):
+        return autoencoder_from_checkpoint(
+            checkpoint, device=self.autoencoder_device,
+            sparse_decode_min_sparsity=self.hyperparameters.get('sparse_decode_min_sparsity')
         )
-        target_autoencoders_base[str(layer_index)] = autoencoder_base
 
-        target_autoencoders_rlhf = (
-            self.autoencoders_rlhf_big if hidden_size_multiple > self.small_hidden_size_multiple
-            else self.autoencoders_rlhf_small
+    def checkpoint_trained_autoencoders(self):
+        """
+        Records that all autoencoders are trained, with their weights, so a relaunch goes straight to comparing them.
+        """
+        self.checkpointer.mark_stage_done('autoencoders', results={
+            holder_name: {
+                layer_index: [autoencoder_to_checkpoint(autoencoder) for autoencoder in autoencoders]
+                for layer_index, autoencoders in holder.items()
+            } for holder_name, holder in self.get_autoencoder_holders().items()
+        })
+
+    def restore_trained_autoencoders(self):
+        print('Restoring all trained autoencoders from checkpoint')
+        holders = self.get_autoencoder_holders()
+        for holder_name, checkpoints_by_layer in self.checkpointer.load_stage_results('autoencoders').items():
+            for layer_index, checkpoints in checkpoints_by_layer.items():
+                holders[holder_name][layer_index] = [self.restore_autoencoder(checkpoint) for checkpoint in checkpoints]
+
+    def get_autoencoder_holders(self):
+        return {
+            'base_big': self.autoencoders_base_big, 'base_small': self.autoencoders_base_small,
+            'rlhf_big': self.autoencoders_rlhf_big, 'rlhf_small': self.autoencoders_rlhf_small
+        }
+
+    def get_target_autoencoders(self, model_label: str, hidden_size_multiple: int):
+        """
+        Returns the holder of trained autoencoders for a model ('base' or 'rlhf') and hidden size multiple.
+        """
+        is_big = hidden_size_multiple > self.small_hidden_size_multiple
+        if model_label == 'base':
+            return self.autoencoders_base_big if is_big else self.autoencoders_base_small
+        return self.autoencoders_rlhf_big if is_big else self.autoencoders_rlhf_small
+
+    def extract_autoencoders_for_base_and_rlhf_at_all_layers(self):
+        """
+        Extracts autoencoders for all sorted layers and hidden size multiples, with a single
+        forward pass per batch of each of the base and rlhf models.
+        """
+        layer_names = {f'{self.layer_name_stem}.{layer_index}.mlp': layer_index for layer_index in self.sorted_layers}
+        multiple_labels = {
+            hidden_size_multiple: 'big' if hidden_size_multiple > self.small_hidden_size_multiple else 'small'
+            for hidden_size_multiple in self.hidden_size_multiples
+        }
+
+        for model_label, ae_extractor, input_texts in [
+            ('base', self.ae_extractor_base, self.test_dataset_base),
+            ('rlhf', self.ae_extractor_rlhf, self.test_dataset_rlhf)
+        ]:
+            print(f'Training {model_label} model autoencoders for layers {list(layer_names)}')
+            trained_autoencoders = ae_extractor.train_autoencoders_on_multi_layer_text_activations(
+                layer_names=list(layer_names), input_texts=input_texts,
+                hidden_size_multiples=multiple_labels, label=model_label, tokenized_dataset=self.tokenized_dataset
+            )
+            for (layer_name, hidden_size_multiple), autoencoder in trained_autoencoders.items():
+                layer_index = layer_names[layer_name]
+                self.get_target_autoencoders(model_label, hidden_size_multiple)[str(layer_index)] = autoencoder
+
+    def report_activation_storage_formats(self):
+        """
+        For each sorted layer, measures on a batch of base model activations how much each storage format
+        perturbs the activations, and the reconstruction loss of the trained base autoencoders.
+        """
+        layer_names = {f'{self.layer_name_stem}.{layer_index}.mlp': layer_index for layer_index in self.sorted_layers}
+        first_texts = self.test_dataset_base[:self.hyperparameters['batch_size']]
+        activations = self.activations_handler.get_multi_layer_activations(
+            layer_names=list(layer_names), input_texts=first_texts, tokenizer=self.tokenizer,
+            device=self.model_device, hyperparameters=self.hyperparameters
+        )
+
+        storage_format_reports = {}
+        for layer_name, layer_index in layer_names.items():
+            autoencoders = [
+                self.get_target_autoencoders('base', hidden_size_multiple)[str(layer_index)][0]
+                for hidden_size_multiple in self.hidden_size_multiples
+            ]
+            layer_activations = activations[layer_name]
+            layer_activations = layer_activations.reshape(-1, layer_activations.size(-1))
+            storage_format_reports[layer_name] = get_storage_format_report(layer_activations, autoencoders)
+
+        return storage_format_reports
+
+    def extract_paired_autoencoders_for_base_and_rlhf_at_all_layers(self):
+        """
+        Extracts autoencoders for all sorted layers and hidden size multiples of both models at once.
+        Each batch is tokenized once, and the same input ids are run through the base and rlhf models.
+        """
+        layer_names = {f'{self.layer_name_stem}.{layer_index}.mlp': layer_index for layer_index in self.sorted_layers}
+        multiple_labels = {
+            hidden_size_multiple: 'big' if hidden_size_multiple > self.small_hidden_size_multiple else 'small'
+            for hidden_size_multiple in self.hidden_size_multiples
+        }
+
+        print(f'Training paired base and rlhf model autoencoders for layers {list(layer_names)}')
+        trained_autoencoders = self.ae_extractor_base.train_paired_autoencoders_on_multi_layer_text_activations(
+            other=self.ae_extractor_rlhf, layer_names=list(layer_names), input_texts=self.test_dataset_base,
+            hidden_size_multiples=multiple_labels, tokenized_dataset=self.tokenized_dataset
         )
-        target_autoencoders_rlhf[str(layer_index)] = autoencoder_rlhf
+        for model_label, model_autoencoders in trained_autoencoders.items():
+            for (layer_name, hidden_size_multiple), autoencoder in model_autoencoders.items():
+                layer_index = layer_names[layer_name]
+                self.get_target_autoencoders(model_label, hidden_size_multiple)[str(layer_index)] = autoencoder
+
+    def train_autoencoder_sweeps(self):
+        """
+        For both models, trains autoencoders at every sorted layer for each of hyperparameters['sweep_l1_coefs']
+        and hidden size multiple, stacked so that the whole sweep needs one extraction per model.
+
+        Returns:
+        For each model and l1_coef, the MMCS between the smallest and largest hidden size multiples.
+        """
+        layer_names = {f'{self.layer_name_stem}.{layer_index}.mlp': layer_index for layer_index in self.sorted_layers}
+        sweep_l1_coefs = self.hyperparameters['sweep_l1_coefs']
+        sweep_settings = [
+            (hidden_size_multiple, l1_coef)
+            for l1_coef in sweep_l1_coefs for hidden_size_multiple in self.hidden_size_multiples
+        ]
+        big_hidden_size_multiple = self.hidden_size_multiples[-1]
+
+        sweep_comparisons = {}
+        for model_label, ae_extractor, input_texts in [
+            ('base', self.ae_extractor_base, self.test_dataset_base),
+            ('rlhf', self.ae_extractor_rlhf, self.test_dataset_rlhf)
+        ]:
+            print(f'Training {model_label} model autoencoder sweep over l1_coefs {sweep_l1_coefs}')
+            trained_autoencoders = ae_extractor.train_autoencoder_sweep_on_multi_layer_text_activations(
+                layer_names=list(layer_names), input_texts=input_texts, sweep_settings=sweep_settings,
+                label=model_label, tokenized_dataset=self.tokenized_dataset
+            )
+            for l1_coef in sweep_l1_coefs:
+                small_dict = {
+                    str(layer_index): trained_autoencoders[(layer_name, self.small_hidden_size_multiple, l1_coef)]
+                    for layer_name, layer_index in layer_names.items()
+                }
+                big_dict = {
+                    str(layer_index): trained_autoencoders[(layer_name, big_hidden_size_multiple, l1_coef)]
+                    for layer_name, layer_index in layer_names.items()
+                }
+                sweep_comparisons[f'{model_label}_l1_{l1_coef}'] = (small_dict, big_dict)
+
+        # Compare the whole sweep at once, so its layers are matched in parallel.
+        sweep_mmcs_results, _ = compare_autoencoder_pairs(sweep_comparisons, **self.get_mmcs_kwargs())
+        return sweep_mmcs_results
+
+    def get_mmcs_kwargs(self):
+        return {
+            'method': self.hyperparameters.get('mmcs_method', 'hungarian'),
+            'tile_size': self.hyperparameters.get('mmcs_tile_size', 4096),
+            'candidates_k': self.hyperparameters.get('mmcs_candidates_k', 10),
+            'exact_max_size': self.hyperparameters.get('mmcs_exact_max_size', 4096 * 8192),
+            'num_workers': self.hyperparameters.get('mmcs_num_workers', 1)
+        }
 
     def run_experiment(self):
         """
@@ -223,34 +457,50 @@ class ExperimentRunner:
             num_layers_to_keep=self.num_layers_to_keep
         )
 
-        # Create autoencoder pairs for each layer
-        for number, layer_index in enumerate(self.sorted_layers):
-            print(f'Training autoencoder pair # {number}')
+        if self.checkpointer is not None and self.checkpointer.is_stage_done('autoencoders'):
+            self.restore_trained_autoencoders()
 
-            # For each pair, set the hidden size to be a different multiple of the input size
-            for hidden_size_multiple in self.hidden_size_multiples:
-                label = 'big' if hidden_size_multiple > self.small_hidden_size_multiple else 'small'
+        elif self.hyperparameters.get('paired_extraction', False):
+            # Run the base and rlhf models on the same token ids, and train all their autoencoders together.
+            self.extract_paired_autoencoders_for_base_and_rlhf_at_all_layers()
 
-                self.extract_autoencoder_for_base_and_rlhf_at_layer_index(
-                    hidden_size_multiple=hidden_size_multiple, layer_index=layer_index, label=label
-                )
+        elif self.hyperparameters.get('single_pass_extraction', False):
+            # Hook all layers at once, and train every autoencoder of a model from the same forward passes.
+            self.extract_autoencoders_for_base_and_rlhf_at_all_layers()
 
-        # Compare overlaps between large and small autoencoder feature dictionaries.
-        base_mmcs_results = compare_autoencoders(
-            small_dict=self.autoencoders_base_small, big_dict=self.autoencoders_base_big
-        )
-        rlhf_mmcs_results = compare_autoencoders(
-            small_dict=self.autoencoders_rlhf_small, big_dict=self.autoencoders_rlhf_big
-        )
+        else:
+            # Create autoencoder pairs for each layer
+            for number, layer_index in enumerate(self.sorted_layers):
+                print(f'Training autoencoder pair # {number}')
+
+                # For each pair, set the hidden size to be a different multiple of the input size
+                for hidden_size_multiple in self.hidden_size_multiples:
+                    label = 'big' if hidden_size_multiple > self.small_hidden_size_multiple else 'small'
+
+                    self.extract_autoencoder_for_base_and_rlhf_at_layer_index(
+                        hidden_size_multiple=hidden_size_multiple, layer_index=layer_index, label=label
+                    )
+
+        if self.checkpointer is not None and not self.checkpointer.is_stage_done('autoencoders'):
+            self.checkpoint_trained_autoencoders()
+
+        # Compare overlaps between large and small autoencoder feature dictionaries, all layers of both models at once.
+        mmcs_results, match_tables = compare_autoencoder_pairs({
+            'base_mmcs_results': (self.autoencoders_base_small, self.autoencoders_base_big),
+            'rlhf_mmcs_results': (self.autoencoders_rlhf_small, self.autoencoders_rlhf_big)
+        }, **self.get_mmcs_kwargs())
 
         added_metadata = {}
 
-        mmcs_results = {"base_mmcs_results": base_mmcs_results, "rlhf_mmcs_results": rlhf_mmcs_results}
         divergences_by_layer = {'divergences_by_layer': self.divergences_by_layer}
 
         added_metadata.update(mmcs_results)
         added_metadata.update(divergences_by_layer)
-        wandb.log(added_metadata)
+        if self.hyperparameters.get('report_storage_formats'):
+            added_metadata['activation_storage_formats'] = self.report_activation_storage_formats()
+        if self.hyperparameters.get('sweep_l1_coefs'):
+            added_metadata['sweep_mmcs_results'] = self.train_autoencoder_sweeps()
+        log_metrics(added_metadata)
 
         print('saving to wandb')
         # Finally, log to wandb.
@@ -258,6 +508,13 @@ class ExperimentRunner:
             autoencoders_base_big=self.autoencoders_base_big, autoencoders_base_small=self.autoencoders_base_small,
             autoencoders_rlhf_big=self.autoencoders_rlhf_big, autoencoders_rlhf_small=self.autoencoders_rlhf_small,
             policy_model_name=self.policy_model_name, hyperparameters=self.hyperparameters,
-            alias='latest', run=self.run, added_metadata=added_metadata
+            alias='latest', run=self.run, added_metadata=added_metadata,
+            match_tables={
+                label.replace('_mmcs_results', ''): match_table for label, match_table in match_tables.items()
+            }
         )
+        if self.checkpointer is not None:
+            # The artifact holds everything now, so a relaunch starts a new run.
+            self.checkpointer.clear()
+        self.metrics_sink.close()
         wandb.finish()
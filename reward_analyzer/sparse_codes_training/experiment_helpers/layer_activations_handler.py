@@ -6,7 +6,16 @@ namely extracting activations and finding divergences between layers.
 from collections import defaultdict
 
 import torch
-import wandb
+
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_cache import ActivationCache, hash_texts
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_storage import get_storage_format
+from reward_analyzer.sparse_codes_training.experiment_helpers.checkpoint_divergence import (
+    CheckpointDivergence, find_safetensors_files
+)
+from reward_analyzer.sparse_codes_training.experiment_helpers.tokenized_dataset import TokenizedDataset
+from reward_analyzer.utils.hook_manager import HookManager
+from reward_analyzer.utils.metrics_sink import log_metrics
+from reward_analyzer.utils.transformer_utils import batch, token_budget_batches
 
 class LayerActivationsHandler:
     """
@@ -15,6 +24,7 @@ class LayerActivationsHandler:
     """
     def __init__(self, model):
         self.model = model
+        self.hook_manager = HookManager(model)
         model_name = self.model.config.name_or_path
 
         if 'pythia' in model_name:
@@ -54,22 +64,47 @@ class LayerActivationsHandler:
                 layer_num: sum(layer_type.values()) for layer_num, layer_type in layer_divergences.items()
             }
 
-            wandb.log({'layer_divergences': layer_total_divergences})
+            log_metrics({'layer_divergences': layer_total_divergences})
 
-            if divergence_choice == 'highest_divergence':
-                # Sort by divergence value.
-                sorted_layer_divergences = sorted(layer_total_divergences.items(), key=lambda x: x[1], reverse=True)
-                sorted_layer_numbers = [item[0] for item in sorted_layer_divergences]
+            sorted_layer_numbers = self.sort_layers_by_divergence(layer_total_divergences, divergence_choice)
+            return sorted_layer_numbers, layer_total_divergences
 
-            elif divergence_choice == 'lowest_layers':
-                # Sort (in ascending order) by layer number.
-                sorted_layer_divergences = sorted(layer_total_divergences.items(), key=lambda x: x[0], reverse=False)
-                sorted_layer_numbers = [item[0] for item in sorted_layer_divergences]
+    def find_divergences_from_checkpoints(self, base_model_path: str, rlhf_model_path: str, hyperparameters):
+        """
+        Like find_divergences, but streams the weights from the safetensors checkpoints of the models
+        (local directories or hub names), so neither model needs to be in memory, nor dequantized.
+        """
+        checkpoint_divergence = CheckpointDivergence(
+            base_files=find_safetensors_files(base_model_path), rlhf_files=find_safetensors_files(rlhf_model_path),
+            layer_name_stem=self.layer_name_stem,
+            chunk_bytes=hyperparameters.get('divergence_chunk_bytes', 64 * 2 ** 20),
+            num_workers=hyperparameters.get('divergence_num_workers', 4)
+        )
+        layer_divergences, layer_total_divergences = checkpoint_divergence.get_layer_divergences()
 
-            else:
-                raise ValueError(f'Divergence choice {divergence_choice} not supported!')
+        log_metrics({'layer_divergences': layer_total_divergences, 'layer_module_divergences': layer_divergences})
 
-            return sorted_layer_numbers, layer_total_divergences
+        sorted_layer_numbers = self.sort_layers_by_divergence(
+            layer_total_divergences, hyperparameters['divergence_choice']
+        )
+        return sorted_layer_numbers, layer_total_divergences
+
+    @staticmethod
+    def sort_layers_by_divergence(layer_total_divergences, divergence_choice):
+        if divergence_choice == 'highest_divergence':
+            # Sort by divergence value.
+            sorted_layer_divergences = sorted(layer_total_divergences.items(), key=lambda x: x[1], reverse=True)
+            sorted_layer_numbers = [item[0] for item in sorted_layer_divergences]
+
+        elif divergence_choice == 'lowest_layers':
+            # Sort (in ascending order) by layer number.
+            sorted_layer_divergences = sorted(layer_total_divergences.items(), key=lambda x: x[0], reverse=False)
+            sorted_layer_numbers = [item[0] for item in sorted_layer_divergences]
+
+        else:
+            raise ValueError(f'Divergence choice {divergence_choice} not supported!')
+
+        return sorted_layer_numbers
 
 
     def get_layer_activations(self, layer_name, input_texts, tokenizer, device, hyperparameters, with_adapter=False):
@@ -86,24 +121,325 @@ class LayerActivationsHandler:
         Returns:
         The activations of the specified layer.
         """
-        activations = None
+        return self.get_multi_layer_activations(
+            layer_names=[layer_name], input_texts=input_texts, tokenizer=tokenizer,
+            device=device, hyperparameters=hyperparameters
+        )[layer_name]
 
+    @staticmethod
+    def get_sequence_offsets(attention_mask):
+        """
+        Returns the offsets of each sequence's tokens in a packed [n_tokens, d] activations matrix,
+        so that the tokens of sequence i are rows sequence_offsets[i]:sequence_offsets[i + 1].
+        """
+        lengths = attention_mask.sum(dim=1).to(dtype=torch.long)
+        sequence_offsets = torch.zeros(len(lengths) + 1, dtype=torch.long, device=lengths.device)
+        sequence_offsets[1:] = torch.cumsum(lengths, dim=0)
+        return sequence_offsets
+
+    def get_multi_layer_activations(
+            self, layer_names, input_texts, tokenizer, device, hyperparameters, return_offsets=False
+    ):
+        """
+        Gets the activations of several layers from a single forward pass over the input data.
+
+        If hyperparameters['pack_tokens'] is set, padding positions are dropped using the attention mask,
+        and each layer's activations are a packed [n_tokens, d] matrix instead of [batch, seq, d].
+        If hyperparameters['early_exit'] is set, the forward pass stops after the deepest hooked layer.
+
+        Returns:
+        A dictionary mapping each layer name to its activations, and if return_offsets is set,
+        the per-sequence offsets into the packed activations.
+        """
         max_length = hyperparameters['max_input_length']
         inputs = tokenizer(input_texts, return_tensors='pt', padding=True, truncation=True, max_length=max_length)
-        input_ids = inputs['input_ids'].to(device)
-        attention_mask = inputs['attention_mask']
 
-        def hook_fn(module, input, output):
-            nonlocal activations
-            activations = output
+        return self.get_multi_layer_activations_from_ids(
+            layer_names=layer_names, input_ids=inputs['input_ids'], attention_mask=inputs['attention_mask'],
+            device=device, hyperparameters=hyperparameters, return_offsets=return_offsets
+        )
 
-        layer = dict(self.model.named_modules())[layer_name]
-        hook = layer.register_forward_hook(hook_fn)
+    def get_multi_layer_activations_from_ids(
+            self, layer_names, input_ids, attention_mask, device, hyperparameters, return_offsets=False
+    ):
+        """
+        Gets the activations of several layers from a single forward pass over already tokenized input ids.
+        See get_multi_layer_activations.
+        """
+        input_ids = input_ids.to(device)
 
         if attention_mask is not None:
             attention_mask = attention_mask.to(device)
 
-        with torch.no_grad():
-            self.model(input_ids, attention_mask=attention_mask)
+        token_mask = None
+        if hyperparameters.get('pack_tokens', False) and attention_mask is not None:
+            token_mask = attention_mask.bool()
+
+        # Reuses the capture hooks of an enclosing capture_layers context, if there is one.
+        with self.hook_manager.capture_layers(layer_names, early_exit=hyperparameters.get('early_exit', False)):
+            outputs = self.hook_manager.run_forward(input_ids, attention_mask=attention_mask)
+
+        activations = {
+            layer_name: outputs[layer_name][token_mask] if token_mask is not None else outputs[layer_name]
+            for layer_name in layer_names
+        }
+
+        if return_offsets:
+            sequence_offsets = self.get_sequence_offsets(token_mask) if token_mask is not None else None
+            return activations, sequence_offsets
 
         return activations
+
+    @staticmethod
+    def get_index_batches(input_texts, tokenizer, hyperparameters, tokenized_dataset: TokenizedDataset = None):
+        """
+        Splits the indices of the input texts into batches. By default these are fixed size batches in dataset order.
+        If hyperparameters['max_batch_tokens'] is set, texts are bucketed by tokenized length into batches
+        whose padded size fits the token budget, and batches are shuffled with a fixed seed.
+        """
+        max_batch_tokens = hyperparameters.get('max_batch_tokens')
+        if not max_batch_tokens:
+            return [list(index_batch) for index_batch in batch(range(len(input_texts)), hyperparameters['batch_size'])]
+
+        if tokenized_dataset is not None:
+            lengths = tokenized_dataset.lengths.tolist()
+        else:
+            lengths = []
+            for text_chunk in batch(input_texts, 10000):
+                tokenized = tokenizer(text_chunk, truncation=True, max_length=hyperparameters['max_input_length'])
+                lengths.extend(len(input_ids) for input_ids in tokenized['input_ids'])
+        return token_budget_batches(lengths, max_tokens=max_batch_tokens, shuffle_seed=0)
+
+    def iterate_layer_activations(
+            self, layer_name, input_texts, tokenizer, device, hyperparameters, activation_cache: ActivationCache = None,
+            tokenized_dataset: TokenizedDataset = None, start_batch: int = 0
+    ):
+        """
+        Yields the activations of a layer for each batch of input texts, from batch start_batch on.
+        """
+        for activations in self.iterate_multi_layer_activations(
+            layer_names=[layer_name], input_texts=input_texts, tokenizer=tokenizer,
+            device=device, hyperparameters=hyperparameters, activation_cache=activation_cache,
+            tokenized_dataset=tokenized_dataset, start_batch=start_batch
+        ):
+            yield activations[layer_name]
+
+    def get_cache_keys(
+            self, layer_names, input_texts, tokenizer, hyperparameters, activation_cache: ActivationCache,
+            dataset_hash=None
+    ):
+        """
+        Returns a dictionary of layer name to this model's cache key for the given layers and dataset.
+        The texts are hashed once for all layers, unless the hash of their tokenized dataset is given.
+        """
+        dataset_hash = dataset_hash or hash_texts(input_texts)
+        return {
+            layer_name: activation_cache.get_key(
+                model=self.model, layer_name=layer_name, hyperparameters=hyperparameters,
+                input_texts=input_texts, tokenizer=tokenizer, dataset_hash=dataset_hash
+            ) for layer_name in layer_names
+        }
+
+    def open_cache_entries(
+            self, layer_names, input_texts, tokenizer, hyperparameters, activation_cache: ActivationCache = None,
+            dataset_hash=None, start_missing=True
+    ):
+        """
+        Looks up this model's cache entries for the given layers and dataset.
+
+        Returns:
+        A dictionary of layer name to cache key, and the subset of it whose entries are not complete yet.
+        If start_missing is set, those entries are started, so that batches can be written to them.
+        """
+        if activation_cache is None:
+            return {}, {}
+
+        cache_keys = self.get_cache_keys(
+            layer_names, input_texts, tokenizer, hyperparameters, activation_cache=activation_cache,
+            dataset_hash=dataset_hash
+        )
+        keys_to_write = {
+            layer_name: cache_key for layer_name, cache_key in cache_keys.items()
+            if not activation_cache.is_complete(cache_key)
+        }
+
+        if keys_to_write:
+            if not start_missing:
+                return cache_keys, keys_to_write
+            for cache_key in keys_to_write.values():
+                activation_cache.start_entry(cache_key)
+        else:
+            for cache_key in cache_keys.values():
+                activation_cache.touch(cache_key)
+
+        return cache_keys, keys_to_write
+
+    @staticmethod
+    def read_cached_batch(activation_cache: ActivationCache, cache_keys, shard_index, hyperparameters):
+        return {
+            layer_name: activation_cache.read_shard(
+                cache_key, shard_index, storage_format=get_storage_format(hyperparameters, layer_name)
+            ) for layer_name, cache_key in cache_keys.items()
+        }
+
+    @staticmethod
+    def write_cached_batch(
+            activation_cache: ActivationCache, keys_to_write, shard_index, activations, sequence_offsets, hyperparameters
+    ):
+        for layer_name, cache_key in keys_to_write.items():
+            activation_cache.write_shard(
+                cache_key, shard_index, activations[layer_name], sequence_offsets=sequence_offsets,
+                storage_format=get_storage_format(hyperparameters, layer_name)
+            )
+
+    @staticmethod
+    def complete_cache_entries(activation_cache: ActivationCache, keys_to_write, num_batches):
+        for layer_name, cache_key in keys_to_write.items():
+            activation_cache.mark_complete(cache_key, num_shards=num_batches, metadata={'layer_name': layer_name})
+
+    @staticmethod
+    def get_batch_ids(index_batch, input_texts, tokenizer, hyperparameters, tokenized_dataset: TokenizedDataset = None):
+        """
+        Returns the input_ids and attention_mask of a batch of texts, taken from the tokenized dataset if given.
+        """
+        if tokenized_dataset is not None:
+            return tokenized_dataset.get_batch(index_batch)
+
+        inputs = tokenizer(
+            [input_texts[index] for index in index_batch], return_tensors='pt', padding=True, truncation=True,
+            max_length=hyperparameters['max_input_length']
+        )
+        return inputs['input_ids'], inputs['attention_mask']
+
+    def iterate_multi_layer_activations(
+            self, layer_names, input_texts, tokenizer, device, hyperparameters, activation_cache: ActivationCache = None,
+            tokenized_dataset: TokenizedDataset = None, start_batch: int = 0
+    ):
+        """
+        Yields a dictionary of layer name to activations for each batch of input texts,
+        hooking all layers at once so each batch needs only one forward pass.
+
+        If an activation cache is given, batches are read from disk when complete entries exist
+        for this model, all layers and dataset. Otherwise they are computed and written to the
+        cache entries that are missing, which become readable once the last batch is written.
+
+        If a tokenized dataset of the input texts is given, batches are built from its token ids
+        instead of tokenizing the texts again.
+
+        With start_batch, eg. to resume training from a checkpoint, the batches before it are neither read nor
+        run through the model. Such a partial pass does not write to the cache, as it could not complete an entry.
+        """
+        dataset_hash = tokenized_dataset.dataset_hash if tokenized_dataset is not None else None
+        cache_keys, keys_to_write = self.open_cache_entries(
+            layer_names, input_texts, tokenizer, hyperparameters, activation_cache=activation_cache,
+            dataset_hash=dataset_hash, start_missing=not start_batch
+        )
+        read_from_cache = activation_cache is not None and not keys_to_write
+        if start_batch:
+            keys_to_write = {}
+
+        if read_from_cache:
+            print(f'Reading activations for {layer_names} from activation cache')
+            index_batches = None
+            num_batches = activation_cache.get_num_shards(next(iter(cache_keys.values())))
+        else:
+            index_batches = self.get_index_batches(
+                input_texts, tokenizer, hyperparameters, tokenized_dataset=tokenized_dataset
+            )
+            num_batches = len(index_batches)
+
+        # Keep one capture hook per layer alive across all batches, rather than registering hooks per batch.
+        with self.hook_manager.capture_layers(layer_names, early_exit=hyperparameters.get('early_exit', False)):
+            for shard_index in range(start_batch, num_batches):
+                if read_from_cache:
+                    yield self.read_cached_batch(activation_cache, cache_keys, shard_index, hyperparameters)
+                    continue
+
+                input_ids, attention_mask = self.get_batch_ids(
+                    index_batches[shard_index], input_texts, tokenizer, hyperparameters,
+                    tokenized_dataset=tokenized_dataset
+                )
+                activations, sequence_offsets = self.get_multi_layer_activations_from_ids(
+                    layer_names=layer_names, input_ids=input_ids, attention_mask=attention_mask,
+                    device=device, hyperparameters=hyperparameters, return_offsets=True
+                )
+
+                self.write_cached_batch(
+                    activation_cache, keys_to_write, shard_index, activations, sequence_offsets, hyperparameters
+                )
+                yield activations
+
+        self.complete_cache_entries(activation_cache, keys_to_write, num_batches)
+
+    def iterate_paired_multi_layer_activations(
+            self, other_handler: "LayerActivationsHandler", layer_names, input_texts, tokenizer, device, other_device,
+            hyperparameters, activation_cache: ActivationCache = None, tokenized_dataset: TokenizedDataset = None,
+            start_batch: int = 0
+    ):
+        """
+        Yields the activations of this (base) model and another (rlhf) model on the same batches of input texts.
+        Each batch is tokenized once, and the same input ids are run through both models.
+
+        Yields a dictionary with 'base' and 'rlhf' dictionaries of layer name to activations. Since both models
+        see the same attention mask, packed activations of both models line up row by row.
+
+        Batches are read from the activation cache only if the entries of both models are complete.
+        start_batch skips batches as in iterate_multi_layer_activations.
+        """
+        dataset_hash = tokenized_dataset.dataset_hash if tokenized_dataset is not None else None
+        cache_keys, keys_to_write = self.open_cache_entries(
+            layer_names, input_texts, tokenizer, hyperparameters, activation_cache=activation_cache,
+            dataset_hash=dataset_hash, start_missing=not start_batch
+        )
+        other_cache_keys, other_keys_to_write = other_handler.open_cache_entries(
+            layer_names, input_texts, tokenizer, hyperparameters, activation_cache=activation_cache,
+            dataset_hash=dataset_hash, start_missing=not start_batch
+        )
+        read_from_cache = activation_cache is not None and not keys_to_write and not other_keys_to_write
+        if start_batch:
+            keys_to_write, other_keys_to_write = {}, {}
+
+        if read_from_cache:
+            print(f'Reading paired activations for {layer_names} from activation cache')
+            index_batches = None
+            num_batches = activation_cache.get_num_shards(next(iter(cache_keys.values())))
+        else:
+            index_batches = self.get_index_batches(
+                input_texts, tokenizer, hyperparameters, tokenized_dataset=tokenized_dataset
+            )
+            num_batches = len(index_batches)
+
+        early_exit = hyperparameters.get('early_exit', False)
+        with self.hook_manager.capture_layers(layer_names, early_exit=early_exit), \
+                other_handler.hook_manager.capture_layers(layer_names, early_exit=early_exit):
+            for shard_index in range(start_batch, num_batches):
+                if read_from_cache:
+                    activations = self.read_cached_batch(activation_cache, cache_keys, shard_index, hyperparameters)
+                    other_activations = self.read_cached_batch(
+                        activation_cache, other_cache_keys, shard_index, hyperparameters
+                    )
+                else:
+                    input_ids, attention_mask = self.get_batch_ids(
+                        index_batches[shard_index], input_texts, tokenizer, hyperparameters,
+                        tokenized_dataset=tokenized_dataset
+                    )
+                    activations, sequence_offsets = self.get_multi_layer_activations_from_ids(
+                        layer_names=layer_names, input_ids=input_ids, attention_mask=attention_mask,
+                        device=device, hyperparameters=hyperparameters, return_offsets=True
+                    )
+                    other_activations = other_handler.get_multi_layer_activations_from_ids(
+                        layer_names=layer_names, input_ids=input_ids, attention_mask=attention_mask,
+                        device=other_device, hyperparameters=hyperparameters
+                    )
+                    self.write_cached_batch(
+                        activation_cache, keys_to_write, shard_index, activations, sequence_offsets, hyperparameters
+                    )
+                    self.write_cached_batch(
+                        activation_cache, other_keys_to_write, shard_index, other_activations, sequence_offsets,
+                        hyperparameters
+                    )
+
+                yield {'base': activations, 'rlhf': other_activations}
+
+        self.complete_cache_entries(activation_cache, keys_to_write, num_batches)
+        other_handler.complete_cache_entries(activation_cache, other_keys_to_write, num_batches)
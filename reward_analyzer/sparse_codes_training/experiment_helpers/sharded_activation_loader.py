@@ -0,0 +1,292 @@
+"""
+This module streams token-level activations from the memory-mapped shards of complete activation cache entries
+in shuffled batches, so that autoencoders train on decorrelated tokens from many documents per step,
+on more tokens than fit in memory.
+"""
+import itertools
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Iterator
+
+import numpy as np
+import torch
+
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_cache import ActivationCache
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_storage import get_storage_format
+
+
+class ShuffleState:
+    """
+    The position of a ShardedActivationLoader in an epoch: the shard being read (its position in the epoch's
+    shard order) and the offset of the next row to take from it, the shuffle buffers, and the rows
+    emitted by the buffer that are not in a batch yet.
+    """
+    def __init__(self):
+        self.shard_position = 0
+        self.offset = 0
+        self.buffers = None
+        self.num_buffered = 0
+        self.pending = []
+        self.num_pending = 0
+
+
+class ShardedActivationLoader:
+    """
+    Iterates over batches of batch_size token activations of one or more cache entries with the same shards,
+    eg. several layers of the base and rlhf models on the same dataset, each keyed by a name such as
+    (source, layer_name). All entries are shuffled with the same permutation, so their batches stay aligned.
+
+    Each epoch, shards are visited in a random order and read by num_workers threads, ahead of the consumer.
+    The rows of each shard are flattened to tokens (shards of unpacked batches include their padding positions)
+    and permuted, then passed through a shuffle buffer of shuffle_buffer_size tokens per entry: every incoming
+    token replaces a random token in the buffer, which goes into the next batch. With a buffer larger than a shard,
+    a batch mixes tokens of many shards, while only the buffer and the shards being read are held in memory.
+
+    The order of batches only depends on the seed and the epoch, not on the timing of the readers.
+    iterate(start_batch) resumes an epoch mid-way without reading the shards of the batches before start_batch.
+    """
+    def __init__(
+            self, activation_cache: ActivationCache, cache_keys: Dict[Hashable, str], storage_formats: Dict[Hashable, str],
+            batch_size: int, shuffle_buffer_size: int, num_workers: int = 2, seed: int = 0
+    ):
+        self.activation_cache = activation_cache
+        self.cache_keys = cache_keys
+        self.storage_formats = storage_formats
+        self.batch_size = batch_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.num_workers = max(num_workers, 1)
+        self.seed = seed
+        self.epoch = 0
+
+        num_shards = {activation_cache.get_num_shards(cache_key) for cache_key in cache_keys.values()}
+        if len(num_shards) != 1:
+            raise ValueError(f'Entries to load together must have the same shards, found shard counts {num_shards}.')
+        self.num_shards = num_shards.pop()
+
+        # Shard headers are read through memory maps, so sizing the epoch does not read any activations.
+        first_key = next(iter(cache_keys.values()))
+        self.shard_num_rows = [
+            int(np.prod(np.load(activation_cache.get_shard_path(first_key, shard_index), mmap_mode='r').shape[:-1]))
+            for shard_index in range(self.num_shards)
+        ]
+        self.num_rows = sum(self.shard_num_rows)
+        self.shard_row_starts = torch.tensor([0] + self.shard_num_rows[:-1]).cumsum(dim=0)
+
+    @classmethod
+    def from_hyperparameters(
+            cls, activation_cache: ActivationCache, cache_keys: Dict[Hashable, str], hyperparameters: dict
+    ):
+        """
+        Creates a loader from hyperparameters, where each name of cache_keys is a layer name or ends with one.
+        """
+        storage_formats = {
+            name: get_storage_format(hyperparameters, name[-1] if isinstance(name, tuple) else name)
+            for name in cache_keys
+        }
+        return cls(
+            activation_cache, cache_keys, storage_formats,
+            batch_size=hyperparameters.get(
+                'loader_batch_tokens', hyperparameters['batch_size'] * hyperparameters['max_input_length']
+            ),
+            shuffle_buffer_size=hyperparameters['shuffle_buffer_tokens'],
+            num_workers=hyperparameters.get('loader_num_workers', 2),
+            seed=hyperparameters.get('loader_seed', 0)
+        )
+
+    def __len__(self):
+        return math.ceil(self.num_rows / self.batch_size)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def get_generator(self, *entropy) -> torch.Generator:
+        return torch.Generator().manual_seed(int(np.random.SeedSequence([self.seed, *entropy]).generate_state(1)[0]))
+
+    def read_shard(self, shard_index: int) -> Dict[Hashable, torch.Tensor]:
+        """
+        Reads a shard of every entry as [num_tokens, d] float32 tensors, permuted by the same random permutation.
+        """
+        generator = self.get_generator(self.epoch, shard_index)
+        permutation = torch.randperm(self.shard_num_rows[shard_index], generator=generator)
+
+        shard = {}
+        for name, cache_key in self.cache_keys.items():
+            activations = self.activation_cache.read_shard(
+                cache_key, shard_index, storage_format=self.storage_formats[name]
+            )
+            shard[name] = activations.reshape(-1, activations.size(-1))[permutation]
+        return shard
+
+    def iterate_shards(self, shard_order) -> Iterator[Dict[Hashable, torch.Tensor]]:
+        """
+        Yields shards in order, while the reader threads read up to 2 * num_workers shards ahead.
+        """
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            pending_shards = deque()
+            shard_order = iter(shard_order)
+            try:
+                for shard_index in shard_order:
+                    pending_shards.append(executor.submit(self.read_shard, shard_index))
+                    if len(pending_shards) >= 2 * self.num_workers:
+                        break
+                while pending_shards:
+                    shard = pending_shards.popleft().result()
+                    next_shard_index = next(shard_order, None)
+                    if next_shard_index is not None:
+                        pending_shards.append(executor.submit(self.read_shard, next_shard_index))
+                    yield shard
+            finally:
+                for pending_shard in pending_shards:
+                    pending_shard.cancel()
+
+    def read_rows(self, row_ids: torch.Tensor) -> Dict[Hashable, torch.Tensor]:
+        """
+        Reads the rows of every entry with the given ids, where the id of a row is the offset of its shard
+        plus its position in the permuted shard. Only the shards holding those rows are read.
+        """
+        shard_indices = torch.searchsorted(self.shard_row_starts, row_ids, right=True) - 1
+        rows = None
+        for shard_index in shard_indices.unique().tolist():
+            mask = shard_indices == shard_index
+            shard = self.read_shard(shard_index)
+            if rows is None:
+                rows = {
+                    name: torch.empty(len(row_ids), shard_rows.size(-1), dtype=shard_rows.dtype)
+                    for name, shard_rows in shard.items()
+                }
+            for name, shard_rows in shard.items():
+                rows[name][mask] = shard_rows[row_ids[mask] - self.shard_row_starts[shard_index]]
+        return rows
+
+    def shuffle_batches(self, state: ShuffleState, shards: Iterator, generator: torch.Generator):
+        """
+        Passes shards through the shuffle buffer and yields batches, starting from the shuffle state,
+        with shards in the epoch's order from state.shard_position on. state is updated before every yield,
+        so iteration can stop after any batch and continue from state later.
+        """
+        def take_batches(final=False):
+            if not state.pending or (state.num_pending < self.batch_size and not final):
+                return
+            if len(state.pending) > 1:
+                state.pending = [{
+                    name: torch.cat([pending_rows[name] for pending_rows in state.pending]) for name in state.pending[0]
+                }]
+            while state.num_pending >= self.batch_size or (final and state.num_pending):
+                num_rows = min(self.batch_size, state.num_pending)
+                rows = state.pending[0]
+                state.pending = [{name: name_rows[num_rows:] for name, name_rows in rows.items()}]
+                state.num_pending -= num_rows
+                yield {name: name_rows[:num_rows] for name, name_rows in rows.items()}
+            if not state.num_pending:
+                state.pending = []
+
+        for shard in shards:
+            if state.buffers is None:
+                state.buffers = {
+                    name: torch.empty(self.shuffle_buffer_size, *rows.shape[1:], dtype=rows.dtype)
+                    for name, rows in shard.items()
+                }
+
+            num_shard_rows = next(iter(shard.values())).size(0)
+            while state.offset < num_shard_rows:
+                offset = state.offset
+                if state.num_buffered < self.shuffle_buffer_size:
+                    num_taken = min(self.shuffle_buffer_size - state.num_buffered, num_shard_rows - offset)
+                    for name, rows in shard.items():
+                        state.buffers[name][state.num_buffered:state.num_buffered + num_taken] = (
+                            rows[offset:offset + num_taken]
+                        )
+                    state.num_buffered += num_taken
+                    state.offset += num_taken
+                else:
+                    # Swap incoming tokens into random slots of the full buffer, and emit the tokens they replace.
+                    num_taken = min(self.shuffle_buffer_size, num_shard_rows - offset)
+                    slots = torch.randperm(self.shuffle_buffer_size, generator=generator)[:num_taken]
+                    emitted = {}
+                    for name, rows in shard.items():
+                        emitted[name] = state.buffers[name][slots]
+                        state.buffers[name].index_copy_(0, slots, rows[offset:offset + num_taken])
+                    state.pending.append(emitted)
+                    state.num_pending += num_taken
+                    state.offset += num_taken
+                    yield from take_batches()
+            state.shard_position += 1
+            state.offset = 0
+
+        if state.buffers is not None and state.num_buffered:
+            permutation = torch.randperm(state.num_buffered, generator=generator)
+            state.pending.append({
+                name: buffer[:state.num_buffered][permutation] for name, buffer in state.buffers.items()
+            })
+            state.num_pending += state.num_buffered
+            state.num_buffered = 0
+        yield from take_batches(final=True)
+
+    def seek(self, shard_order, generator: torch.Generator, start_batch: int) -> ShuffleState:
+        """
+        Returns the shuffle state after the first start_batch batches of the epoch, without reading their shards:
+        the shuffle buffer is replayed over row ids, whose randomness only depends on the shard sizes,
+        and only the shards of rows still in the buffer are read.
+        """
+        state = ShuffleState()
+        id_shards = (
+            {'ids': torch.arange(self.shard_num_rows[shard_index]) + self.shard_row_starts[shard_index]}
+            for shard_index in shard_order
+        )
+        for _ in itertools.islice(self.shuffle_batches(state, id_shards, generator), start_batch):
+            pass
+
+        if state.shard_position < len(shard_order) and (
+                state.offset >= self.shard_num_rows[shard_order[state.shard_position]]
+        ):
+            state.shard_position += 1
+            state.offset = 0
+
+        if state.buffers is None:
+            return state
+        row_ids = [state.buffers['ids'][:state.num_buffered]] + [pending['ids'] for pending in state.pending]
+        rows = self.read_rows(torch.cat(row_ids))
+        if rows is None:
+            state.buffers = None
+            return state
+
+        state.buffers = {
+            name: torch.empty(self.shuffle_buffer_size, name_rows.size(-1), dtype=name_rows.dtype)
+            for name, name_rows in rows.items()
+        }
+        for name, name_rows in rows.items():
+            state.buffers[name][:state.num_buffered] = name_rows[:state.num_buffered]
+        state.pending = [{name: name_rows[state.num_buffered:] for name, name_rows in rows.items()}]
+        if not state.num_pending:
+            state.pending = []
+        return state
+
+    def iterate(self, start_batch: int = 0) -> Iterator[Dict[Hashable, torch.Tensor]]:
+        """
+        Yields the batches of the epoch from batch start_batch on, eg. to resume from a checkpoint,
+        the same as the batches of a full pass after its first start_batch.
+        """
+        generator = self.get_generator(self.epoch)
+        shard_order = torch.randperm(self.num_shards, generator=generator).tolist()
+
+        state = self.seek(shard_order, generator, start_batch) if start_batch else ShuffleState()
+        shards = self.iterate_shards(shard_order[state.shard_position:])
+        yield from self.shuffle_batches(state, shards, generator)
+
+    def __iter__(self) -> Iterator[Dict[Hashable, torch.Tensor]]:
+        return self.iterate()
+
+
+def write_missing_cache_entries(
+        activation_cache: ActivationCache, cache_keys: Dict[Hashable, str], get_activations_batches: Callable
+):
+    """
+    Runs get_activations_batches() to completion if any of the entries is not complete yet,
+    which writes the entries through the activation cache.
+    """
+    if all(activation_cache.is_complete(cache_key) for cache_key in cache_keys.values()):
+        return
+    print(f'Writing activations for {len(cache_keys)} entries to the activation cache before shuffled training')
+    for _ in get_activations_batches():
+        pass
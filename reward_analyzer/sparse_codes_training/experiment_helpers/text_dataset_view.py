@@ -0,0 +1,103 @@
+"""
+This module samples texts from an Arrow backed (huggingface) dataset by index, so that
+experiments read texts from the memory-mapped dataset instead of copying them into Python lists.
+"""
+import math
+from numbers import Integral
+from typing import List
+
+import numpy as np
+
+from reward_analyzer.utils.transformer_utils import batch
+
+
+def reservoir_sample_indices(population_size: int, k: int, seed: int) -> np.ndarray:
+    """
+    Samples k distinct indices out of range(population_size), in a single pass and O(k) memory (Algorithm L).
+    The sample is deterministic given the seed, and returned in random order.
+    """
+    rng = np.random.default_rng(seed)
+    if population_size <= k:
+        return rng.permutation(population_size)
+
+    reservoir = np.arange(k, dtype=np.int64)
+    weight = math.exp(math.log(rng.random()) / k)
+    index = k - 1
+    while True:
+        index += int(math.floor(math.log(rng.random()) / math.log(1 - weight))) + 1
+        if index >= population_size:
+            break
+        reservoir[rng.integers(k)] = index
+        weight *= math.exp(math.log(rng.random()) / k)
+
+    rng.shuffle(reservoir)
+    return reservoir
+
+
+class TextDatasetView:
+    """
+    An immutable, list-like view of texts in a huggingface dataset.
+
+    Each row of the dataset contributes one item per column, so item i is the text in column
+    columns[i % len(columns)] of row i // len(columns) (eg. the chosen and rejected responses of hh-rlhf).
+    The view holds only the sampled item indices, and reads texts from the dataset when they are accessed.
+    Indexing with an integer returns a text, while slices and index lists return a list of texts.
+    """
+    def __init__(self, dataset, columns: List[str], item_indices: np.ndarray = None, read_chunk_size: int = 1000):
+        self.dataset = dataset.select_columns(columns)
+        self.columns = list(columns)
+        self.read_chunk_size = read_chunk_size
+
+        if item_indices is None:
+            item_indices = np.arange(len(dataset) * len(columns), dtype=np.int64)
+        self.item_indices = np.array(item_indices, dtype=np.int64)
+        self.item_indices.flags.writeable = False
+
+    @classmethod
+    def sample(cls, dataset, columns: List[str], k: int, seed: int):
+        """
+        Samples k items without replacement, deterministically given the seed.
+        """
+        item_indices = reservoir_sample_indices(len(dataset) * len(columns), k=k, seed=seed)
+        return cls(dataset, columns=columns, item_indices=item_indices)
+
+    def __len__(self):
+        return len(self.item_indices)
+
+    def get_texts(self, positions) -> List[str]:
+        """
+        Reads the texts at the given positions of the view, with one Arrow take per call.
+        """
+        item_indices = self.item_indices[positions]
+        if len(item_indices) == 0:
+            return []
+
+        rows = item_indices // len(self.columns)
+        column_indices = item_indices % len(self.columns)
+        unique_rows, row_positions = np.unique(rows, return_inverse=True)
+        rows_by_column = self.dataset[unique_rows.tolist()]
+
+        return [
+            rows_by_column[self.columns[column_index]][row_position]
+            for column_index, row_position in zip(column_indices, row_positions)
+        ]
+
+    def __getitem__(self, position):
+        if isinstance(position, Integral):
+            return self.get_texts(np.array([position]))[0]
+        if isinstance(position, slice):
+            return self.get_texts(np.arange(len(self))[position])
+        return self.get_texts(np.asarray(position, dtype=np.int64))
+
+    def __iter__(self):
+        for positions in batch(range(len(self)), self.read_chunk_size):
+            yield from self.get_texts(np.asarray(positions))
+
+    def select(self, positions):
+        """
+        Returns a view of a subset of this view, eg. select(range(12)) for its first 12 texts.
+        """
+        return TextDatasetView(
+            self.dataset, columns=self.columns, item_indices=self.item_indices[np.asarray(positions, dtype=np.int64)],
+            read_chunk_size=self.read_chunk_size
+        )
@@ -0,0 +1,135 @@
+"""
+This module tokenizes a text dataset once, so that activation extraction consumes
+ready-made token id tensors instead of re-tokenizing every batch of every epoch.
+"""
+import hashlib
+import json
+import os
+from typing import List
+
+import numpy as np
+import torch
+
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_cache import hash_texts
+from reward_analyzer.utils.transformer_utils import batch
+
+
+class TokenizedDataset:
+    """
+    The token ids of a text dataset, stored as one flat array with per-text offsets,
+    so that the ids of text i are token_ids[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self, token_ids: np.ndarray, offsets: np.ndarray, pad_token_id: int, padding_side: str, key: str,
+                 dataset_hash: str):
+        self.token_ids = token_ids
+        self.offsets = offsets
+        self.lengths = np.diff(offsets)
+        self.pad_token_id = pad_token_id
+        self.padding_side = padding_side
+        self.key = key
+        self.dataset_hash = dataset_hash
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @staticmethod
+    def get_key(tokenizer, max_input_length: int, dataset_hash: str) -> str:
+        """
+        Builds the key of a tokenized dataset. The padding side and pad token are part of it,
+        since a saved dataset pads its batches with the ones it was built with.
+        """
+        key_parts = {
+            'tokenizer': tokenizer.name_or_path,
+            'tokenizer_revision': getattr(tokenizer, 'init_kwargs', {}).get('_commit_hash'),
+            'vocab_size': len(tokenizer),
+            'padding_side': tokenizer.padding_side,
+            'pad_token_id': tokenizer.pad_token_id,
+            'max_input_length': max_input_length,
+            'dataset_hash': dataset_hash
+        }
+        serialized = json.dumps(key_parts, sort_keys=True)
+        return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def from_texts(
+            cls, input_texts: List[str], tokenizer, max_input_length: int, chunk_size: int = 10000, dataset_hash=None
+    ):
+        """
+        Tokenizes the texts in chunks, truncating them to max_input_length as extraction does.
+        """
+        dataset_hash = dataset_hash or hash_texts(input_texts)
+        all_token_ids = []
+        for text_chunk in batch(input_texts, chunk_size):
+            tokenized = tokenizer(text_chunk, truncation=True, max_length=max_input_length)
+            all_token_ids.extend(np.asarray(input_ids, dtype=np.int32) for input_ids in tokenized['input_ids'])
+
+        lengths = np.array([len(input_ids) for input_ids in all_token_ids], dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        token_ids = np.concatenate(all_token_ids) if all_token_ids else np.zeros(0, dtype=np.int32)
+
+        return cls(
+            token_ids=token_ids, offsets=offsets, pad_token_id=tokenizer.pad_token_id,
+            padding_side=tokenizer.padding_side, dataset_hash=dataset_hash,
+            key=cls.get_key(tokenizer, max_input_length=max_input_length, dataset_hash=dataset_hash)
+        )
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'token_ids.npy'), self.token_ids)
+        np.save(os.path.join(directory, 'offsets.npy'), self.offsets)
+        metadata = {
+            'pad_token_id': self.pad_token_id, 'padding_side': self.padding_side,
+            'key': self.key, 'dataset_hash': self.dataset_hash
+        }
+        with open(os.path.join(directory, 'metadata.json'), 'w') as f_out:
+            json.dump(metadata, f_out)
+
+    @classmethod
+    def load(cls, directory: str):
+        with open(os.path.join(directory, 'metadata.json'), 'r') as f_in:
+            metadata = json.load(f_in)
+        return cls(
+            token_ids=np.load(os.path.join(directory, 'token_ids.npy'), mmap_mode='r'),
+            offsets=np.load(os.path.join(directory, 'offsets.npy')), **metadata
+        )
+
+    @classmethod
+    def load_or_build(cls, input_texts: List[str], tokenizer, max_input_length: int, cache_dir: str = None):
+        """
+        Loads the tokenized dataset from cache_dir if it was already built for this tokenizer,
+        max_input_length and dataset, and otherwise builds it and saves it there.
+        """
+        if not cache_dir:
+            return cls.from_texts(input_texts, tokenizer=tokenizer, max_input_length=max_input_length)
+
+        dataset_hash = hash_texts(input_texts)
+        key = cls.get_key(tokenizer, max_input_length=max_input_length, dataset_hash=dataset_hash)
+        directory = os.path.join(cache_dir, key)
+        if os.path.exists(os.path.join(directory, 'metadata.json')):
+            print(f'Loading tokenized dataset from {directory}')
+            return cls.load(directory)
+
+        tokenized_dataset = cls.from_texts(
+            input_texts, tokenizer=tokenizer, max_input_length=max_input_length, dataset_hash=dataset_hash
+        )
+        tokenized_dataset.save(directory)
+        return tokenized_dataset
+
+    def get_batch(self, indices: List[int]):
+        """
+        Returns padded input_ids and attention_mask tensors for the texts at the given indices,
+        padded on the tokenizer's padding side.
+        """
+        lengths = self.lengths[indices]
+        max_length = int(lengths.max())
+        input_ids = np.full((len(indices), max_length), self.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(indices), max_length), dtype=np.int64)
+
+        for row, (index, length) in enumerate(zip(indices, lengths)):
+            token_ids = self.token_ids[self.offsets[index]:self.offsets[index + 1]]
+            start = max_length - length if self.padding_side == 'left' else 0
+            input_ids[row, start:start + length] = token_ids
+            attention_mask[row, start:start + length] = 1
+
+        return torch.from_numpy(input_ids), torch.from_numpy(attention_mask)
@@ -0,0 +1,120 @@
+"""
+Times training steps of SparseAutoencoder with the losses accumulated on device and flushed every
+metrics_flush_steps steps, against the former step, which copied each loss to the host every step
+and renormalized the encoder by replacing its weight with a normalized copy before every forward pass.
+
+Run with eg. python -m reward_analyzer.sparse_codes_training.experiment_helpers.training_benchmark --device cuda
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from torch import optim
+
+from reward_analyzer.sparse_codes_training.models.sparse_autoencoder import SparseAutoencoder
+from reward_analyzer.utils.metrics_sink import log_metrics
+
+
+def synchronous_training_step(autoencoder: SparseAutoencoder, data, optimizer, label: str):
+    """
+    The training step before losses were accumulated on device, kept here as the benchmark's baseline.
+    """
+    optimizer.zero_grad()
+    autoencoder.encoder[0].weight.data = F.normalize(autoencoder.encoder[0].weight, p=2, dim=1)
+    features = autoencoder.encode(data)
+    reconstruction = autoencoder.decode(features, sparse=False)
+
+    sparsity_loss = autoencoder.l1_coef * torch.norm(features, 1, dim=-1).mean()
+    true_sparsity_loss = torch.norm(features, 0, dim=-1).mean()
+    reconstruction_loss = F.mse_loss(reconstruction, data)
+    loss = reconstruction_loss + sparsity_loss
+
+    # Each copy to the host waits for the device.
+    losses = [
+        metric.cpu().detach().numpy() for metric in (loss, reconstruction_loss, sparsity_loss, true_sparsity_loss)
+    ]
+
+    loss.backward()
+    optimizer.step()
+
+    log_metrics({
+        f"{metric_name}_{label}": float(metric) for metric_name, metric in zip(SparseAutoencoder.metric_names, losses)
+    })
+
+
+def time_training(autoencoder: SparseAutoencoder, batches, synchronous: bool, metrics_flush_steps: int) -> float:
+    """
+    Returns the training steps per second over the batches, after one untimed warmup step.
+    """
+    optimizer = optim.Adam(autoencoder.parameters(), lr=1e-3)
+    autoencoder.start_epoch(metrics_flush_steps=metrics_flush_steps)
+
+    def step(data):
+        if synchronous:
+            synchronous_training_step(autoencoder, data, optimizer, label='benchmark')
+        else:
+            autoencoder.training_step(data, optimizer=optimizer, label='benchmark')
+
+    step(batches[0])
+    if batches[0].is_cuda:
+        torch.cuda.synchronize()
+
+    start_time = time.perf_counter()
+    for data in batches:
+        step(data)
+    # The accumulated losses are flushed once more at the end of an epoch, which waits for the device.
+    autoencoder.flush_metrics('benchmark')
+    if batches[0].is_cuda:
+        torch.cuda.synchronize()
+    return len(batches) / (time.perf_counter() - start_time)
+
+
+def benchmark_training(
+        input_size: int, hidden_size_multiple: int = 2, batch_size: int = 1024, num_steps: int = 200,
+        metrics_flush_steps: int = 100, device: str = 'cpu', seed: int = 0
+):
+    """
+    Trains the same autoencoder on the same random activations with both training steps.
+
+    Returns:
+    A dictionary with the synchronous and accumulated steps per second, and the speedup of the latter.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    batches = [torch.randn(batch_size, input_size, generator=generator).to(device) for _ in range(num_steps)]
+
+    steps_per_second = {}
+    for synchronous in (True, False):
+        torch.manual_seed(seed)
+        autoencoder = SparseAutoencoder(
+            input_size, hidden_size=input_size * hidden_size_multiple, l1_coef=1e-3, tied_weights=True
+        ).to(device)
+        key = 'synchronous_steps_per_second' if synchronous else 'accumulated_steps_per_second'
+        steps_per_second[key] = time_training(
+            autoencoder, batches, synchronous=synchronous, metrics_flush_steps=metrics_flush_steps
+        )
+
+    steps_per_second['speedup'] = (
+        steps_per_second['accumulated_steps_per_second'] / steps_per_second['synchronous_steps_per_second']
+    )
+    return steps_per_second
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark autoencoder training steps per second.")
+    parser.add_argument("--input_size", default=2048, type=int, help="The activation size, eg. 2048 for gemma-2b.")
+    parser.add_argument("--hidden_size_multiple", default=2, type=int, help="The dictionary size multiple.")
+    parser.add_argument("--batch_size", default=1024, type=int, help="The number of activations per step.")
+    parser.add_argument("--num_steps", default=200, type=int, help="The number of timed steps per training step.")
+    parser.add_argument("--metrics_flush_steps", default=100, type=int, help="Steps between copies of the losses.")
+    parser.add_argument("--device", default='cpu', type=str, help="The device to benchmark on.")
+    args = parser.parse_args()
+
+    results = benchmark_training(
+        input_size=args.input_size, hidden_size_multiple=args.hidden_size_multiple, batch_size=args.batch_size,
+        num_steps=args.num_steps, metrics_flush_steps=args.metrics_flush_steps, device=args.device
+    )
+    print(f"Synchronous steps: {results['synchronous_steps_per_second']:.1f} steps/s")
+    print(f"Accumulated steps: {results['accumulated_steps_per_second']:.1f} steps/s")
+    print(f"Speedup: {results['speedup']:.2f}x")
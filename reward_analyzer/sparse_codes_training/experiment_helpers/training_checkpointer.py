@@ -0,0 +1,137 @@
+"""
+This module checkpoints experiment progress to disk, so that a relaunched run with the same config
+resumes where the last one stopped instead of redoing extraction and training.
+"""
+import hashlib
+import json
+import os
+import shutil
+from typing import Dict, List
+
+import torch
+
+from reward_analyzer.sparse_codes_training.models.sparse_autoencoder import SparseAutoencoder
+
+
+def autoencoder_to_checkpoint(autoencoder: SparseAutoencoder) -> dict:
+    return {
+        'kwargs': autoencoder.kwargs, 'tied_weights': autoencoder.tied_weights,
+        'state_dict': {name: tensor.cpu() for name, tensor in autoencoder.state_dict().items()}
+    }
+
+
+def autoencoder_from_checkpoint(checkpoint: dict, device: str = 'cpu', **kwargs) -> SparseAutoencoder:
+    """
+    Rebuilds a SparseAutoencoder from autoencoder_to_checkpoint, with extra constructor kwargs
+    such as sparse_decode_min_sparsity.
+    """
+    autoencoder = SparseAutoencoder(**checkpoint['kwargs'], tied_weights=checkpoint['tied_weights'], **kwargs)
+    autoencoder.load_state_dict(checkpoint['state_dict'])
+    return autoencoder.to(device)
+
+
+class TrainingCheckpointer:
+    """
+    Stores the checkpoints of one run in a directory keyed by a hash of its config, so a relaunch finds them.
+
+    Two kinds of checkpoints are kept:
+    Stage markers record that a stage of the run is done (eg. finding divergences, or training a layer's
+    autoencoders), together with its results. Training states hold the weights and optimizer states of
+    autoencoders trained together, and the epoch and batch to resume from; they are saved every
+    checkpoint_every_steps batches and at the end of every epoch.
+    All files are written atomically, so a run killed mid-write leaves the previous checkpoint intact.
+    """
+    stages_name = 'stages.json'
+
+    def __init__(self, checkpoint_dir: str, run_config: dict, checkpoint_every_steps: int = 500):
+        self.checkpoint_every_steps = checkpoint_every_steps
+        self.run_key = self.get_run_key(run_config)
+        self.run_dir = os.path.join(checkpoint_dir, self.run_key)
+        os.makedirs(self.run_dir, exist_ok=True)
+
+    @staticmethod
+    def get_run_key(run_config: dict) -> str:
+        serialized = json.dumps(run_config, sort_keys=True, default=str)
+        return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+    def get_path(self, name: str) -> str:
+        return os.path.join(self.run_dir, name)
+
+    def save_atomically(self, name: str, obj):
+        path = self.get_path(name)
+        temp_path = f'{path}.tmp'
+        torch.save(obj, temp_path)
+        os.replace(temp_path, path)
+
+    def load(self, name: str):
+        path = self.get_path(name)
+        if not os.path.exists(path):
+            return None
+        return torch.load(path, map_location='cpu')
+
+    def get_done_stages(self) -> List[str]:
+        path = self.get_path(self.stages_name)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r') as f_in:
+            return json.load(f_in)
+
+    def is_stage_done(self, stage: str) -> bool:
+        return stage in self.get_done_stages()
+
+    def mark_stage_done(self, stage: str, results=None):
+        """
+        Saves the results of a stage, then records the stage as done.
+        """
+        if results is not None:
+            self.save_atomically(f'stage_{stage}.pt', results)
+
+        done_stages = self.get_done_stages()
+        if stage not in done_stages:
+            done_stages.append(stage)
+        temp_path = f'{self.get_path(self.stages_name)}.tmp'
+        with open(temp_path, 'w') as f_out:
+            json.dump(done_stages, f_out)
+        os.replace(temp_path, self.get_path(self.stages_name))
+        print(f'Checkpointed stage {stage}')
+
+    def load_stage_results(self, stage: str):
+        return self.load(f'stage_{stage}.pt')
+
+    def should_save(self, num_steps: int) -> bool:
+        return bool(self.checkpoint_every_steps) and num_steps % self.checkpoint_every_steps == 0
+
+    def save_training_state(self, label: str, modules: Dict, optimizers: Dict, epoch: int, batch_index: int):
+        """
+        Saves the weights and optimizer states of modules trained together under a label,
+        to resume at batch batch_index of epoch epoch.
+        """
+        self.save_atomically(f'training_{label}.pt', {
+            'epoch': epoch, 'batch_index': batch_index,
+            'modules': {key: module.state_dict() for key, module in modules.items()},
+            'optimizers': {key: optimizer.state_dict() for key, optimizer in optimizers.items()}
+        })
+
+    def restore_training_state(self, label: str, modules: Dict, optimizers: Dict):
+        """
+        Loads the last training state of a label into the modules and optimizers.
+
+        Returns:
+        The epoch and batch index to resume from, (0, 0) without a checkpoint.
+        """
+        state = self.load(f'training_{label}.pt')
+        if state is None:
+            return 0, 0
+
+        for key, module in modules.items():
+            module.load_state_dict(state['modules'][key])
+        for key, optimizer in optimizers.items():
+            optimizer.load_state_dict(state['optimizers'][key])
+        print(f"Resuming training of {label} at epoch {state['epoch']}, batch {state['batch_index']}")
+        return state['epoch'], state['batch_index']
+
+    def clear(self):
+        """
+        Removes the checkpoints of the run, eg. once its artifact is saved.
+        """
+        shutil.rmtree(self.run_dir, ignore_errors=True)
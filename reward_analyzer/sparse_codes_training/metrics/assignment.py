@@ -0,0 +1,221 @@
+"""
+Approximate one to one matchings between the features of a small and a big dictionary, maximizing the total
+cosine similarity, for dictionaries too big for an exact (cubic time) Hungarian assignment.
+
+Every matching comes with an upper bound on the exact optimum, from the dual of the assignment problem,
+so the error against exact Hungarian is bounded without computing it.
+"""
+from dataclasses import dataclass
+
+import numpy as np
+
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+
+from reward_analyzer.sparse_codes_training.metrics.cosine_similarity import BlockwiseCosineSimilarity
+
+
+@dataclass
+class FeatureMatching:
+    """
+    The big feature matched to each small feature, their cosine similarities, an upper bound
+    on the mean similarity of the exact optimal matching, and the method that made the matching.
+    """
+    col_ind: np.ndarray
+    similarities: np.ndarray
+    upper_bound: float
+    method: str = 'hungarian'
+
+    @property
+    def mean_similarity(self) -> float:
+        return float(np.mean(self.similarities))
+
+    @property
+    def error_bound(self) -> float:
+        """
+        How far the mean similarity can be below that of the exact matching.
+        """
+        return max(self.upper_bound - self.mean_similarity, 0.0)
+
+
+def get_segment_starts(lengths: np.ndarray) -> np.ndarray:
+    return np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+
+
+def get_dual_upper_bound(
+        graph: csr_matrix, prices: np.ndarray, row_thresholds: np.ndarray, num_rows: int
+) -> float:
+    """
+    Bounds the mean similarity of the best matching, from object prices >= 0 of the assignment dual:
+    sum_i max_j (a_ij - p_j) + sum_j p_j. Pairs outside the candidate graph are below their row's threshold
+    (the k-th best similarity of the row), so a row's term is at most the larger of its candidates' a_ij - p_j
+    and its threshold.
+    """
+    lengths = np.diff(graph.indptr)
+    row_terms = row_thresholds.astype(np.float64).copy()
+    has_candidates = lengths > 0
+    if graph.nnz:
+        values = graph.data - prices[graph.indices]
+        row_maxima = np.maximum.reduceat(values, graph.indptr[:-1][has_candidates])
+        row_terms[has_candidates] = np.maximum(row_terms[has_candidates], row_maxima)
+    return float((row_terms.sum() + prices.sum()) / num_rows)
+
+
+def greedy_matching(
+        row_weights: np.ndarray, col_weights: np.ndarray, tile_size: int = 4096, k: int = 10, device: str = None
+):
+    """
+    Matches rows to columns in order of decreasing similarity, skipping pairs whose row or column is taken.
+    Pairs are taken from the top k candidate graph; rows left without a free candidate are matched
+    in further rounds, among the remaining columns.
+    """
+    col_ind = np.full(len(row_weights), -1, dtype=np.int64)
+    rows, cols = np.arange(len(row_weights)), np.arange(len(col_weights))
+
+    while len(rows):
+        graph = BlockwiseCosineSimilarity(
+            row_weights[rows], col_weights[cols], tile_size=tile_size, device=device
+        ).get_candidate_graph(k=k).tocoo()
+
+        row_taken = np.zeros(len(rows), dtype=bool)
+        col_taken = np.zeros(len(cols), dtype=bool)
+        for entry in np.argsort(-graph.data, kind='stable'):
+            row, col = graph.row[entry], graph.col[entry]
+            if not row_taken[row] and not col_taken[col]:
+                row_taken[row], col_taken[col] = True, True
+                col_ind[rows[row]] = cols[col]
+
+        rows, cols = rows[~row_taken], cols[~col_taken]
+
+    return col_ind
+
+
+def auction_matching(graph: csr_matrix, epsilon: float = 1e-4, max_rounds: int = 100000):
+    """
+    A forward auction on a sparse candidate graph of benefits (similarities).
+
+    In each round, every unassigned row bids at once for its best candidate, raising that candidate's price
+    by the gap to its second best plus epsilon, and each column goes to its highest bidder.
+    Starting from zero prices, columns left unassigned keep the lowest price, so the total similarity of the
+    result is within num_rows * epsilon of the best matching within the graph. (Epsilon scaling, which reuses
+    prices across phases, breaks this for more columns than rows without extra reverse auction steps.)
+    Rows whose best value drops below any possible similarity cannot be matched within the graph,
+    and are left unassigned (-1).
+
+    Returns:
+    The column of each row, and the final prices.
+    """
+    num_rows, num_cols = graph.shape
+    lengths = np.diff(graph.indptr)
+    prices = np.zeros(num_cols)
+    col_ind = np.full(num_rows, -1, dtype=np.int64)
+    owners = np.full(num_cols, -1, dtype=np.int64)
+    active = lengths > 0
+
+    for _ in range(max_rounds):
+        bidders = np.flatnonzero(active & (col_ind < 0))
+        if not len(bidders):
+            break
+
+        bidder_lengths = lengths[bidders]
+        starts = get_segment_starts(bidder_lengths)
+        entries = np.repeat(graph.indptr[bidders] - starts, bidder_lengths) + np.arange(bidder_lengths.sum())
+        candidate_cols = graph.indices[entries]
+        values = graph.data[entries] - prices[candidate_cols]
+
+        best_values = np.maximum.reduceat(values, starts)
+        segment_ids = np.repeat(np.arange(len(bidders)), bidder_lengths)
+        is_best = values == best_values[segment_ids]
+        first_best = np.flatnonzero(is_best)
+        _, first_of_segment = np.unique(segment_ids[first_best], return_index=True)
+        best_entries = first_best[first_of_segment]
+
+        values[best_entries] = -np.inf
+        second_values = np.maximum.reduceat(values, starts)
+        # Without a second candidate, bid as if the second best were the lowest possible similarity.
+        second_values = np.where(np.isfinite(second_values), second_values, np.minimum(best_values, -1.0))
+
+        # Rows that cannot gain anything anymore drop out, rather than bid prices up forever.
+        hopeless = best_values < -2.0
+        active[bidders[hopeless]] = False
+
+        bidders, best_entries = bidders[~hopeless], best_entries[~hopeless]
+        best_values, second_values = best_values[~hopeless], second_values[~hopeless]
+        bid_cols = candidate_cols[best_entries]
+        bids = prices[bid_cols] + best_values - second_values + epsilon
+
+        # Each column goes to its highest bid.
+        order = np.lexsort((-bids, bid_cols))
+        won_cols, first_bids = np.unique(bid_cols[order], return_index=True)
+        winners = bidders[order[first_bids]]
+
+        previous_owners = owners[won_cols]
+        col_ind[previous_owners[previous_owners >= 0]] = -1
+        owners[won_cols] = winners
+        col_ind[winners] = won_cols
+        prices[won_cols] = bids[order[first_bids]]
+
+    return col_ind, prices
+
+
+def match_features(
+        small_weights: np.ndarray, big_weights: np.ndarray, method: str = 'auto', tile_size: int = 4096,
+        k: int = 10, exact_max_size: int = 4096 * 8192, device: str = None
+) -> FeatureMatching:
+    """
+    Matches each small dictionary feature to a distinct big dictionary feature. Weights are [num_features, d].
+
+    Methods:
+    'hungarian': exact, on a dense cost matrix.
+    'greedy': see greedy_matching.
+    'auction': see auction_matching, on the top k candidate graph, with rows it could not match matched greedily.
+    'auto': exact when num_small * num_big <= exact_max_size, otherwise auction.
+    """
+    similarity = BlockwiseCosineSimilarity(small_weights, big_weights, tile_size=tile_size, device=device)
+    num_rows, num_cols = similarity.num_rows, similarity.num_cols
+    if num_rows > num_cols:
+        raise ValueError('Each small dictionary feature needs its own big dictionary feature.')
+
+    if method == 'auto':
+        method = 'hungarian' if num_rows * num_cols <= exact_max_size else 'auction'
+
+    if method == 'hungarian':
+        cost = np.empty((num_rows, num_cols), dtype=np.float64)
+        similarity.fill_dense(out=cost, transform=lambda tile: 1 - tile)
+        _, col_ind = linear_sum_assignment(cost)
+        similarities = 1 - cost[np.arange(num_rows), col_ind]
+        return FeatureMatching(
+            col_ind=col_ind, similarities=similarities, upper_bound=float(np.mean(similarities)), method=method
+        )
+
+    row_weights = similarity.row_weights.cpu().numpy()
+    col_weights = similarity.col_weights.cpu().numpy()
+    top_k_values, _ = similarity.get_top_k(k)
+    row_thresholds = top_k_values[:, -1]
+
+    if method == 'greedy':
+        col_ind = greedy_matching(row_weights, col_weights, tile_size=tile_size, k=k, device=device)
+        graph = csr_matrix((num_rows, num_cols))
+        prices = np.zeros(num_cols)
+        # With zero prices, the bound is the mean of the rows' max similarities.
+        row_thresholds = top_k_values[:, 0]
+
+    elif method == 'auction':
+        graph = similarity.get_candidate_graph(k=k)
+        graph.data = graph.data.astype(np.float64)
+        col_ind, prices = auction_matching(graph)
+
+        unmatched = np.flatnonzero(col_ind < 0)
+        if len(unmatched):
+            free_cols = np.setdiff1d(np.arange(num_cols), col_ind[col_ind >= 0])
+            free_col_ind = greedy_matching(
+                row_weights[unmatched], col_weights[free_cols], tile_size=tile_size, k=k, device=device
+            )
+            col_ind[unmatched] = free_cols[free_col_ind]
+
+    else:
+        raise ValueError(f'Matching method {method} not supported!')
+
+    similarities = similarity.get_pair_similarities(np.arange(num_rows), col_ind)
+    upper_bound = get_dual_upper_bound(graph, prices, row_thresholds, num_rows)
+    return FeatureMatching(col_ind=col_ind, similarities=similarities, upper_bound=upper_bound, method=method)
@@ -0,0 +1,76 @@
+"""
+Times the MMCS matching methods across dictionary sizes, and compares the approximate methods
+with exact Hungarian matching where it is affordable.
+
+Run with eg. python -m reward_analyzer.sparse_codes_training.metrics.assignment_benchmark --sizes 1024 2048 4096
+"""
+import argparse
+import time
+from typing import List
+
+import numpy as np
+
+from reward_analyzer.sparse_codes_training.metrics.assignment import match_features
+
+
+def make_dictionaries(num_small: int, hidden_size_multiple: int, input_size: int, noise: float, seed: int = 0):
+    """
+    Returns a random small dictionary, and a big dictionary holding a noisy copy of every small feature
+    in random order plus random features, as [num_features, input_size] arrays.
+    """
+    rng = np.random.default_rng(seed)
+    small_weights = rng.standard_normal((num_small, input_size)).astype(np.float32)
+    copied_features = small_weights[rng.permutation(num_small)] + noise * rng.standard_normal((num_small, input_size))
+    new_features = rng.standard_normal((num_small * (hidden_size_multiple - 1), input_size))
+    big_weights = np.concatenate([copied_features, new_features]).astype(np.float32)
+    return small_weights, big_weights
+
+
+def benchmark_matching(
+        sizes: List[int] = (1024, 2048, 4096), hidden_size_multiple: int = 2, input_size: int = 256, noise: float = 1.0,
+        methods: List[str] = ('hungarian', 'greedy', 'auction'), exact_max_size: int = 4096 * 8192, k: int = 10
+):
+    """
+    Returns a list of dictionaries with the size, method, seconds, MMCS, reported error bound, and the
+    error against exact matching where exact matching was run (num_small * num_big <= exact_max_size).
+    """
+    results = []
+    for num_small in sizes:
+        small_weights, big_weights = make_dictionaries(num_small, hidden_size_multiple, input_size, noise)
+        exact_mmcs = None
+        for method in methods:
+            if method == 'hungarian' and num_small * len(big_weights) > exact_max_size:
+                continue
+
+            start_time = time.perf_counter()
+            matching = match_features(small_weights, big_weights, method=method, k=k)
+            seconds = time.perf_counter() - start_time
+
+            if method == 'hungarian':
+                exact_mmcs = matching.mean_similarity
+            results.append({
+                'num_small': num_small, 'num_big': len(big_weights), 'method': method, 'seconds': seconds,
+                'mmcs': matching.mean_similarity, 'error_bound': matching.error_bound,
+                'error': None if exact_mmcs is None else exact_mmcs - matching.mean_similarity
+            })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the MMCS matching methods.")
+    parser.add_argument("--sizes", default=[1024, 2048, 4096], type=int, nargs='+', help="Small dictionary sizes.")
+    parser.add_argument("--hidden_size_multiple", default=2, type=int, help="Big over small dictionary size.")
+    parser.add_argument("--input_size", default=256, type=int, help="The feature dimension.")
+    parser.add_argument("--noise", default=1.0, type=float, help="Noise on the copies of small features.")
+    parser.add_argument("--exact_max_size", default=4096 * 8192, type=int, help="Largest size to run Hungarian on.")
+    args = parser.parse_args()
+
+    for result in benchmark_matching(
+        sizes=args.sizes, hidden_size_multiple=args.hidden_size_multiple, input_size=args.input_size,
+        noise=args.noise, exact_max_size=args.exact_max_size
+    ):
+        error = 'n/a' if result['error'] is None else f"{result['error']:.5f}"
+        print(
+            f"{result['num_small']} x {result['num_big']} {result['method']}: {result['seconds']:.2f}s, "
+            f"MMCS {result['mmcs']:.5f}, error bound {result['error_bound']:.5f}, error vs exact {error}"
+        )
@@ -0,0 +1,158 @@
+"""
+Blockwise cosine similarities between two sets of dictionary features, eg. the encoder rows of a small and a big
+autoencoder. Only tile_size x tile_size tiles of the similarity matrix are ever materialized, so peak memory
+is set by the tile size rather than by the dictionary sizes.
+"""
+from typing import Iterator, Tuple
+
+import numpy as np
+import torch
+
+from scipy.sparse import coo_matrix, csr_matrix
+
+
+class BlockwiseCosineSimilarity:
+    """
+    Streams tiles of the [num_rows, num_cols] cosine similarity matrix between the rows of two
+    [num_features, d] weight matrices, and reduces them to what a consumer needs: row and column maxima,
+    the top k matches per feature, a sparse candidate graph, or a dense matrix filled in place.
+    """
+    def __init__(self, row_weights, col_weights, tile_size: int = 4096, device: str = None):
+        self.device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+        self.tile_size = tile_size
+        self.row_weights = self.normalize(row_weights)
+        self.col_weights = self.normalize(col_weights)
+        self.num_rows, self.num_cols = self.row_weights.size(0), self.col_weights.size(0)
+
+    def normalize(self, weights) -> torch.Tensor:
+        weights = torch.as_tensor(weights).to(self.device, dtype=torch.float32)
+        return torch.nn.functional.normalize(weights, p=2, dim=1)
+
+    def transposed(self) -> "BlockwiseCosineSimilarity":
+        """
+        Returns the engine with rows and columns swapped, sharing the normalized weights.
+        """
+        engine = BlockwiseCosineSimilarity.__new__(BlockwiseCosineSimilarity)
+        engine.device, engine.tile_size = self.device, self.tile_size
+        engine.row_weights, engine.col_weights = self.col_weights, self.row_weights
+        engine.num_rows, engine.num_cols = self.num_cols, self.num_rows
+        return engine
+
+    def iterate_tiles(self) -> Iterator[Tuple[int, int, torch.Tensor]]:
+        """
+        Yields the row offset, column offset and [tile rows, tile columns] similarities of each tile,
+        row block by row block.
+        """
+        for row_start in range(0, self.num_rows, self.tile_size):
+            row_block = self.row_weights[row_start:row_start + self.tile_size]
+            for col_start in range(0, self.num_cols, self.tile_size):
+                col_block = self.col_weights[col_start:col_start + self.tile_size]
+                yield row_start, col_start, torch.mm(row_block, col_block.T)
+
+    def get_maxima(self):
+        """
+        Returns the max similarity of each row and of each column, and the indices where they are reached,
+        as numpy arrays: row_max, row_argmax, col_max, col_argmax.
+        """
+        row_max = torch.full((self.num_rows,), -np.inf, device=self.device)
+        row_argmax = torch.zeros(self.num_rows, dtype=torch.long, device=self.device)
+        col_max = torch.full((self.num_cols,), -np.inf, device=self.device)
+        col_argmax = torch.zeros(self.num_cols, dtype=torch.long, device=self.device)
+
+        for row_start, col_start, tile in self.iterate_tiles():
+            row_end, col_end = row_start + tile.size(0), col_start + tile.size(1)
+
+            tile_row_max, tile_row_argmax = tile.max(dim=1)
+            improved = tile_row_max > row_max[row_start:row_end]
+            row_max[row_start:row_end] = torch.where(improved, tile_row_max, row_max[row_start:row_end])
+            row_argmax[row_start:row_end] = torch.where(
+                improved, tile_row_argmax + col_start, row_argmax[row_start:row_end]
+            )
+
+            tile_col_max, tile_col_argmax = tile.max(dim=0)
+            improved = tile_col_max > col_max[col_start:col_end]
+            col_max[col_start:col_end] = torch.where(improved, tile_col_max, col_max[col_start:col_end])
+            col_argmax[col_start:col_end] = torch.where(
+                improved, tile_col_argmax + row_start, col_argmax[col_start:col_end]
+            )
+
+        return row_max.cpu().numpy(), row_argmax.cpu().numpy(), col_max.cpu().numpy(), col_argmax.cpu().numpy()
+
+    def get_top_k(self, k: int):
+        """
+        Returns the k highest similarities of each row and their column indices, as [num_rows, k] numpy arrays
+        sorted by decreasing similarity. Use transposed() for the top k per column.
+        """
+        k = min(k, self.num_cols)
+        all_values, all_indices = [], []
+        for row_start in range(0, self.num_rows, self.tile_size):
+            row_block = self.row_weights[row_start:row_start + self.tile_size]
+            values = torch.empty(row_block.size(0), 0, device=self.device)
+            indices = torch.empty(row_block.size(0), 0, dtype=torch.long, device=self.device)
+
+            for col_start in range(0, self.num_cols, self.tile_size):
+                tile = torch.mm(row_block, self.col_weights[col_start:col_start + self.tile_size].T)
+                tile_values, tile_indices = torch.topk(tile, k=min(k, tile.size(1)), dim=1)
+                # Merge the running top k with the tile's, so only [rows, 2k] candidates are held.
+                values = torch.cat([values, tile_values], dim=1)
+                indices = torch.cat([indices, tile_indices + col_start], dim=1)
+                values, order = torch.topk(values, k=min(k, values.size(1)), dim=1)
+                indices = torch.gather(indices, 1, order)
+
+            all_values.append(values.cpu().numpy())
+            all_indices.append(indices.cpu().numpy())
+
+        return np.concatenate(all_values), np.concatenate(all_indices)
+
+    def get_candidate_graph(self, k: int = 10, min_similarity: float = None) -> csr_matrix:
+        """
+        Returns a sparse [num_rows, num_cols] matrix of candidate matches: the top k columns of every row,
+        the top k rows of every column, and if min_similarity is given, every pair at least that similar.
+        """
+        _, row_indices = self.get_top_k(k)
+        _, col_indices = self.transposed().get_top_k(k)
+
+        rows = [np.repeat(np.arange(self.num_rows), row_indices.shape[1]), col_indices.ravel()]
+        cols = [row_indices.ravel(), np.repeat(np.arange(self.num_cols), col_indices.shape[1])]
+
+        if min_similarity is not None:
+            for row_start, col_start, tile in self.iterate_tiles():
+                tile_rows, tile_cols = torch.nonzero(tile >= min_similarity, as_tuple=True)
+                rows.append((tile_rows + row_start).cpu().numpy())
+                cols.append((tile_cols + col_start).cpu().numpy())
+
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        graph = coo_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(self.num_rows, self.num_cols)
+        ).tocsr()
+        # Pairs found more than once were merged, so look the similarities up once per stored pair.
+        graph_rows = np.repeat(np.arange(self.num_rows), np.diff(graph.indptr))
+        graph.data = self.get_pair_similarities(graph_rows, graph.indices)
+        return graph
+
+    def get_pair_similarities(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """
+        Returns the similarities of the given (row, column) pairs, in chunks of about as many values as a tile.
+        """
+        similarities = np.empty(len(rows), dtype=np.float32)
+        chunk_size = max(self.tile_size * self.tile_size // self.row_weights.size(1), 1)
+        for start in range(0, len(rows), chunk_size):
+            chunk_rows = torch.as_tensor(rows[start:start + chunk_size], device=self.device)
+            chunk_cols = torch.as_tensor(cols[start:start + chunk_size], device=self.device)
+            similarities[start:start + chunk_size] = (
+                self.row_weights[chunk_rows] * self.col_weights[chunk_cols]
+            ).sum(dim=1).cpu().numpy()
+        return similarities
+
+    def fill_dense(self, out: np.ndarray = None, transform=None) -> np.ndarray:
+        """
+        Writes the full similarity matrix tile by tile into out (allocated if not given), applying transform
+        (eg. lambda tile: 1 - tile for a cost matrix) to each tile first, so no other full size copy is made.
+        """
+        if out is None:
+            out = np.empty((self.num_rows, self.num_cols), dtype=np.float32)
+        for row_start, col_start, tile in self.iterate_tiles():
+            if transform is not None:
+                tile = transform(tile)
+            out[row_start:row_start + tile.size(0), col_start:col_start + tile.size(1)] = tile.cpu().numpy()
+        return out
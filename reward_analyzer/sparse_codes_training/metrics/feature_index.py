@@ -0,0 +1,309 @@
+"""
+A nearest neighbour index over the normalized dictionary atoms (encoder rows) of every autoencoder of an artifact,
+to look up eg. the rlhf model features closest to a base model feature, across layers and dictionary sizes,
+without recomputing dense cosine similarity matrices per query.
+
+Search is either exact, over blocks of atoms, or approximate, with an inverted file of coarse clusters whose
+residuals are product quantized (IVF-PQ), and the best approximate candidates rescored exactly.
+"""
+import json
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from scipy.sparse import csr_matrix
+
+
+def kmeans(vectors: np.ndarray, num_clusters: int, num_iterations: int = 20, seed: int = 0,
+           block_size: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Lloyd's k-means, assigning vectors in blocks so that only [block_size, num_clusters] distances are held.
+
+    Returns:
+    The [num_clusters, d] centroids, and the cluster of each vector.
+    """
+    rng = np.random.default_rng(seed)
+    num_clusters = min(num_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].astype(np.float32)
+    assignments = np.zeros(len(vectors), dtype=np.int64)
+
+    for _ in range(num_iterations):
+        centroid_norms = (centroids ** 2).sum(axis=1)
+        for start in range(0, len(vectors), block_size):
+            # The squared norms of the vectors do not change which centroid is closest.
+            distances = centroid_norms - 2 * vectors[start:start + block_size] @ centroids.T
+            assignments[start:start + block_size] = distances.argmin(axis=1)
+
+        counts = np.bincount(assignments, minlength=num_clusters)
+        members = csr_matrix(
+            (np.ones(len(vectors), dtype=np.float32), (assignments, np.arange(len(vectors)))),
+            shape=(num_clusters, len(vectors))
+        )
+        sums = members @ vectors
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+        # Restart empty clusters at random vectors.
+        centroids[~non_empty] = vectors[rng.choice(len(vectors), int((~non_empty).sum()), replace=False)]
+
+    return centroids, assignments
+
+
+def merge_top_k(values: np.ndarray, indices: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Keeps the k highest values of each row of [num_queries, n] values, sorted decreasing, with their indices.
+    """
+    if values.shape[1] > k:
+        top = np.argpartition(-values, k - 1, axis=1)[:, :k]
+        values, indices = np.take_along_axis(values, top, axis=1), np.take_along_axis(indices, top, axis=1)
+    order = np.argsort(-values, axis=1, kind='stable')
+    return np.take_along_axis(values, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+class FeatureIndex:
+    """
+    Holds the unit norm atoms of one or more dictionaries as rows of one [num_entries, d] float32 matrix,
+    stored contiguously per (holder, layer), eg. ('rlhf_big', '3'), with the feature number of every row.
+
+    Searches return columnar results like the MMCS match tables: dicts of [num_queries, k] arrays
+    holder, layer, feature and cosine, best match first.
+    """
+    array_names = ['atoms', 'features', 'segment_bounds', 'centroids', 'codebooks', 'codes', 'list_entries',
+                   'list_offsets']
+
+    def __init__(self, atoms: np.ndarray, features: np.ndarray, segment_keys: List[Tuple[str, str]],
+                 segment_bounds: np.ndarray):
+        self.atoms = atoms
+        self.features = features
+        self.segment_keys = [tuple(key) for key in segment_keys]
+        self.segment_bounds = segment_bounds
+        self.centroids = self.codebooks = self.codes = self.list_entries = self.list_offsets = None
+
+    @classmethod
+    def from_autoencoders(cls, autoencoders_dict: Dict, holder_names: List[str] = None):
+        """
+        Indexes the encoder rows of loaded autoencoders, eg. the output of load_autoencoders_for_artifact:
+        {holder name: {layer name: autoencoder or [autoencoder]}}. Entries other than autoencoder holders,
+        such as match tables, are skipped.
+        """
+        holder_names = holder_names or ['base_big', 'base_small', 'rlhf_big', 'rlhf_small']
+
+        all_atoms, all_features, segment_keys, segment_bounds, num_entries = [], [], [], [], 0
+        for holder_name in holder_names:
+            if holder_name not in autoencoders_dict:
+                continue
+            for layer_name, autoencoder in sorted(autoencoders_dict[holder_name].items()):
+                if isinstance(autoencoder, list):
+                    autoencoder = autoencoder[0]
+                atoms = autoencoder.encoder[0].weight.detach().cpu().float().numpy()
+                atoms = atoms / np.maximum(np.linalg.norm(atoms, axis=1, keepdims=True), 1e-12)
+
+                all_atoms.append(atoms)
+                all_features.append(np.arange(len(atoms), dtype=np.int64))
+                segment_keys.append((holder_name, str(layer_name)))
+                segment_bounds.append((num_entries, num_entries + len(atoms)))
+                num_entries += len(atoms)
+
+        return cls(
+            np.ascontiguousarray(np.concatenate(all_atoms), dtype=np.float32), np.concatenate(all_features),
+            segment_keys, np.array(segment_bounds, dtype=np.int64)
+        )
+
+    def get_segments(self, holder: str = None, layer: str = None) -> List[Tuple[int, int]]:
+        """
+        Returns the (start, end) rows of the dictionaries matching the holder and layer, any if None.
+        """
+        segments = [
+            tuple(bounds) for (segment_holder, segment_layer), bounds in zip(self.segment_keys, self.segment_bounds)
+            if holder in (None, segment_holder) and (layer is None or str(layer) == segment_layer)
+        ]
+        if not segments:
+            raise ValueError(f'No dictionary indexed for holder {holder} and layer {layer}.')
+        return segments
+
+    def get_atom(self, holder: str, layer: str, feature: int) -> np.ndarray:
+        (start, end), = self.get_segments(holder, layer)
+        return self.atoms[start + feature]
+
+    def describe(self, similarities: np.ndarray, entries: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Turns [num_queries, k] row numbers of the index into holder, layer, feature and cosine columns.
+        """
+        segment_of_entry = np.searchsorted(self.segment_bounds[:, 1], entries, side='right')
+        holders = np.array([holder for holder, _ in self.segment_keys], dtype=str)
+        layers = np.array([layer for _, layer in self.segment_keys], dtype=str)
+        return {
+            'holder': holders[segment_of_entry], 'layer': layers[segment_of_entry],
+            'feature': self.features[entries], 'cosine': similarities
+        }
+
+    def search_exact(self, queries: np.ndarray, k: int, segments: List[Tuple[int, int]], block_size: int = 65536):
+        """
+        Scores queries against the atoms of the segments block by block, keeping a running top k.
+        """
+        top_values = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        top_entries = np.zeros((len(queries), 0), dtype=np.int64)
+        for segment_start, segment_end in segments:
+            for start in range(segment_start, segment_end, block_size):
+                end = min(start + block_size, segment_end)
+                values = queries @ self.atoms[start:end].T
+                entries = np.broadcast_to(np.arange(start, end), values.shape)
+                top_values, top_entries = merge_top_k(
+                    np.concatenate([top_values, values], axis=1), np.concatenate([top_entries, entries], axis=1), k
+                )
+        return top_values, top_entries
+
+    def train_ivfpq(self, num_lists: int = None, num_subspaces: int = 16, num_codes: int = 256,
+                    num_iterations: int = 20, seed: int = 0):
+        """
+        Builds the approximate index: num_lists coarse clusters (about the square root of the number of atoms
+        by default), and num_subspaces product quantizers of num_codes codes each for the residuals
+        of atoms from their cluster centroids, so every atom is coded in num_subspaces bytes.
+        """
+        num_entries, input_size = self.atoms.shape
+        if num_codes > 256:
+            raise ValueError('Product quantizer codes are stored in one byte, so num_codes can be at most 256.')
+        if input_size % num_subspaces:
+            raise ValueError(f'The atom size {input_size} must be divisible by num_subspaces {num_subspaces}.')
+        num_lists = num_lists or max(int(np.sqrt(num_entries)), 1)
+
+        self.centroids, lists = kmeans(self.atoms, num_lists, num_iterations=num_iterations, seed=seed)
+        residuals = (self.atoms - self.centroids[lists]).reshape(num_entries, num_subspaces, -1)
+
+        codebooks, codes = [], []
+        for subspace in range(num_subspaces):
+            codebook, subspace_codes = kmeans(
+                np.ascontiguousarray(residuals[:, subspace]), num_codes, num_iterations=num_iterations,
+                seed=seed + 1 + subspace
+            )
+            codebooks.append(codebook)
+            codes.append(subspace_codes.astype(np.uint8))
+        self.codebooks = np.stack(codebooks)
+        self.codes = np.stack(codes, axis=1)
+
+        # Inverted lists: the entries of each list are list_entries[list_offsets[i]:list_offsets[i + 1]].
+        self.list_entries = np.argsort(lists, kind='stable')
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=len(self.centroids)))])
+
+    def search_ivfpq(self, queries: np.ndarray, k: int, segments: List[Tuple[int, int]], num_probes: int = 8,
+                     num_rescored: int = None, query_block_size: int = 1024):
+        """
+        Scores each query against the atoms of its num_probes closest lists as q.centroid + q.decoded residual,
+        using a [num_subspaces, num_codes] lookup table per query, then rescores the best num_rescored
+        (4k by default) candidates exactly. Blocks of query_block_size queries are scored at once,
+        with their candidates padded to the longest candidate list of the block.
+        """
+        if self.centroids is None:
+            raise ValueError('Approximate search needs train_ivfpq first.')
+        num_rescored = num_rescored or 4 * k
+        num_subspaces = self.codebooks.shape[0]
+
+        bounds = np.array(sorted(segments), dtype=np.int64)
+        top_values = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        top_entries = np.zeros((len(queries), k), dtype=np.int64)
+
+        centroid_scores = queries @ self.centroids.T
+        num_probes = min(num_probes, len(self.centroids))
+        probed_lists = np.argpartition(-centroid_scores, num_probes - 1, axis=1)[:, :num_probes]
+
+        for start in range(0, len(queries), query_block_size):
+            block_queries = queries[start:start + query_block_size]
+            num_queries = len(block_queries)
+
+            # The entries of every probed list of every query, grouped by query.
+            lists = probed_lists[start:start + num_queries].ravel()
+            lengths = self.list_offsets[lists + 1] - self.list_offsets[lists]
+            entries = self.list_entries[
+                np.repeat(self.list_offsets[lists] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            ]
+            entry_queries = np.repeat(np.repeat(np.arange(num_queries), num_probes), lengths)
+            entry_lists = np.repeat(lists, lengths)
+
+            segment_of_entry = np.searchsorted(bounds[:, 0], entries, side='right') - 1
+            in_segments = (segment_of_entry >= 0) & (entries < bounds[np.maximum(segment_of_entry, 0), 1])
+            entries, entry_queries, entry_lists = (
+                entries[in_segments], entry_queries[in_segments], entry_lists[in_segments]
+            )
+            if not len(entries):
+                continue
+
+            lookup_tables = np.einsum(
+                'qsd,scd->qsc', block_queries.reshape(num_queries, num_subspaces, -1), self.codebooks
+            )
+            scores = centroid_scores[start + entry_queries, entry_lists] + lookup_tables[
+                entry_queries[:, None], np.arange(num_subspaces), self.codes[entries]
+            ].sum(axis=1)
+
+            # Pads the candidates of each query into a row of a [num_queries, most candidates] matrix.
+            num_candidates = np.bincount(entry_queries, minlength=num_queries)
+            positions = np.arange(len(entries)) - np.repeat(np.cumsum(num_candidates) - num_candidates, num_candidates)
+            padded_scores = np.full((num_queries, num_candidates.max()), -np.inf, dtype=np.float32)
+            padded_entries = np.zeros((num_queries, num_candidates.max()), dtype=np.int64)
+            padded_scores[entry_queries, positions] = scores
+            padded_entries[entry_queries, positions] = entries
+
+            candidate_scores, candidates = merge_top_k(padded_scores, padded_entries, num_rescored)
+            values = np.einsum('qd,qrd->qr', block_queries, self.atoms[candidates])
+            values[np.isneginf(candidate_scores)] = -np.inf
+            values, candidates = merge_top_k(values, candidates, k)
+            top_values[start:start + num_queries, :values.shape[1]] = values
+            top_entries[start:start + num_queries, :candidates.shape[1]] = candidates
+
+        return top_values, top_entries
+
+    def search(self, queries: np.ndarray, k: int = 10, holder: str = None, layer: str = None,
+               approximate: bool = False, **search_kwargs) -> Dict[str, np.ndarray]:
+        """
+        Finds the k atoms most cosine similar to each of the [num_queries, d] (or [d]) queries,
+        among the dictionaries matching holder and layer (all if None).
+        With approximate=True, uses the IVF-PQ index, with search_kwargs for search_ivfpq.
+        Approximate results are padded with cosine -inf where the probed lists hold fewer than k atoms.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        segments = self.get_segments(holder, layer)
+
+        if approximate:
+            similarities, entries = self.search_ivfpq(queries, k, segments, **search_kwargs)
+        else:
+            similarities, entries = self.search_exact(queries, k, segments, **search_kwargs)
+        return self.describe(similarities, entries)
+
+    def search_feature(self, holder: str, layer: str, feature: int, k: int = 10, target_holder: str = None,
+                       target_layer: str = None, **search_kwargs) -> Dict[str, np.ndarray]:
+        """
+        Finds the atoms closest to one indexed feature, eg. the rlhf_big features closest to base_small feature 12
+        of layer '3', with search_feature('base_small', '3', 12, target_holder='rlhf_big').
+        """
+        results = self.search(
+            self.get_atom(holder, layer, feature), k=k, holder=target_holder, layer=target_layer, **search_kwargs
+        )
+        return {name: column[0] for name, column in results.items()}
+
+    def save(self, index_dir: str):
+        """
+        Saves the index as one .npy file per array plus the dictionary keys, so that load can memory map it.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        for name in self.array_names:
+            if getattr(self, name) is not None:
+                np.save(os.path.join(index_dir, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(index_dir, 'segment_keys.json'), 'w') as f_out:
+            json.dump(self.segment_keys, f_out)
+
+    @classmethod
+    def load(cls, index_dir: str, mmap_mode: str = 'r'):
+        """
+        Loads an index saved by save, memory mapping its arrays by default so that loading reads no atoms.
+        """
+        with open(os.path.join(index_dir, 'segment_keys.json'), 'r') as f_in:
+            segment_keys = json.load(f_in)
+
+        arrays = {
+            name: np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+            for name in cls.array_names if os.path.exists(os.path.join(index_dir, f'{name}.npy'))
+        }
+        index = cls(arrays.pop('atoms'), arrays.pop('features'), segment_keys, np.asarray(arrays.pop('segment_bounds')))
+        for name, array in arrays.items():
+            setattr(index, name, array)
+        return index
@@ -1,28 +1,90 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import torch
+import torch.multiprocessing
+
+from reward_analyzer.sparse_codes_training.metrics.assignment import match_features
+from reward_analyzer.sparse_codes_training.metrics.cosine_similarity import BlockwiseCosineSimilarity
+
+def calculate_MMCS_hungarian(small_weights, big_weights, tile_size=4096):
+    """
+    Matches each small dictionary feature to a distinct big dictionary feature, maximizing the total cosine
+    similarity. Weights are [d, num_features]. The cost matrix is the only full size matrix, filled tile by tile.
+    """
+    mean_mmcs, sorted_indices, _ = calculate_MMCS_matching(
+        small_weights, big_weights, method='hungarian', tile_size=tile_size
+    )
+    return mean_mmcs, sorted_indices
 
-from scipy.optimize import linear_sum_assignment
-
-def calculate_MMCS_hungarian(small_weights, big_weights):
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-    small_weights = torch.tensor(small_weights).to(device)
-    big_weights = torch.tensor(big_weights).to(device)
-
-    small_weights_norm = torch.nn.functional.normalize(small_weights, p=2, dim=0)
-    big_weights_norm = torch.nn.functional.normalize(big_weights, p=2, dim=0)
-    cos_sims = torch.mm(small_weights_norm.T, big_weights_norm)
-    cos_sims_np = 1 - cos_sims.cpu().numpy()
-    row_ind, col_ind = linear_sum_assignment(cos_sims_np)
-    max_cosine_similarities = 1 - cos_sims_np[row_ind, col_ind]
+def calculate_MMCS_matching(
+        small_weights, big_weights, method='auto', tile_size=4096, k=10, exact_max_size=4096 * 8192
+):
+    """
+    Like calculate_MMCS_hungarian, with the matching methods of match_features: 'hungarian', 'greedy',
+    'auction', or 'auto' (exact below exact_max_size similarities, auction above).
+
+    Returns:
+    The MMCS, the small features sorted by decreasing matched similarity, and a bound on how far
+    the MMCS can be below that of the exact matching.
+    """
+    matching = match_features(
+        np.asarray(small_weights).T, np.asarray(big_weights).T, method=method, tile_size=tile_size, k=k,
+        exact_max_size=exact_max_size
+    )
+    sorted_indices = np.argsort(matching.similarities)[::-1]
+    return matching.mean_similarity, sorted_indices, matching.error_bound
+
+def calculate_MMCS_max(small_weights, big_weights, tile_size=4096):
+    """
+    The mean over small dictionary features of their max cosine similarity with any big dictionary feature,
+    without requiring distinct matches. Memory is bounded by the tile size.
+    """
+    similarity = BlockwiseCosineSimilarity(np.asarray(small_weights).T, np.asarray(big_weights).T, tile_size=tile_size)
+    max_cosine_similarities, _, _, _ = similarity.get_maxima()
     mean_mmcs = np.mean(max_cosine_similarities)
     sorted_indices = np.argsort(max_cosine_similarities)[::-1]
 
     return mean_mmcs, sorted_indices
 
-def compare_autoencoders(small_dict, big_dict, top_k=30):
-    mmcs_results = {}
-
+matching_methods = ['hungarian', 'greedy', 'auction', 'auto']
+
+def match_layer(
+        small_weights, big_weights, method='hungarian', tile_size=4096, candidates_k=10, exact_max_size=4096 * 8192,
+        device=None
+):
+    """
+    Matches the [num_features, d] encoder weights of a small and a big autoencoder with the given method.
+
+    Returns:
+    The big feature matched to each small feature, their cosine similarities, the bound on the error
+    against exact matching (None for 'max', where big features can be matched more than once),
+    and the method used, which 'auto' resolves per layer.
+    """
+    if method == 'max':
+        row_max, row_argmax, _, _ = BlockwiseCosineSimilarity(
+            small_weights, big_weights, tile_size=tile_size, device=device
+        ).get_maxima()
+        return row_argmax, row_max, None, method
+
+    matching = match_features(
+        small_weights, big_weights, method=method, tile_size=tile_size, k=candidates_k,
+        exact_max_size=exact_max_size, device=device
+    )
+    return matching.col_ind, matching.similarities, matching.error_bound, matching.method
+
+def match_layer_in_worker(small_weights, big_weights, num_threads, match_kwargs):
+    """
+    Runs match_layer in a pool worker on weights in shared memory, with its share of the cpu threads.
+    """
+    torch.set_num_threads(num_threads)
+    return match_layer(small_weights, big_weights, device='cpu', **match_kwargs)
+
+def get_layer_pairs(small_dict, big_dict):
+    """
+    Returns the layer names with the small and big autoencoder of each, from dicts of lists of autoencoders.
+    """
     small_autoencoders_list_of_lists = list(small_dict.values())
     big_autoencoders_list_of_lists = list(big_dict.values())
 
@@ -34,21 +96,118 @@ def compare_autoencoders(small_dict, big_dict, top_k=30):
     if len(small_autoencoders_list) != len(big_autoencoders_list):
         raise ValueError("Length of small and big autoencoders lists must be the same length.")
 
-    for layer_name, (small_autoencoder, big_autoencoder) in zip(layer_names, zip(small_autoencoders_list, big_autoencoders_list)):
-        small_weights = small_autoencoder.encoder[0].weight.detach().cpu().numpy().T
-        big_weights = big_autoencoder.encoder[0].weight.detach().cpu().numpy().T
-
-        MMCS_value, sorted_indices = calculate_MMCS_hungarian(small_weights, big_weights)
-
-        top_k_indices = sorted_indices[:top_k].tolist()
-
-        mmcs_results[layer_name] = MMCS_value
-
-    averaged_mmcs = np.mean(list(mmcs_results.values()))
-
-    result = {
-        "averaged_mmcs": averaged_mmcs,
-        "per_layer_mmcs": mmcs_results
+    return list(zip(layer_names, small_autoencoders_list, big_autoencoders_list))
+
+def get_encoder_weights(autoencoder, shared=False):
+    weights = autoencoder.encoder[0].weight.detach().to('cpu', dtype=torch.float32)
+    # Tensors in shared memory reach pool workers as handles to the same memory, not as pickled copies.
+    return weights.clone().share_memory_() if shared else weights
+
+def build_match_table(layer_matches):
+    """
+    Builds a columnar table of every layer's matches, as a dict of equal length numpy arrays:
+    layer, small_feature, big_feature and cosine, in order of layer then small feature.
+    """
+    layer_names = list(layer_matches)
+    num_features = [len(col_ind) for col_ind, _ in layer_matches.values()]
+    return {
+        'layer': np.repeat(np.array(layer_names, dtype=str), num_features),
+        'small_feature': np.concatenate([np.arange(count, dtype=np.int64) for count in num_features]),
+        'big_feature': np.concatenate([np.asarray(col_ind, dtype=np.int64) for col_ind, _ in layer_matches.values()]),
+        'cosine': np.concatenate([
+            np.asarray(similarities, dtype=np.float32) for _, similarities in layer_matches.values()
+        ])
     }
 
-    return result
\ No newline at end of file
+def compare_autoencoder_pairs(
+        comparisons, top_k=30, method='hungarian', tile_size=4096, candidates_k=10, exact_max_size=4096 * 8192,
+        num_workers=1
+):
+    """
+    Computes the MMCS of several comparisons at once, each a (small_dict, big_dict) pair keyed by a label,
+    eg. the base and rlhf autoencoders. With num_workers > 1 (0 or None for every core), all layers of all comparisons
+    are matched concurrently in a pool of processes, which read the encoder weights from shared memory.
+
+    Returns:
+    The result of compare_autoencoders for each label, and the match table (see build_match_table) of each label.
+    """
+    if method != 'max' and method not in matching_methods:
+        raise ValueError(f'MMCS method {method} not supported!')
+
+    match_kwargs = {
+        'method': method, 'tile_size': tile_size, 'candidates_k': candidates_k, 'exact_max_size': exact_max_size
+    }
+    tasks = [
+        (label, layer_name, small_autoencoder, big_autoencoder)
+        for label, (small_dict, big_dict) in comparisons.items()
+        for layer_name, small_autoencoder, big_autoencoder in get_layer_pairs(small_dict, big_dict)
+    ]
+    num_workers = min(num_workers or os.cpu_count(), len(tasks))
+
+    if num_workers > 1:
+        num_threads = max(os.cpu_count() // num_workers, 1)
+        # Spawned workers start without any cuda state or thread pools of this process.
+        with ProcessPoolExecutor(
+                max_workers=num_workers, mp_context=torch.multiprocessing.get_context('spawn')
+        ) as executor:
+            futures = [
+                executor.submit(
+                    match_layer_in_worker, get_encoder_weights(small_autoencoder, shared=True),
+                    get_encoder_weights(big_autoencoder, shared=True), num_threads, match_kwargs
+                )
+                for _, _, small_autoencoder, big_autoencoder in tasks
+            ]
+            matches = [future.result() for future in futures]
+    else:
+        matches = [
+            match_layer(get_encoder_weights(small_autoencoder), get_encoder_weights(big_autoencoder), **match_kwargs)
+            for _, _, small_autoencoder, big_autoencoder in tasks
+        ]
+
+    results, match_tables = {}, {}
+    for label in comparisons:
+        mmcs_results, mmcs_error_bounds, mmcs_top_k_features, mmcs_methods, layer_matches = {}, {}, {}, {}, {}
+        for (task_label, layer_name, _, _), (col_ind, similarities, error_bound, layer_method) in zip(tasks, matches):
+            if task_label != label:
+                continue
+            sorted_indices = np.argsort(similarities)[::-1]
+            mmcs_results[layer_name] = float(np.mean(similarities))
+            mmcs_top_k_features[layer_name] = sorted_indices[:top_k].tolist()
+            if error_bound is not None:
+                mmcs_error_bounds[layer_name] = error_bound
+            mmcs_methods[layer_name] = layer_method
+            layer_matches[layer_name] = (col_ind, similarities)
+
+        averaged_mmcs = np.mean(list(mmcs_results.values()))
+
+        result = {
+            "averaged_mmcs": averaged_mmcs,
+            "per_layer_mmcs": mmcs_results,
+            "per_layer_top_k_features": mmcs_top_k_features
+        }
+        if mmcs_error_bounds:
+            result["per_layer_mmcs_error_bound"] = mmcs_error_bounds
+        if any(layer_method != 'hungarian' for layer_method in mmcs_methods.values()):
+            # Record which layers are not exact matchings, so approximate results are never mistaken for exact ones.
+            result["per_layer_mmcs_method"] = mmcs_methods
+
+        results[label] = result
+        match_tables[label] = build_match_table(layer_matches)
+
+    return results, match_tables
+
+def compare_autoencoders(
+        small_dict, big_dict, top_k=30, method='hungarian', tile_size=4096, candidates_k=10, exact_max_size=4096 * 8192,
+        num_workers=1
+):
+    """
+    Computes the MMCS between the small and big autoencoders of each layer, with the given method:
+    'max' for the mean max cosine similarity, or a matching method of calculate_MMCS_matching,
+    whose error bounds against exact matching are reported per layer. Also reports the top_k small features
+    with the most similar matches per layer. See compare_autoencoder_pairs for num_workers and the match tables.
+    """
+    results, _ = compare_autoencoder_pairs(
+        {'mmcs': (small_dict, big_dict)}, top_k=top_k, method=method, tile_size=tile_size,
+        candidates_k=candidates_k, exact_max_size=exact_max_size, num_workers=num_workers
+    )
+    return results['mmcs']
@@ -0,0 +1,100 @@
+"""
+Behaviour shared by SparseAutoencoder and MultiSparseAutoencoder: accumulating training losses on device,
+and deciding when tied-weight decoders should decode sparsely.
+"""
+import time
+from typing import List, Union
+
+import torch
+
+from reward_analyzer.utils.metrics_sink import log_metrics
+
+
+class TrainingMetricsMixin:
+    """
+    Accumulates the losses of training steps in tensors on the autoencoder's device, and only copies them
+    to the host (which waits for the device) every metrics_flush_steps steps, and at the end of an epoch.
+
+    The losses of a step are a [4] tensor for one autoencoder, or a [4, K] tensor for K autoencoders trained
+    together, holding the total, reconstruction, sparsity and true sparsity (L0) losses.
+    """
+    metric_names = ('loss', 'normalized_reconstruction_loss', 'sparsity_loss', 'true_sparsity_loss')
+
+    def start_epoch(self, metrics_flush_steps: int = 100):
+        """
+        Resets the losses accumulated over an epoch.
+        """
+        self.metrics_flush_steps = metrics_flush_steps
+        self.epoch_metric_sums = None
+        self.window_metric_sums = None
+        self.last_metrics = None
+        self.num_epoch_steps = 0
+        self.num_window_steps = 0
+        self.epoch_start_time = time.perf_counter()
+
+    def record_metrics(self, metrics: torch.Tensor, label: Union[str, List[str]]):
+        """
+        Adds the losses of a step to the epoch and window sums, flushing the window when it is full.
+        """
+        self.last_metrics = metrics.detach()
+        if self.epoch_metric_sums is None:
+            self.epoch_metric_sums = torch.zeros_like(self.last_metrics)
+            self.window_metric_sums = torch.zeros_like(self.last_metrics)
+        self.epoch_metric_sums += self.last_metrics
+        self.window_metric_sums += self.last_metrics
+        self.num_epoch_steps += 1
+        self.num_window_steps += 1
+
+        if self.num_window_steps >= self.metrics_flush_steps:
+            self.flush_metrics(label)
+
+    def flush_metrics(self, label: Union[str, List[str]]):
+        """
+        Logs the mean losses of each autoencoder over the steps since the last flush, under its label.
+        """
+        if not self.num_window_steps:
+            return
+
+        labels = [label] if isinstance(label, str) else label
+        # Indexing keeps the means on device, so nothing waits for them here.
+        means = (self.window_metric_sums / self.num_window_steps).reshape(len(self.metric_names), len(labels))
+        metrics = {}
+        for index, autoencoder_label in enumerate(labels):
+            for metric_index, metric_name in enumerate(self.metric_names):
+                metrics[f"{metric_name}_{autoencoder_label}"] = means[metric_index, index]
+        log_metrics(metrics)
+
+        self.window_metric_sums.zero_()
+        self.num_window_steps = 0
+
+    def get_steps_per_second(self) -> float:
+        return self.num_epoch_steps / (time.perf_counter() - self.epoch_start_time)
+
+
+class SparseDecodeMixin:
+    """
+    Decides whether tied-weight decoders use a sparse-dense matmul: once at least sparse_decode_min_sparsity
+    of the features are zero. The fraction is measured every sparse_decode_check_interval decodes,
+    as measuring it waits for the device. A sparse_decode_min_sparsity of None always decodes densely.
+    """
+    def init_sparse_decode(self, sparse_decode_min_sparsity: float = None, sparse_decode_check_interval: int = 50):
+        self.sparse_decode_min_sparsity = sparse_decode_min_sparsity
+        self.sparse_decode_check_interval = sparse_decode_check_interval
+        self.measured_sparsity = None
+        self.num_decodes = 0
+
+    def use_sparse_decode(self, features):
+        """
+        Returns whether the tied decoder should use the sparse path, re-measuring the sparsity of features
+        (a tensor, or a list of tensors decoded together) every sparse_decode_check_interval calls.
+        """
+        if not self.tied_weights or self.sparse_decode_min_sparsity is None:
+            return False
+
+        if self.measured_sparsity is None or self.num_decodes % self.sparse_decode_check_interval == 0:
+            features = features if isinstance(features, (list, tuple)) else [features]
+            num_nonzero = sum(group_features.count_nonzero() for group_features in features).item()
+            num_features = sum(group_features.numel() for group_features in features)
+            self.measured_sparsity = 1 - num_nonzero / max(num_features, 1)
+        self.num_decodes += 1
+        return self.measured_sparsity >= self.sparse_decode_min_sparsity
@@ -0,0 +1,209 @@
+"""
+Many sparse autoencoders on the same input size, trained together on shared activation batches.
+"""
+import math
+from typing import List
+
+import torch
+
+from torch import nn
+
+from reward_analyzer.sparse_codes_training.models.autoencoder_mixins import SparseDecodeMixin, TrainingMetricsMixin
+from reward_analyzer.sparse_codes_training.models.sparse_autoencoder import SparseAutoencoder
+from reward_analyzer.utils.metrics_sink import log_metrics
+
+
+class MultiSparseAutoencoder(TrainingMetricsMixin, SparseDecodeMixin, nn.Module):
+    """
+    K sparse autoencoders with their own hidden sizes and l1 coefficients, eg. the settings of a sweep.
+
+    Autoencoders of the same hidden size are grouped, and the weights of each group are stacked,
+    so a training step runs a few batched matmuls over one shared activation batch instead of K forward passes.
+    Each autoencoder's parameters only receive gradients from its own loss, so training them with
+    one Adam optimizer is the same as training each with its own.
+    With tied weights and sparse_decode_min_sparsity, mostly zero features are decoded sparsely, as in SparseAutoencoder.
+    """
+    def __init__(
+            self, input_size: int, hidden_sizes: List[int], l1_coefs: List[float], tied_weights=True,
+            sparse_decode_min_sparsity: float = None, sparse_decode_check_interval: int = 50
+    ):
+        super().__init__()
+        if len(hidden_sizes) != len(l1_coefs):
+            raise ValueError('Each autoencoder needs a hidden size and an l1_coef.')
+
+        self.input_size = input_size
+        self.hidden_sizes = list(hidden_sizes)
+        self.l1_coefs = [float(l1_coef) for l1_coef in l1_coefs]
+        self.tied_weights = tied_weights
+        self.num_autoencoders = len(hidden_sizes)
+        self.init_sparse_decode(sparse_decode_min_sparsity, sparse_decode_check_interval)
+
+        # For each group, the hidden size and the indices of its autoencoders.
+        self.group_hidden_sizes = sorted(set(self.hidden_sizes))
+        self.group_members = [
+            [index for index, hidden_size in enumerate(self.hidden_sizes) if hidden_size == group_hidden_size]
+            for group_hidden_size in self.group_hidden_sizes
+        ]
+        # Maps the concatenated outputs of all groups back to the original autoencoder order.
+        self.register_buffer(
+            'output_order', torch.argsort(torch.tensor([index for members in self.group_members for index in members]))
+        )
+
+        self.encoder_weights = nn.ParameterList()
+        self.encoder_biases = nn.ParameterList()
+        self.decoder_weights = nn.ParameterList()
+        self.decoder_biases = nn.ParameterList()
+
+        for group_index, (hidden_size, members) in enumerate(zip(self.group_hidden_sizes, self.group_members)):
+            num_members = len(members)
+            self.encoder_weights.append(nn.Parameter(torch.empty(num_members, hidden_size, input_size)))
+            self.encoder_biases.append(nn.Parameter(torch.zeros(num_members, hidden_size)))
+            if not self.tied_weights:
+                self.decoder_weights.append(nn.Parameter(torch.empty(num_members, input_size, hidden_size)))
+            self.decoder_biases.append(nn.Parameter(torch.zeros(num_members, input_size)))
+
+            self.register_buffer(
+                f'group_l1_coefs_{group_index}', torch.tensor([self.l1_coefs[index] for index in members])
+            )
+
+        self.initialize_weights()
+        self.normalize_encoder_weights()
+
+    def initialize_weights(self):
+        """
+        Initializes each autoencoder's weights via xavier uniform, as in SparseAutoencoder.
+        """
+        for hidden_size, encoder_weight in zip(self.group_hidden_sizes, self.encoder_weights):
+            bound = math.sqrt(6.0 / (hidden_size + self.input_size))
+            nn.init.uniform_(encoder_weight, -bound, bound)
+        for hidden_size, decoder_weight in zip(self.group_hidden_sizes, self.decoder_weights):
+            bound = math.sqrt(6.0 / (hidden_size + self.input_size))
+            nn.init.uniform_(decoder_weight, -bound, bound)
+
+    @torch.no_grad()
+    def normalize_encoder_weights(self):
+        """
+        Normalizes each row of every encoder weight to unit norm, in place.
+        """
+        for encoder_weight in self.encoder_weights:
+            encoder_weight.div_(encoder_weight.norm(p=2, dim=-1, keepdim=True).clamp_min(1e-12))
+
+    def decode_group(self, group_index: int, features, sparse: bool = False):
+        """
+        Reconstructs activations from the [group size, batch, hidden size] features of a group,
+        with the sparse tied decoder if sparse is set.
+        """
+        if not self.tied_weights:
+            reconstruction = torch.matmul(features, self.decoder_weights[group_index].transpose(1, 2))
+            return reconstruction + self.decoder_biases[group_index].unsqueeze(1)
+
+        encoder_weight = self.encoder_weights[group_index]
+        if sparse:
+            reconstruction = torch.stack([
+                torch.sparse.mm(member_features.to_sparse(), member_weight)
+                for member_features, member_weight in zip(features, encoder_weight)
+            ])
+        else:
+            reconstruction = torch.matmul(features, encoder_weight)
+        return reconstruction + self.decoder_biases[group_index].unsqueeze(1)
+
+    def forward(self, x, sparse: bool = None):
+        """
+        Runs all autoencoders on a batch of activations, flattened to [batch, input_size].
+        sparse forces the sparse or dense tied decoder, otherwise it follows use_sparse_decode on all features.
+
+        Returns:
+        Per group, the [group size, batch, hidden size] features and [group size, batch, input size] reconstructions.
+        """
+        x = x.reshape(-1, self.input_size).to(dtype=self.encoder_weights[0].dtype)
+        all_features = [
+            torch.relu(torch.matmul(x, encoder_weight.transpose(1, 2)) + encoder_bias.unsqueeze(1))
+            for encoder_weight, encoder_bias in zip(self.encoder_weights, self.encoder_biases)
+        ]
+
+        if sparse is None:
+            sparse = self.use_sparse_decode(all_features)
+        all_reconstructions = [
+            self.decode_group(group_index, features, sparse=sparse) for group_index, features in enumerate(all_features)
+        ]
+        return all_features, all_reconstructions
+
+    def compute_losses(self, x):
+        """
+        Returns the [num_autoencoders] total, reconstruction, sparsity and true sparsity (L0) losses,
+        defined per autoencoder as in SparseAutoencoder.training_step.
+        """
+        all_features, all_reconstructions = self.forward(x)
+        x = x.reshape(-1, self.input_size).to(dtype=self.encoder_weights[0].dtype)
+
+        losses = []
+        for group_index, (features, reconstruction) in enumerate(zip(all_features, all_reconstructions)):
+            reconstruction_loss = (reconstruction - x.unsqueeze(0)).pow(2).mean(dim=(1, 2))
+            l1_coefs = getattr(self, f'group_l1_coefs_{group_index}')
+            sparsity_loss = l1_coefs * features.abs().sum(dim=-1).mean(dim=-1)
+            true_sparsity_loss = (features != 0).sum(dim=-1).to(dtype=features.dtype).mean(dim=-1)
+            losses.append(
+                torch.stack([reconstruction_loss + sparsity_loss, reconstruction_loss, sparsity_loss, true_sparsity_loss])
+            )
+
+        return torch.cat(losses, dim=1)[:, self.output_order]
+
+    def define_metrics(self, labels: List[str]):
+        for label in labels:
+            SparseAutoencoder.define_metrics(label)
+
+    def training_step(self, data, optimizer, label: List[str]):
+        """
+        Runs one optimization step of all autoencoders on a shared batch of activations, and records their losses.
+        The reconstruction loss is the mean squared error. label has one label per autoencoder.
+        """
+        optimizer.zero_grad()
+        metrics = self.compute_losses(data)
+        # Summing makes each autoencoder's gradient that of its own loss.
+        metrics[0].sum().backward()
+        optimizer.step()
+        self.normalize_encoder_weights()
+
+        self.record_metrics(metrics, label)
+
+    def end_epoch(self, epoch: int, num_epochs: int, label: List[str]):
+        """
+        Flushes and prints the losses accumulated over an epoch, and the training steps per second.
+        """
+        self.flush_metrics(label)
+        if not self.num_epoch_steps:
+            print(f"Epoch [{epoch+1}/{num_epochs}] had no batches.")
+            return
+
+        average_losses = (self.epoch_metric_sums[0] / self.num_epoch_steps).tolist()
+        steps_per_second = self.get_steps_per_second()
+        log_metrics({f"steps_per_second_{label[0]}_sweep": steps_per_second})
+
+        print(f"Epoch [{epoch+1}/{num_epochs}] on {len(label)} autoencoders, {steps_per_second:.1f} steps/s")
+        for autoencoder_label, average_loss in zip(label, average_losses):
+            print(f"Loss on {autoencoder_label}: {average_loss:.4f}")
+
+    @torch.no_grad()
+    def to_autoencoders(self) -> List[SparseAutoencoder]:
+        """
+        Splits the stacked weights into K separate SparseAutoencoders, in the original order.
+        """
+        autoencoders = [None] * self.num_autoencoders
+        for group_index, members in enumerate(self.group_members):
+            for member_index, index in enumerate(members):
+                autoencoder = SparseAutoencoder(
+                    self.input_size, hidden_size=self.hidden_sizes[index], l1_coef=self.l1_coefs[index],
+                    tied_weights=self.tied_weights, sparse_decode_min_sparsity=self.sparse_decode_min_sparsity,
+                    sparse_decode_check_interval=self.sparse_decode_check_interval
+                ).to(self.encoder_weights[group_index].device)
+
+                autoencoder.encoder[0].weight.copy_(self.encoder_weights[group_index][member_index])
+                autoencoder.encoder[0].bias.copy_(self.encoder_biases[group_index][member_index])
+                if self.tied_weights:
+                    autoencoder.bias.copy_(self.decoder_biases[group_index][member_index])
+                else:
+                    autoencoder.decoder.weight.copy_(self.decoder_weights[group_index][member_index])
+                    autoencoder.decoder.bias.copy_(self.decoder_biases[group_index][member_index])
+
+                autoencoders[index] = autoencoder
+        return autoencoders
@@ -2,9 +2,7 @@
 A sparse autoencoder, trained on activations of an LLM on a dataset.
 """
 
-import numpy as np
 import torch
-import torch.nn.functional as F
 import wandb
 
 from torch import nn
@@ -12,14 +10,24 @@ from torch import optim
 from tqdm import tqdm
 from typing import List
 
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_cache import ActivationCache
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_prefetcher import ActivationPrefetcher
 from reward_analyzer.sparse_codes_training.experiment_helpers.layer_activations_handler import LayerActivationsHandler
-from reward_analyzer.utils.transformer_utils import batch
+from reward_analyzer.sparse_codes_training.experiment_helpers.sharded_activation_loader import (
+    ShardedActivationLoader, write_missing_cache_entries
+)
+from reward_analyzer.sparse_codes_training.experiment_helpers.tokenized_dataset import TokenizedDataset
+from reward_analyzer.sparse_codes_training.models.autoencoder_mixins import SparseDecodeMixin, TrainingMetricsMixin
+from reward_analyzer.utils.metrics_sink import log_metrics
 
-class SparseAutoencoder(nn.Module):
+class SparseAutoencoder(TrainingMetricsMixin, SparseDecodeMixin, nn.Module):
     """
     This autoencoder is trained on activations of a LLM on a dataset.
     """
-    def __init__(self, input_size: int, hidden_size: int, l1_coef: float, tied_weights=True):
+    def __init__(
+            self, input_size: int, hidden_size: int, l1_coef: float, tied_weights=True,
+            sparse_decode_min_sparsity: float = None, sparse_decode_check_interval: int = 50
+    ):
         super().__init__()
         self.hidden_size = hidden_size
         self.input_size = input_size
@@ -28,6 +36,9 @@ class SparseAutoencoder(nn.Module):
         self.kwargs = {'input_size': input_size, 'hidden_size': hidden_size, 'l1_coef': l1_coef}
         self.l1_coef = float(l1_coef)
 
+        # With tied weights, decode with a sparse-dense matmul once at least this fraction of features is zero.
+        self.init_sparse_decode(sparse_decode_min_sparsity, sparse_decode_check_interval)
+
         # Encoder layers
         self.encoder = nn.Sequential(
             nn.Linear(self.input_size, self.hidden_size),
@@ -43,6 +54,7 @@ class SparseAutoencoder(nn.Module):
 
         # Initialize the linear layers
         self.initialize_weights()
+        self.normalize_encoder_weights()
 
     def initialize_weights(self):
         """
@@ -53,84 +65,198 @@ class SparseAutoencoder(nn.Module):
                 nn.init.xavier_uniform_(m.weight)
                 nn.init.zeros_(m.bias)
 
-    def forward(self, x):
+    @torch.no_grad()
+    def normalize_encoder_weights(self):
         """
-        Normalizes encoder weight, applies encoder, and then the decoder.
+        Normalizes each row of the encoder weight to unit norm, in place.
+        This is applied after every optimizer step, so forward passes always see normalized weights.
         """
-        x = x.to(dtype=self.encoder[0].weight.dtype)
-        self.encoder[0].weight.data = F.normalize(self.encoder[0].weight, p=2, dim=1)
-        features = self.encoder(x)
+        encoder_weight = self.encoder[0].weight
+        encoder_weight.div_(encoder_weight.norm(p=2, dim=1, keepdim=True).clamp_min(1e-12))
 
-        if self.tied_weights:
-            encoder_weight = self.encoder[0].weight
-            reconstruction = torch.matmul(features, encoder_weight) + self.bias
+    def encode(self, x):
+        """
+        Applies only the encoder, returning the dictionary features.
+        """
+        return self.encoder(x.to(dtype=self.encoder[0].weight.dtype))
+
+    def decode(self, features, sparse: bool = None):
+        """
+        Reconstructs activations from dictionary features.
+        With tied weights, mostly zero features are decoded with a sparse-dense matmul, which only reads
+        the encoder rows of active features. sparse forces either path, otherwise it follows use_sparse_decode.
+        """
+        if not self.tied_weights:
+            return self.decoder(features)
+
+        encoder_weight = self.encoder[0].weight
+        if sparse is None:
+            sparse = self.use_sparse_decode(features)
+
+        if sparse:
+            flat_features = features.reshape(-1, self.hidden_size)
+            reconstruction = torch.sparse.mm(flat_features.to_sparse(), encoder_weight)
+            reconstruction = reconstruction.reshape(*features.shape[:-1], self.input_size)
         else:
-            reconstruction = self.decoder(features)
+            reconstruction = torch.matmul(features, encoder_weight)
+        return reconstruction + self.bias
 
+    def forward(self, x):
+        """
+        Applies the encoder, and then the decoder.
+        """
+        features = self.encode(x)
+        reconstruction = self.decode(features)
         return features, reconstruction
 
+    @staticmethod
+    def define_metrics(label: str):
+        """
+        Defines the wandb summaries of the metrics logged while training, if there is a wandb run.
+        """
+        if wandb.run is None:
+            return
+
+        wandb.define_metric(f"loss_{label}", summary="min")
+        wandb.define_metric(f"reconstruction_loss_{label}", summary="min")
+        wandb.define_metric(f"sparsity_loss_{label}", summary="min")
+        wandb.define_metric(f"true_sparsity_loss_{label}", summary="min")
+
+        wandb.define_metric("base_mmcs_results", summary="min")
+        wandb.define_metric("rlhf_mmcs_results", summary="min")
+
+    def training_step(self, data, optimizer, label: str, criterion=None):
+        """
+        Runs one optimization step on a batch of activations, and records its losses.
+        The reconstruction loss is criterion, the mean squared error by default.
+        """
+        criterion = criterion if criterion is not None else nn.functional.mse_loss
+        optimizer.zero_grad()
+        features, reconstruction = self.forward(data)
+
+        sparsity_loss = self.l1_coef * torch.norm(features, 1, dim=-1).mean()
+        true_sparsity_loss = torch.norm(features, 0, dim=-1).mean()
+
+        reconstruction_loss = criterion(reconstruction, data)
+        loss = reconstruction_loss + sparsity_loss
+
+        loss.backward()
+        optimizer.step()
+        self.normalize_encoder_weights()
+
+        self.record_metrics(torch.stack([loss, reconstruction_loss, sparsity_loss, true_sparsity_loss]), label)
+
+    def end_epoch(self, epoch: int, num_epochs: int, label: str):
+        """
+        Flushes and prints the losses accumulated over an epoch, and the training steps per second.
+        """
+        self.flush_metrics(label)
+        if not self.num_epoch_steps:
+            print(f"Epoch [{epoch+1}/{num_epochs}] on {label} had no batches.")
+            return
+
+        avg_loss = self.epoch_metric_sums[0].item() / self.num_epoch_steps
+        reconstruction_loss, sparsity_loss, true_sparsity_loss = self.last_metrics[1:].tolist()
+        steps_per_second = self.get_steps_per_second()
+        log_metrics({f"steps_per_second_{label}": steps_per_second})
+
+        print(f"Epoch [{epoch+1}/{num_epochs}] on {label}, Loss: {avg_loss:.4f}, {steps_per_second:.1f} steps/s")
+        print(f"Final reconstruction Loss on {label}: {reconstruction_loss}")
+        print(f"Final sparsity Loss on {label}: {sparsity_loss}")
+        print(f"Final true sparsity loss on {label}: {true_sparsity_loss}")
 
     def train_model(
             self, input_texts: List[str], hyperparameters: dict, model_device: str,
-            autoencoder_device: str, label: str, activations_handler: LayerActivationsHandler, tokenizer, layer_name: str
+            autoencoder_device: str, label: str, activations_handler: LayerActivationsHandler, tokenizer, layer_name: str,
+            activation_cache: ActivationCache = None, tokenized_dataset: TokenizedDataset = None,
+            checkpointer=None, checkpoint_label: str = None
     ):
         """
         Train on the activations on texts.
+        If an activation cache is given, the first epoch writes activations to it,
+        and later epochs (and later runs) read them back from disk.
+        If a tokenized dataset of the input texts is given, its token ids are used instead of re-tokenizing.
+        If hyperparameters['prefetch_batches'] is set, activations are produced on a background thread
+        while the autoencoder trains on the previous batch.
+        If hyperparameters['shuffle_buffer_tokens'] is set too, the cache entry is written first,
+        and every epoch trains on shuffled token batches streamed from it, see ShardedActivationLoader.
+        With a TrainingCheckpointer, the weights, optimizer state and position in the epoch are saved under
+        checkpoint_label (label by default), and training resumes mid-epoch from the last save,
+        like AutoencoderDataPreparerAndTrainer.train_autoencoders_on_activation_batches.
         """
         criterion = nn.MSELoss()
         batch_size = hyperparameters['batch_size']
         optimizer = optim.Adam(self.parameters(), lr=hyperparameters['learning_rate'])
         num_batches = int(len(input_texts) / batch_size)
+        num_epochs = hyperparameters['num_epochs']
+        checkpoint_label = checkpoint_label or label
 
-        wandb.define_metric(f"loss_{label}", summary="min")
-        wandb.define_metric(f"reconstruction_loss_{label}", summary="min")
-        wandb.define_metric(f"sparsity_loss_{label}", summary="min")
-        wandb.define_metric(f"true_sparsity_loss_{label}", summary="min")
+        start_epoch, start_batch = 0, 0
+        if checkpointer is not None:
+            start_epoch, start_batch = checkpointer.restore_training_state(
+                checkpoint_label, {'autoencoder': self}, {'autoencoder': optimizer}
+            )
+        if start_epoch >= num_epochs:
+            return
 
-        wandb.define_metric("base_mmcs_results", summary="min")
-        wandb.define_metric("rlhf_mmcs_results", summary="min")
+        self.define_metrics(label)
 
-        for epoch in range(hyperparameters['num_epochs']):
-            all_losses = []
-            all_sparsity_losses = []
-            all_reconstruction_losses = []
-            all_true_sparsity_losses = []
+        def get_activations_batches(start_batch=0):
+            return activations_handler.iterate_layer_activations(
+                layer_name=layer_name, input_texts=input_texts, tokenizer=tokenizer,
+                device=model_device, hyperparameters=hyperparameters, activation_cache=activation_cache,
+                tokenized_dataset=tokenized_dataset, start_batch=start_batch
+            )
 
+        loader = None
+        if activation_cache is not None and hyperparameters.get('shuffle_buffer_tokens'):
+            cache_keys = activations_handler.get_cache_keys(
+                [layer_name], input_texts, tokenizer, hyperparameters, activation_cache=activation_cache,
+                dataset_hash=tokenized_dataset.dataset_hash if tokenized_dataset is not None else None
+            )
+            write_missing_cache_entries(activation_cache, cache_keys, get_activations_batches)
+            loader = ShardedActivationLoader.from_hyperparameters(activation_cache, cache_keys, hyperparameters)
+            num_batches = len(loader)
 
-            for input_batch in tqdm(batch(input_texts, batch_size), total=num_batches):
+        for epoch in range(start_epoch, num_epochs):
+            self.start_epoch(metrics_flush_steps=hyperparameters.get('metrics_flush_steps', 100))
 
-                activations_batch = activations_handler.get_layer_activations(
-                    layer_name=layer_name, input_texts=input_batch, tokenizer=tokenizer,
-                    device=model_device, hyperparameters=hyperparameters
+            # A resumed epoch starts at the checkpointed batch, without reading or extracting the batches before it.
+            first_batch = start_batch if epoch == start_epoch else 0
+            if loader is not None:
+                loader.set_epoch(epoch)
+                activations_batches = (
+                    activations[layer_name] for activations in loader.iterate(start_batch=first_batch)
                 )
-                data = activations_batch.to(autoencoder_device, dtype=torch.float32)
-
-                optimizer.zero_grad()
-                features, reconstruction = self.forward(data)
+            else:
+                activations_batches = get_activations_batches(start_batch=first_batch)
 
-                sparsity_loss = self.l1_coef * torch.norm(features, 1, dim=-1).mean()
-                true_sparsity_loss = torch.norm(features, 0, dim=-1).mean()
+            prefetcher = None
+            if hyperparameters.get('prefetch_batches'):
+                prefetcher = ActivationPrefetcher(
+                    activations_batches, max_prefetch=hyperparameters['prefetch_batches'],
+                    transform=lambda activations: activations.to(autoencoder_device, dtype=torch.float32)
+                )
+                activations_batches = prefetcher
 
-                reconstruction_loss = criterion(reconstruction, data)
-                loss = reconstruction_loss + sparsity_loss
+            for batch_index, activations_batch in enumerate(
+                tqdm(activations_batches, total=num_batches, initial=first_batch), start=first_batch
+            ):
+                data = activations_batch.to(autoencoder_device, dtype=torch.float32)
+                self.training_step(data, optimizer=optimizer, criterion=criterion, label=label)
 
-                all_losses.append(loss.cpu().detach().numpy())
-                all_reconstruction_losses.append(reconstruction_loss.cpu().detach().numpy())
-                all_sparsity_losses.append(sparsity_loss.cpu().detach().numpy())
-                all_true_sparsity_losses.append(true_sparsity_loss.cpu().detach().numpy())
+                if checkpointer is not None and checkpointer.should_save(batch_index + 1):
+                    checkpointer.save_training_state(
+                        checkpoint_label, {'autoencoder': self}, {'autoencoder': optimizer},
+                        epoch=epoch, batch_index=batch_index + 1
+                    )
 
-                loss.backward()
-                optimizer.step()
+            if prefetcher is not None:
+                log_metrics(prefetcher.report(label))
 
-                wandb.log({
-                    f"loss_{label}": loss,
-                    f"normalized_reconstruction_loss_{label}": reconstruction_loss,
-                    f"sparsity_loss_{label}": sparsity_loss,
-                    f"true_sparsity_loss_{label}": true_sparsity_loss
-                })
-            avg_loss = np.average(all_losses)
+            self.end_epoch(epoch, num_epochs=num_epochs, label=label)
 
-            print(f"Epoch [{epoch+1}/{hyperparameters['num_epochs']}] on {label}, Loss: {avg_loss:.4f}")
-            print(f"Final reconstruction Loss on {label}: {all_reconstruction_losses[-1]}")
-            print(f"Final sparsity Loss on {label}: {all_sparsity_losses[-1]}")
-            print(f"Final true sparsity loss on {label}: {all_true_sparsity_losses[-1]}")
+            if checkpointer is not None:
+                checkpointer.save_training_state(
+                    checkpoint_label, {'autoencoder': self}, {'autoencoder': optimizer}, epoch=epoch + 1, batch_index=0
+                )
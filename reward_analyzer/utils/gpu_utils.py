@@ -1,33 +1,110 @@
-import pynvml
+import os
+
+import torch
+
 
 def find_gpu_with_most_memory(min_memory: int = 10):
-    pynvml.nvmlInit()
+    if not torch.cuda.is_available():
+        print("No CUDA devices available.")
+        return None
 
-    one_gb = 1024*1024*1024
-    device_count = pynvml.nvmlDeviceGetCount()
+    # Imported here, so that NVML is only initialized when a GPU is actually being picked.
+    import pynvml
 
-    if device_count == 0:
-        print("No NVIDIA GPUs found.")
+    try:
+        pynvml.nvmlInit()
+    except pynvml.NVMLError as error:
+        print(f"Could not initialize NVML: {error}")
         return None
 
-    max_memory = 0
-    max_gpu_index = 0
+    one_gb = 1024*1024*1024
+    try:
+        device_count = pynvml.nvmlDeviceGetCount()
+
+        if device_count == 0:
+            print("No NVIDIA GPUs found.")
+            return None
 
-    for i in range(device_count):
-        handle = pynvml.nvmlDeviceGetHandleByIndex(i)
-        gpu_info = pynvml.nvmlDeviceGetMemoryInfo(handle)
+        max_memory = 0
+        max_gpu_index = 0
 
-        free_memory = round(gpu_info.free / one_gb, 2)
+        for i in range(device_count):
+            handle = pynvml.nvmlDeviceGetHandleByIndex(i)
+            gpu_info = pynvml.nvmlDeviceGetMemoryInfo(handle)
 
-        if free_memory > max_memory:
-            max_memory = free_memory
-            max_gpu_index = i
+            free_memory = round(gpu_info.free / one_gb, 2)
 
-    pynvml.nvmlShutdown()
+            if free_memory > max_memory:
+                max_memory = free_memory
+                max_gpu_index = i
+    finally:
+        pynvml.nvmlShutdown()
 
     if max_memory > min_memory:
         print(f'Found GPU {max_gpu_index} with {max_memory} GB available.')
         return f'cuda:{max_gpu_index}'
     else:
         print("No NVIDIA GPUs with sufficient memory found.")
-        return None
\ No newline at end of file
+        return None
+
+
+def get_available_cpu_count() -> int:
+    """
+    Counts the CPUs this process may run on, which can be fewer than the machine has (eg. in containers).
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class DevicePlanner:
+    """
+    Picks the devices that models and autoencoders run on, when they are first needed rather than at import time.
+
+    Without a requested device, the GPU with the most free memory is picked. If there is no GPU with enough
+    free memory, the plan falls back to the CPU, and sizes torch's intra-op thread pool to the available CPUs.
+    """
+    def __init__(self, device: str = None, min_memory: int = 10, num_threads: int = None):
+        self.requested_device = device
+        self.min_memory = min_memory
+        self.num_threads = num_threads
+
+        # Maps each role (eg. 'model', 'autoencoder') to its planned device.
+        self.planned_devices = {}
+
+    def plan_device(self) -> str:
+        device = self.requested_device or find_gpu_with_most_memory(min_memory=self.min_memory) or 'cpu'
+        if device == 'cpu':
+            self.configure_cpu_threads()
+        return device
+
+    def get_device(self, role: str = 'model') -> str:
+        """
+        Plans the device of a role the first time it is asked for, and returns the same device afterwards.
+        Roles are planned separately, so eg. autoencoders planned after the models are loaded
+        see the GPU memory that the models use.
+        """
+        if role not in self.planned_devices:
+            self.planned_devices[role] = self.plan_device()
+            print(f'Placing {role} on {self.planned_devices[role]}')
+        return self.planned_devices[role]
+
+    def configure_cpu_threads(self) -> int:
+        num_threads = self.num_threads or get_available_cpu_count()
+        if torch.get_num_threads() != num_threads:
+            print(f'Using {num_threads} CPU threads')
+            torch.set_num_threads(num_threads)
+        return num_threads
+
+
+_default_device_planner = None
+
+
+def get_default_device_planner() -> DevicePlanner:
+    """
+    Returns the process wide device planner, used where no device is passed in explicitly.
+    """
+    global _default_device_planner
+    if _default_device_planner is None:
+        _default_device_planner = DevicePlanner()
+    return _default_device_planner
@@ -0,0 +1,122 @@
+"""
+Manages the forward hooks used to capture layer activations, so that hooks are
+registered once per layer, live only as long as they are needed, and can be listed.
+"""
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+import torch
+
+
+class StopForward(Exception):
+    """
+    Raised by a forward hook to end a forward pass once all needed activations are captured.
+    """
+
+
+def stop_forward_hook(module, input, output):
+    raise StopForward()
+
+
+class HookManager:
+    """
+    Owns the forward hooks registered on a model.
+
+    Capture hooks write each layer's latest output into a single reusable buffer, self.activations.
+    Within capture_layers, there is one persistent capture hook per layer no matter how many forward
+    passes are run, and all hooks registered by the context are removed when it exits.
+    A stop hook can be placed after the deepest captured layer, to skip the rest of the forward pass.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.named_modules = dict(model.named_modules())
+        self.module_positions = {name: position for position, name in enumerate(self.named_modules)}
+
+        # Maps (kind, module name) to its hook handle.
+        self.hook_handles: Dict[Tuple[str, str], torch.utils.hooks.RemovableHandle] = {}
+        self.activations = {}
+
+    def get_capture_hook_fn(self, layer_name: str) -> Callable:
+        def hook_fn(module, input, output):
+            self.activations[layer_name] = output
+        return hook_fn
+
+    def add_hook(self, module_name: str, hook_fn: Callable, kind: str = 'capture'):
+        """
+        Registers a forward hook on a module, unless one of the same kind is already registered there.
+        Returns whether a new hook was registered.
+        """
+        if (kind, module_name) in self.hook_handles:
+            return False
+        self.hook_handles[(kind, module_name)] = self.named_modules[module_name].register_forward_hook(hook_fn)
+        return True
+
+    def remove_hook(self, module_name: str, kind: str = 'capture'):
+        hook_handle = self.hook_handles.pop((kind, module_name), None)
+        if hook_handle is not None:
+            hook_handle.remove()
+
+    def remove_all_hooks(self):
+        for kind, module_name in list(self.hook_handles):
+            self.remove_hook(module_name, kind=kind)
+
+    def get_deepest_module_name(self, module_names: List[str]) -> str:
+        return max(module_names, key=lambda name: self.module_positions[name])
+
+    def add_stop_hook(self, module_names: List[str]):
+        """
+        Stops forward passes right after the deepest of the given modules.
+        Returns whether a new hook was registered.
+        """
+        deepest_module_name = self.get_deepest_module_name(module_names)
+        stop_hooks = [module_name for kind, module_name in self.hook_handles if kind == 'stop']
+        if stop_hooks and stop_hooks != [deepest_module_name]:
+            raise ValueError(f'A forward pass already stops at {stop_hooks}, before or after {deepest_module_name}.')
+        return self.add_hook(deepest_module_name, stop_forward_hook, kind='stop')
+
+    def get_live_hooks(self) -> List[Tuple[str, str]]:
+        """
+        Lists the (kind, module name) of all hooks currently registered by this manager.
+        """
+        return sorted(self.hook_handles, key=lambda key: (self.module_positions[key[1]], key[0]))
+
+    def count_module_hooks(self) -> int:
+        """
+        Counts all forward hooks on the model's modules, including those not registered by this manager.
+        """
+        return sum(len(module._forward_hooks) for module in self.named_modules.values())
+
+    @contextmanager
+    def capture_layers(self, layer_names: List[str], early_exit: bool = False):
+        """
+        Within this context, every forward pass writes the outputs of the given layers into self.activations.
+        Hooks that already exist (eg. from an enclosing context) are reused, and only hooks registered
+        by this context are removed when it exits.
+        """
+        registered = []
+        try:
+            for layer_name in layer_names:
+                if self.add_hook(layer_name, self.get_capture_hook_fn(layer_name)):
+                    registered.append(('capture', layer_name))
+
+            # Capture hooks are registered first, so they run before the stop hook on the same module.
+            if early_exit and self.add_stop_hook(layer_names):
+                registered.append(('stop', self.get_deepest_module_name(layer_names)))
+
+            yield self.activations
+        finally:
+            for kind, module_name in registered:
+                self.remove_hook(module_name, kind=kind)
+
+    def run_forward(self, *args, **kwargs):
+        """
+        Runs a forward pass without gradients, allowing it to be stopped early by a stop hook.
+        The capture buffer is cleared first, and returned afterwards.
+        """
+        self.activations.clear()
+        with torch.no_grad():
+            try:
+                self.model(*args, **kwargs)
+            except StopForward:
+                pass
+        return self.activations
@@ -0,0 +1,214 @@
+"""
+Buffers logged metrics in memory and writes them to one or more backends (local JSONL or SQLite files,
+and optionally wandb) in batches from a background thread, so that logging does not block training.
+"""
+import atexit
+import json
+import numbers
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Dict, List
+
+import numpy as np
+import torch
+import wandb
+
+
+def to_loggable(value):
+    """
+    Converts tensors and numpy values into plain python values, recursing into dictionaries and lists.
+    Single element tensors become scalars, so this is where a device sync happens, on the flushing thread.
+    """
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu()
+        return value.item() if value.numel() == 1 else value.tolist()
+    if isinstance(value, np.ndarray):
+        return value.item() if value.size == 1 else value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {str(key): to_loggable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_loggable(item) for item in value]
+    return value
+
+
+class MetricsBackend:
+    """
+    A destination for batches of metric records, each a dictionary with 'step', 'timestamp' and 'metrics'.
+    """
+    def write(self, records: List[dict]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JsonlMetricsBackend(MetricsBackend):
+    """
+    Appends one JSON line per record to a file.
+    """
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.file = open(path, 'a')
+
+    def write(self, records: List[dict]):
+        for record in records:
+            self.file.write(json.dumps(record, default=str) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class SqliteMetricsBackend(MetricsBackend):
+    """
+    Writes one row per (record, metric name) to a metrics table, with numbers stored as numbers,
+    and other values (eg. dictionaries of results per layer) stored as JSON.
+    """
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        # Created on the constructing thread, and used from the flushing thread.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS metrics (step INTEGER, timestamp REAL, name TEXT, value)'
+        )
+        self.connection.commit()
+
+    def write(self, records: List[dict]):
+        rows = []
+        for record in records:
+            for name, value in record['metrics'].items():
+                if not isinstance(value, numbers.Number):
+                    value = json.dumps(value, default=str)
+                rows.append((record['step'], record['timestamp'], name, value))
+        self.connection.executemany('INSERT INTO metrics VALUES (?, ?, ?, ?)', rows)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class WandbMetricsBackend(MetricsBackend):
+    """
+    Logs each record to the current wandb run, in order.
+    """
+    def write(self, records: List[dict]):
+        for record in records:
+            wandb.log(record['metrics'])
+
+
+class MetricsSink:
+    """
+    Collects metrics with log(), which only appends to an in-memory buffer, and writes them to its backends
+    in batches on a background thread: every flush_interval seconds, or as soon as max_buffer_size
+    records are waiting. Tensor values are converted (and so synced) on the background thread too.
+    """
+    def __init__(self, backends: List[MetricsBackend], flush_interval: float = 5.0, max_buffer_size: int = 1000):
+        self.backends = backends
+        self.flush_interval = flush_interval
+        self.max_buffer_size = max_buffer_size
+
+        self.buffer = deque()
+        self.step = 0
+        self.flush_lock = threading.Lock()
+        self.flush_requested = threading.Event()
+        self.stop_event = threading.Event()
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_backend_names(cls, backend_names: List[str], metrics_dir: str = 'metrics', run_name: str = 'run', **kwargs):
+        """
+        Creates a sink from backend names: 'jsonl' and 'sqlite' write to files named after the run in metrics_dir,
+        and 'wandb' logs to the current wandb run.
+        """
+        backends = []
+        for backend_name in backend_names:
+            if backend_name == 'jsonl':
+                backends.append(JsonlMetricsBackend(os.path.join(metrics_dir, f'{run_name}.jsonl')))
+            elif backend_name == 'sqlite':
+                backends.append(SqliteMetricsBackend(os.path.join(metrics_dir, f'{run_name}.sqlite')))
+            elif backend_name == 'wandb':
+                backends.append(WandbMetricsBackend())
+            else:
+                raise ValueError(f'Metrics backend {backend_name} not supported!')
+        return cls(backends, **kwargs)
+
+    def log(self, metrics: Dict):
+        """
+        Buffers a dictionary of metrics as one record. Values may be tensors, which are not synced here.
+        """
+        self.buffer.append({'step': self.step, 'timestamp': time.time(), 'metrics': metrics})
+        self.step += 1
+        if len(self.buffer) >= self.max_buffer_size:
+            self.flush_requested.set()
+
+    def flush(self):
+        """
+        Writes all buffered records to the backends.
+        """
+        with self.flush_lock:
+            records = []
+            while self.buffer:
+                record = self.buffer.popleft()
+                record['metrics'] = to_loggable(record['metrics'])
+                records.append(record)
+
+            if records:
+                for backend in self.backends:
+                    backend.write(records)
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.flush_requested.wait(timeout=self.flush_interval)
+            self.flush_requested.clear()
+            self.flush()
+
+    def close(self):
+        """
+        Stops the background thread, writes the remaining records and closes the backends.
+        """
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        self.flush_requested.set()
+        self.thread.join()
+        self.flush()
+        for backend in self.backends:
+            backend.close()
+
+
+_metrics_sink = None
+
+
+def set_metrics_sink(metrics_sink: MetricsSink):
+    """
+    Sets the sink that log_metrics writes to, closing the previous one.
+    """
+    global _metrics_sink
+    if _metrics_sink is not None and _metrics_sink is not metrics_sink:
+        _metrics_sink.close()
+    _metrics_sink = metrics_sink
+
+
+def get_metrics_sink() -> MetricsSink:
+    """
+    Returns the current sink. If none was set, one without backends is created, which drops metrics,
+    so that autoencoders trained outside ExperimentRunner neither call wandb nor write files.
+    Set a sink, eg. MetricsSink.from_backend_names(['jsonl']), to keep them.
+    """
+    if _metrics_sink is None:
+        set_metrics_sink(MetricsSink([]))
+        atexit.register(_metrics_sink.close)
+    return _metrics_sink
+
+
+def log_metrics(metrics: Dict):
+    get_metrics_sink().log(metrics)
@@ -7,6 +7,7 @@ import shutil
 
 
 from huggingface_hub import HfApi, hf_hub_download
+import numpy as np
 import torch
 from transformers import AutoModel
 from trl import RewardTrainer
@@ -39,10 +40,37 @@ def save_models_to_folder(model_dict, save_dir):
             torch.save([model.kwargs, model.state_dict()], model_path)
             print(f"Saved {model_name} to {model_path}")
 
+def save_match_tables(match_tables, save_dir):
+    """
+    Save columnar MMCS match tables, eg. from compare_autoencoder_pairs, as one .npz file per label.
+
+    Args:
+        match_tables (dict): A dictionary of labels to dicts of column names to numpy arrays.
+        save_dir (str): The directory where tables will be saved.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+
+    for label, match_table in match_tables.items():
+        table_path = os.path.join(save_dir, f'{label}.npz')
+        np.savez(table_path, **match_table)
+        print(f"Saved {label} match table to {table_path}")
+
+def load_match_tables(load_dir):
+    """
+    Load the match tables saved by save_match_tables, as a dictionary of labels to dicts of numpy arrays.
+    """
+    match_tables = {}
+
+    for file_name in sorted(os.listdir(load_dir)):
+        with np.load(os.path.join(load_dir, file_name)) as match_table:
+            match_tables[file_name[:-len('.npz')]] = dict(match_table)
+
+    return match_tables
+
 
 def save_autoencoders_for_artifact(
         autoencoders_base_big, autoencoders_base_small, autoencoders_rlhf_big, autoencoders_rlhf_small,
-        policy_model_name, hyperparameters, alias, run, added_metadata = None
+        policy_model_name, hyperparameters, alias, run, added_metadata = None, match_tables = None
     ):
     '''
     Saves the autoencoders from one run into memory. Note that these paths are to some extent hardcoded
@@ -58,6 +86,8 @@ def save_autoencoders_for_artifact(
     save_models_to_folder(autoencoders_base_small, save_dir=f'{save_dir}/base_small')
     save_models_to_folder(autoencoders_rlhf_big, save_dir=f'{save_dir}/rlhf_big')
     save_models_to_folder(autoencoders_rlhf_small, save_dir=f'{save_dir}/rlhf_small')
+    if match_tables:
+        save_match_tables(match_tables, save_dir=f'{save_dir}/match_tables')
 
     simplified_policy_name = policy_model_name.split('/')[-1].replace("-", "_")
     artifact_name = f'{wandb_artifact_prefix}_{simplified_policy_name}'
@@ -98,10 +128,15 @@ def load_autoencoders_for_artifact(full_path, alias='latest'):
     autoencoders_rlhf_big = load_models_from_folder(f'{save_dir}/rlhf_big')
     autoencoders_rlhf_small = load_models_from_folder(f'{save_dir}/rlhf_small')
 
-    return {
+    loaded = {
         'base_big': autoencoders_base_big, 'base_small': autoencoders_base_small,
         'rlhf_big': autoencoders_rlhf_big, 'rlhf_small': autoencoders_rlhf_small
     }
+    # Artifacts saved before match tables were added have none.
+    if os.path.isdir(f'{save_dir}/match_tables'):
+        loaded['match_tables'] = load_match_tables(f'{save_dir}/match_tables')
+
+    return loaded
 
 def load_models_from_folder(load_dir):
     """
@@ -120,6 +155,8 @@ def load_models_from_folder(load_dir):
         kwargs, state = torch.load(model_path)
         model = SparseAutoencoder(**kwargs)
         model.load_state_dict(state)
+        # Older checkpoints were saved before the encoder weights were renormalized after the last step.
+        model.normalize_encoder_weights()
         model.eval()
         model_dict[model_name] = model
         print(f"Loaded {model_name} from {model_path}")
@@ -178,7 +215,10 @@ def download_folder_from_hub(folder_path: str, local_folder=None, config=Hugging
             shutil.copy(filepath, download_dir)
 
 
-def load_latest_model_from_hub(model_name: str, task_config: TaskConfig, config=HuggingfaceConfig()):
+def download_latest_model_from_hub(model_name: str, task_config: TaskConfig, config=HuggingfaceConfig()):
+    """
+    Downloads the most recent upload of a model for a task, and returns the local directory it is in.
+    """
     api = HfApi()
     # Repository details
     repo_id = config.repo_id
@@ -214,5 +254,11 @@ def load_latest_model_from_hub(model_name: str, task_config: TaskConfig, config=
             filepath = hf_hub_download(repo_id=repo_id, filename=filename, force_download=True)
             shutil.copy(filepath, download_dir)
 
-    model = AutoModel.from_pretrained(download_dir, load_in_8bit=True)
+    return download_dir
+
+def load_latest_model_from_hub(
+        model_name: str, task_config: TaskConfig, config=HuggingfaceConfig(), load_in_8bit: bool = True
+):
+    download_dir = download_latest_model_from_hub(model_name=model_name, task_config=task_config, config=config)
+    model = AutoModel.from_pretrained(download_dir, load_in_8bit=load_in_8bit)
     return model
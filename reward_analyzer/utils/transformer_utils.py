@@ -1,4 +1,5 @@
 import gc
+import random
 
 from time import time
 from typing import Dict, List
@@ -16,6 +17,34 @@ def batch(iterable, n=1):
         yield iterable[ndx:min(ndx + n, l)]
 
 
+def token_budget_batches(lengths: List[int], max_tokens: int, max_batch_size: int = None, shuffle_seed: int = None):
+    """
+    Groups indices into batches of similar tokenized length, such that the padded size of each batch
+    (number of items * longest length) stays within max_tokens. Items longer than max_tokens get a batch of their own.
+    Batches are returned in order of length, or in a seeded random order if shuffle_seed is given.
+    """
+    sorted_indices = sorted(range(len(lengths)), key=lambda index: lengths[index])
+
+    batches = []
+    current_batch = []
+    for index in sorted_indices:
+        # Lengths are ascending, so the current item is the longest in its batch.
+        padded_size = (len(current_batch) + 1) * lengths[index]
+        batch_is_full = max_batch_size is not None and len(current_batch) >= max_batch_size
+        if current_batch and (padded_size > max_tokens or batch_is_full):
+            batches.append(current_batch)
+            current_batch = []
+        current_batch.append(index)
+
+    if current_batch:
+        batches.append(current_batch)
+
+    if shuffle_seed is not None:
+        random.Random(shuffle_seed).shuffle(batches)
+
+    return batches
+
+
 def clear_gpu_memory():
     start_time = time()
     gc.collect()
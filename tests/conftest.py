@@ -0,0 +1,80 @@
+"""
+Shared fixtures: a tiny randomly initialized pythia-style model and a word level tokenizer,
+so that the tests run on CPU in seconds without downloading anything.
+"""
+import os
+import sys
+import types
+
+import pytest
+import torch
+
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import GPTNeoXConfig, GPTNeoXModel, PreTrainedTokenizerFast
+
+# The tests import the modules under test directly. reward_analyzer/__init__.py imports the whole
+# RLHF stack (trl, peft, spacy), which the modules under test do not need, so the package is registered
+# without running it.
+if 'reward_analyzer' not in sys.modules:
+    package = types.ModuleType('reward_analyzer')
+    package.__path__ = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'reward_analyzer')]
+    sys.modules['reward_analyzer'] = package
+
+from reward_analyzer.utils.metrics_sink import MetricsSink, set_metrics_sink  # noqa: E402
+
+WORDS = ['the', 'movie', 'was', 'good', 'bad', 'great', 'awful', 'plot', 'acting', 'and', 'not', 'very']
+
+
+def make_texts(num_texts: int = 24):
+    return [' '.join(WORDS[(index * 7 + offset) % len(WORDS)] for offset in range(index % 6 + 2)) for index in range(num_texts)]
+
+
+def make_tiny_model(seed: int = 0, num_layers: int = 3):
+    torch.manual_seed(seed)
+    config = GPTNeoXConfig(
+        vocab_size=32, hidden_size=16, num_hidden_layers=num_layers, num_attention_heads=2,
+        intermediate_size=32, max_position_embeddings=64
+    )
+    model = GPTNeoXModel(config).eval()
+    # LayerActivationsHandler picks the layer name stem from the model name.
+    model.config.name_or_path = 'pythia-tiny'
+    return model
+
+
+@pytest.fixture(scope='session', autouse=True)
+def offline_metrics(tmp_path_factory):
+    """
+    Logs training metrics to a local jsonl file. Without a wandb run, nothing is sent to wandb.
+    """
+    sink = MetricsSink.from_backend_names(['jsonl'], metrics_dir=str(tmp_path_factory.mktemp('metrics')), run_name='tests')
+    set_metrics_sink(sink)
+    yield sink
+    set_metrics_sink(None)
+
+
+@pytest.fixture
+def tokenizer():
+    vocab = {'<pad>': 0, '<unk>': 1, **{word: index + 2 for index, word in enumerate(WORDS)}}
+    word_tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token='<unk>'))
+    word_tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=word_tokenizer, pad_token='<pad>', unk_token='<unk>', name_or_path='word-level-tiny'
+    )
+
+
+@pytest.fixture
+def tiny_model():
+    return make_tiny_model()
+
+
+@pytest.fixture
+def texts():
+    return make_texts()
+
+
+@pytest.fixture
+def hyperparameters():
+    return {
+        'max_input_length': 16, 'batch_size': 4, 'num_epochs': 2, 'learning_rate': 1e-3,
+        'l1_coef': 1e-3, 'tied_weights': True
+    }
@@ -0,0 +1,90 @@
+import os
+
+import torch
+
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_cache import ActivationCache
+from reward_analyzer.sparse_codes_training.experiment_helpers.layer_activations_handler import LayerActivationsHandler
+
+LAYER_NAMES = ['layers.0.mlp', 'layers.2.mlp']
+
+
+def collect_batches(handler, texts, tokenizer, hyperparameters, activation_cache):
+    return list(handler.iterate_multi_layer_activations(
+        layer_names=LAYER_NAMES, input_texts=texts, tokenizer=tokenizer, device='cpu',
+        hyperparameters=hyperparameters, activation_cache=activation_cache
+    ))
+
+
+def test_cache_miss_writes_and_hit_reads_same_activations(tmp_path, tiny_model, tokenizer, texts, hyperparameters):
+    handler = LayerActivationsHandler(tiny_model)
+    activation_cache = ActivationCache(str(tmp_path))
+
+    written = collect_batches(handler, texts, tokenizer, hyperparameters, activation_cache)
+    cache_keys = handler.get_cache_keys(LAYER_NAMES, texts, tokenizer, hyperparameters, activation_cache)
+    assert all(activation_cache.is_complete(cache_key) for cache_key in cache_keys.values())
+
+    # A hit is served from disk, without running the model.
+    def fail_forward(*args, **kwargs):
+        raise AssertionError('The model should not run on a cache hit.')
+    handler.hook_manager.run_forward = fail_forward
+
+    read = collect_batches(handler, texts, tokenizer, hyperparameters, activation_cache)
+    assert len(read) == len(written)
+    for written_batch, read_batch in zip(written, read):
+        for layer_name in LAYER_NAMES:
+            assert torch.equal(written_batch[layer_name], read_batch[layer_name])
+
+
+def test_cache_key_changes_with_texts_tokenizer_and_batching(tmp_path, tiny_model, tokenizer, texts, hyperparameters):
+    activation_cache = ActivationCache(str(tmp_path))
+    key = activation_cache.get_key(tiny_model, LAYER_NAMES[0], hyperparameters, texts, tokenizer)
+
+    assert key == activation_cache.get_key(tiny_model, LAYER_NAMES[0], hyperparameters, list(texts), tokenizer)
+    assert key != activation_cache.get_key(tiny_model, LAYER_NAMES[1], hyperparameters, texts, tokenizer)
+
+    edited_texts = list(texts)
+    edited_texts[3] = 'not good'
+    assert key != activation_cache.get_key(tiny_model, LAYER_NAMES[0], hyperparameters, edited_texts, tokenizer)
+
+    # Editing the same list in place must not be served from the dataset hash memo.
+    texts[3] = 'not good'
+    assert key != activation_cache.get_key(tiny_model, LAYER_NAMES[0], hyperparameters, texts, tokenizer)
+
+    tokenizer.padding_side = 'left'
+    assert key != activation_cache.get_key(tiny_model, LAYER_NAMES[0], hyperparameters, edited_texts, tokenizer)
+
+    packed_hyperparameters = {**hyperparameters, 'pack_tokens': True}
+    assert key != activation_cache.get_key(tiny_model, LAYER_NAMES[0], packed_hyperparameters, edited_texts, tokenizer)
+
+
+def write_entry(activation_cache, key, num_values):
+    activation_cache.start_entry(key)
+    activation_cache.write_shard(key, 0, torch.ones(num_values))
+    activation_cache.mark_complete(key, num_shards=1)
+
+
+def test_eviction_removes_least_recently_used_complete_entries(tmp_path):
+    # Each entry is a 4 KiB shard plus its manifest, and the budget fits two of them.
+    activation_cache = ActivationCache(str(tmp_path), max_size_gb=10 * 1024 / 1024 ** 3)
+
+    write_entry(activation_cache, 'first', 1024)
+    write_entry(activation_cache, 'second', 1024)
+    os.utime(os.path.join(activation_cache.get_entry_dir('first'), activation_cache.manifest_name), (0, 0))
+    os.utime(os.path.join(activation_cache.get_entry_dir('second'), activation_cache.manifest_name), (1, 1))
+    activation_cache.touch('first')
+
+    write_entry(activation_cache, 'third', 1024)
+    assert activation_cache.is_complete('first')
+    assert not os.path.exists(activation_cache.get_entry_dir('second'))
+    assert activation_cache.is_complete('third')
+
+
+def test_incomplete_entries_are_not_served_or_evicted(tmp_path):
+    activation_cache = ActivationCache(str(tmp_path), max_size_gb=0)
+
+    activation_cache.start_entry('in_flight')
+    activation_cache.write_shard('in_flight', 0, torch.ones(1024))
+    assert not activation_cache.is_complete('in_flight')
+
+    write_entry(activation_cache, 'complete', 1024)
+    assert os.path.exists(activation_cache.get_shard_path('in_flight', 0))
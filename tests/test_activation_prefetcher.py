@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_prefetcher import ActivationPrefetcher
+
+
+class CountingBatches:
+    """
+    Yields 0, 1, ... num_batches - 1, counting how many batches the producer has taken,
+    and optionally raising after raise_after batches.
+    """
+    def __init__(self, num_batches: int, raise_after: int = None):
+        self.num_batches = num_batches
+        self.raise_after = raise_after
+        self.num_produced = 0
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            for batch in range(self.num_batches):
+                if batch == self.raise_after:
+                    raise ValueError('extraction failed')
+                self.num_produced += 1
+                yield batch
+        finally:
+            self.closed = True
+
+
+def wait_until_stable(get_value, timeout=5.0):
+    """
+    Returns get_value() once it has stopped changing for a while.
+    """
+    value, deadline = get_value(), time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        time.sleep(0.05)
+        if get_value() == value:
+            return value
+        value = get_value()
+    return value
+
+
+def test_batches_are_yielded_in_order_and_transformed():
+    prefetcher = ActivationPrefetcher(iter(CountingBatches(50)), max_prefetch=3, transform=lambda batch: batch * 10)
+    assert list(prefetcher) == [batch * 10 for batch in range(50)]
+    assert prefetcher.get_metrics('test')['prefetch_num_batches_test'] == 50
+
+
+def test_producer_stays_at_most_max_prefetch_batches_ahead():
+    batches = CountingBatches(100)
+    prefetcher = ActivationPrefetcher(iter(batches), max_prefetch=2)
+    iterator = iter(prefetcher)
+    assert next(iterator) == 0
+
+    num_produced = wait_until_stable(lambda: batches.num_produced)
+    # One batch consumed, max_prefetch in the queue, and one waiting to be put.
+    assert num_produced <= 1 + 2 + 1
+    assert prefetcher.queue.qsize() <= 2
+
+    assert next(iterator) == 1
+    iterator.close()
+    assert prefetcher.thread is None
+    assert batches.closed
+
+
+def test_producer_exceptions_are_raised_to_the_consumer():
+    prefetcher = ActivationPrefetcher(iter(CountingBatches(10, raise_after=3)), max_prefetch=2)
+    consumed = []
+    with pytest.raises(ValueError, match='extraction failed'):
+        for batch in prefetcher:
+            consumed.append(batch)
+    assert consumed == [0, 1, 2]
+    assert prefetcher.thread is None
+
+
+def test_transform_exceptions_are_raised_to_the_consumer():
+    def transform(batch):
+        if batch == 2:
+            raise RuntimeError('copy failed')
+        return batch
+
+    with pytest.raises(RuntimeError, match='copy failed'):
+        list(ActivationPrefetcher(iter(CountingBatches(10)), max_prefetch=2, transform=transform))
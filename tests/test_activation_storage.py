@@ -0,0 +1,63 @@
+import pytest
+import torch
+
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_cache import ActivationCache
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_storage import (
+    decode_activations, encode_activations, get_storage_format, get_storage_format_report
+)
+
+
+@pytest.fixture
+def activations():
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(64, 32, generator=generator) * torch.linspace(0.1, 10, 64).unsqueeze(1)
+
+
+def round_trip(activations, storage_format):
+    return decode_activations(encode_activations(activations, storage_format), storage_format)
+
+
+def test_float32_round_trip_is_exact(activations):
+    assert torch.equal(round_trip(activations, 'float32'), activations)
+
+
+@pytest.mark.parametrize('storage_format, mantissa_bits', [('float16', 10), ('bfloat16', 7)])
+def test_half_precision_round_trip_error_is_within_rounding(activations, storage_format, mantissa_bits):
+    decoded = round_trip(activations, storage_format)
+    assert decoded.dtype == torch.float32
+    relative_error = (decoded - activations).abs() / activations.abs().clamp_min(1e-6)
+    assert relative_error.max() <= 2 ** -(mantissa_bits + 1)
+
+
+def test_int8_round_trip_error_is_within_half_a_step_per_row(activations):
+    encoded = encode_activations(activations, 'int8')
+    assert encoded['values'].dtype.itemsize == 1
+    decoded = decode_activations(encoded, 'int8')
+
+    row_steps = activations.abs().amax(dim=-1, keepdim=True) / 127.0
+    assert ((decoded - activations).abs() <= row_steps / 2 + 1e-6).all()
+
+
+@pytest.mark.parametrize('storage_format', ['float16', 'bfloat16', 'int8'])
+def test_cache_shards_round_trip_through_storage_formats(tmp_path, activations, storage_format):
+    activation_cache = ActivationCache(str(tmp_path))
+    activation_cache.start_entry('entry')
+    activation_cache.write_shard('entry', 0, activations, storage_format=storage_format)
+    read = activation_cache.read_shard('entry', 0, storage_format=storage_format)
+    assert torch.equal(read, round_trip(activations, storage_format))
+
+
+def test_storage_format_report_orders_formats_by_size(activations):
+    report = get_storage_format_report(activations)
+    assert report['float32']['storage_mse'] == 0
+    assert report['float32']['bytes_per_value'] == 4
+    assert report['bfloat16']['bytes_per_value'] == report['float16']['bytes_per_value'] == 2
+    assert report['int8']['bytes_per_value'] < 2
+
+
+def test_storage_format_per_layer():
+    hyperparameters = {'activation_storage_format': {'layers.1.mlp': 'int8'}}
+    assert get_storage_format(hyperparameters, 'layers.1.mlp') == 'int8'
+    assert get_storage_format(hyperparameters, 'layers.2.mlp') == 'float32'
+    with pytest.raises(ValueError):
+        get_storage_format({'activation_storage_format': 'float8'}, 'layers.1.mlp')
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from reward_analyzer.sparse_codes_training.metrics.assignment import match_features
+
+
+def make_dictionaries(num_small=48, num_big=96, dim=16, seed=0):
+    """
+    A big dictionary, and a small one made of noisy copies of some of its features.
+    """
+    rng = np.random.default_rng(seed)
+    big_weights = rng.standard_normal((num_big, dim)).astype(np.float32)
+    small_weights = big_weights[rng.permutation(num_big)[:num_small]] + 0.5 * rng.standard_normal((num_small, dim))
+    return small_weights.astype(np.float32), big_weights
+
+
+def test_hungarian_matching_is_exact_and_tight():
+    small_weights, big_weights = make_dictionaries()
+    matching = match_features(small_weights, big_weights, method='hungarian')
+    assert len(set(matching.col_ind.tolist())) == len(small_weights)
+    assert matching.method == 'hungarian'
+    assert matching.error_bound == 0
+
+
+@pytest.mark.parametrize('method', ['auction', 'greedy'])
+def test_approximate_matching_is_within_its_dual_bound_of_hungarian(method):
+    small_weights, big_weights = make_dictionaries()
+    exact = match_features(small_weights, big_weights, method='hungarian')
+    approximate = match_features(small_weights, big_weights, method=method, k=8, tile_size=32)
+
+    assert approximate.method == method
+    assert len(set(approximate.col_ind.tolist())) == len(small_weights)
+    # The matching is feasible, so it cannot beat the optimum, and the dual bound cannot be below it.
+    assert approximate.mean_similarity <= exact.mean_similarity + 1e-6
+    assert exact.mean_similarity <= approximate.upper_bound + 1e-6
+    assert exact.mean_similarity - approximate.mean_similarity <= approximate.error_bound + 1e-6
+
+
+def test_auction_matches_hungarian_on_near_copies():
+    small_weights, big_weights = make_dictionaries()
+    exact = match_features(small_weights, big_weights, method='hungarian')
+    auction = match_features(small_weights, big_weights, method='auction', k=8, tile_size=32)
+    assert auction.mean_similarity == pytest.approx(exact.mean_similarity, abs=1e-3)
+
+
+def test_auto_switches_to_auction_above_exact_max_size():
+    small_weights, big_weights = make_dictionaries()
+    assert match_features(small_weights, big_weights, method='auto').method == 'hungarian'
+    assert match_features(small_weights, big_weights, method='auto', exact_max_size=100).method == 'auction'
+
+
+def test_matching_needs_a_big_feature_per_small_feature():
+    small_weights, big_weights = make_dictionaries()
+    with pytest.raises(ValueError):
+        match_features(big_weights, small_weights, method='hungarian')
@@ -0,0 +1,69 @@
+import pytest
+import torch
+
+from safetensors.torch import save_file
+
+from conftest import make_tiny_model
+from reward_analyzer.sparse_codes_training.experiment_helpers.checkpoint_divergence import (
+    CheckpointDivergence, UnsupportedCheckpointError
+)
+from reward_analyzer.sparse_codes_training.experiment_helpers.layer_activations_handler import LayerActivationsHandler
+
+
+@pytest.mark.parametrize('divergence_choice', ['highest_divergence', 'lowest_layers'])
+def test_streaming_divergences_match_the_loaded_models(tmp_path, divergence_choice):
+    base_model, rlhf_model = make_tiny_model(seed=0), make_tiny_model(seed=1)
+    base_model.save_pretrained(tmp_path / 'base', safe_serialization=True)
+    rlhf_model.save_pretrained(tmp_path / 'rlhf', safe_serialization=True)
+    # Chunks of a few rows, so every tensor is streamed in several parts.
+    hyperparameters = {
+        'divergence_choice': divergence_choice, 'divergence_chunk_bytes': 256, 'divergence_num_workers': 2
+    }
+
+    handler = LayerActivationsHandler(base_model)
+    sorted_layers, divergences = handler.find_divergences(rlhf_model, hyperparameters)
+    streamed_sorted_layers, streamed_divergences = handler.find_divergences_from_checkpoints(
+        str(tmp_path / 'base'), str(tmp_path / 'rlhf'), hyperparameters
+    )
+
+    assert len(divergences) == 3
+    assert streamed_sorted_layers == sorted_layers
+    assert streamed_divergences.keys() == divergences.keys()
+    for layer_num, divergence in divergences.items():
+        assert streamed_divergences[layer_num] == pytest.approx(divergence, rel=1e-5)
+
+
+def save_int8_checkpoint(path, weight: torch.Tensor, scales: torch.Tensor = None):
+    tensors = {'layers.0.mlp.weight': weight, 'layers.0.mlp.bias': torch.zeros(weight.size(0))}
+    if scales is not None:
+        tensors['layers.0.mlp.SCB'] = scales
+    save_file(tensors, str(path))
+    return [str(path)]
+
+
+def test_int8_weights_are_dequantized_with_their_row_scales(tmp_path):
+    base_weight = torch.randn(6, 4)
+    scales = torch.rand(6) + 0.5
+    quantized_weight = torch.randint(-127, 128, (6, 4), dtype=torch.int8)
+
+    checkpoint_divergence = CheckpointDivergence(
+        base_files=save_int8_checkpoint(tmp_path / 'base.safetensors', base_weight),
+        rlhf_files=save_int8_checkpoint(tmp_path / 'rlhf.safetensors', quantized_weight, scales),
+        layer_name_stem='layers', chunk_bytes=32
+    )
+    dequantized_weight = quantized_weight.float() * scales[:, None] / 127.0
+    expected = torch.norm(base_weight - dequantized_weight).item()
+    assert checkpoint_divergence.get_tensor_divergences()['layers.0.mlp.weight'] == pytest.approx(expected, rel=1e-5)
+
+
+@pytest.mark.parametrize('scales', [None, torch.rand(4), torch.rand(6, 4)])
+def test_int8_weights_without_row_scales_raise(tmp_path, scales):
+    checkpoint_divergence = CheckpointDivergence(
+        base_files=save_int8_checkpoint(tmp_path / 'base.safetensors', torch.randn(6, 4)),
+        rlhf_files=save_int8_checkpoint(
+            tmp_path / 'rlhf.safetensors', torch.randint(-127, 128, (6, 4), dtype=torch.int8), scales
+        ),
+        layer_name_stem='layers'
+    )
+    with pytest.raises(UnsupportedCheckpointError, match='layers.0.mlp.weight'):
+        checkpoint_divergence.get_tensor_divergences()
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from reward_analyzer.sparse_codes_training.metrics.feature_index import FeatureIndex
+
+NUM_ATOMS, DIM = 2000, 32
+
+
+@pytest.fixture(scope='module')
+def feature_index():
+    """
+    An index over clustered unit atoms of two dictionaries, with a trained IVF-PQ index.
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((40, DIM))
+    atoms = centers[rng.integers(0, len(centers), NUM_ATOMS)] + 0.3 * rng.standard_normal((NUM_ATOMS, DIM))
+    atoms = (atoms / np.linalg.norm(atoms, axis=1, keepdims=True)).astype(np.float32)
+
+    index = FeatureIndex(
+        atoms, np.concatenate([np.arange(800), np.arange(1200)]), [('base_big', '1'), ('rlhf_big', '1')],
+        np.array([[0, 800], [800, NUM_ATOMS]], dtype=np.int64)
+    )
+    index.train_ivfpq(num_subspaces=8, num_codes=64, num_iterations=10)
+    return index
+
+
+def make_queries(num_queries, seed=1):
+    return np.random.default_rng(seed).standard_normal((num_queries, DIM)).astype(np.float32)
+
+
+def test_ivfpq_search_recalls_the_exact_neighbours(feature_index):
+    queries = make_queries(100)
+    exact = feature_index.search(queries, k=10)
+    approximate = feature_index.search(queries, k=10, approximate=True, num_probes=8)
+
+    exact_rows = [set(zip(holders, features)) for holders, features in zip(exact['holder'], exact['feature'])]
+    approximate_rows = [
+        set(zip(holders, features)) for holders, features in zip(approximate['holder'], approximate['feature'])
+    ]
+    recall = np.mean([len(e & a) / 10 for e, a in zip(exact_rows, approximate_rows)])
+    assert recall >= 0.85
+    # Candidates are rescored exactly, so approximate cosines are true cosines, and never above the exact ones.
+    assert np.all(approximate['cosine'][:, 0] <= exact['cosine'][:, 0] + 1e-5)
+
+
+def test_ivfpq_search_probing_every_list_is_exact(feature_index):
+    queries = make_queries(20)
+    exact = feature_index.search(queries, k=5, holder='rlhf_big')
+    approximate = feature_index.search(
+        queries, k=5, holder='rlhf_big', approximate=True, num_probes=len(feature_index.centroids), num_rescored=1200
+    )
+    assert np.array_equal(approximate['feature'], exact['feature'])
+    assert np.allclose(approximate['cosine'], exact['cosine'], atol=1e-5)
+    assert set(approximate['holder'].ravel()) == {'rlhf_big'}
+
+
+def test_ivfpq_search_does_not_depend_on_the_query_blocks(feature_index):
+    queries = feature_index.atoms[:7] + 0.1
+    segments = feature_index.get_segments()
+    values, entries = feature_index.search_ivfpq(queries, 10, segments, num_probes=4)
+    block_values, block_entries = feature_index.search_ivfpq(queries, 10, segments, num_probes=4, query_block_size=3)
+    assert np.array_equal(values, block_values)
+    assert np.array_equal(entries, block_entries)
+
+
+def test_ivfpq_search_pads_missing_candidates_with_negative_infinity(feature_index):
+    results = feature_index.search(make_queries(3), k=10, approximate=True, num_probes=1, num_rescored=2)
+    assert np.all(np.isfinite(results['cosine'][:, :2]))
+    assert np.all(np.isneginf(results['cosine'][:, 2:]))
@@ -0,0 +1,84 @@
+import sys
+import types
+
+import pytest
+import torch
+
+from reward_analyzer.utils import gpu_utils
+from reward_analyzer.utils.gpu_utils import DevicePlanner, find_gpu_with_most_memory
+
+ONE_GB = 1024 ** 3
+
+
+def make_fake_nvml(free_memory_gb, fail_init=False):
+    """
+    A stand-in for pynvml, reporting GPUs with the given free memory.
+    """
+    nvml = types.ModuleType('pynvml')
+    nvml.NVMLError = type('NVMLError', (Exception,), {})
+    nvml.shutdown_calls = 0
+
+    def nvml_init():
+        if fail_init:
+            raise nvml.NVMLError('driver not loaded')
+
+    def nvml_shutdown():
+        nvml.shutdown_calls += 1
+
+    nvml.nvmlInit = nvml_init
+    nvml.nvmlShutdown = nvml_shutdown
+    nvml.nvmlDeviceGetCount = lambda: len(free_memory_gb)
+    nvml.nvmlDeviceGetHandleByIndex = lambda index: index
+    nvml.nvmlDeviceGetMemoryInfo = lambda handle: types.SimpleNamespace(free=free_memory_gb[handle] * ONE_GB)
+    return nvml
+
+
+@pytest.fixture
+def cpu_threads(monkeypatch):
+    """
+    Records the torch thread counts that are set, without changing the test process' thread pool.
+    """
+    set_threads = []
+    monkeypatch.setattr(torch, 'get_num_threads', lambda: 1)
+    monkeypatch.setattr(torch, 'set_num_threads', set_threads.append)
+    return set_threads
+
+
+def test_planner_falls_back_to_the_cpu_without_cuda(monkeypatch, cpu_threads):
+    monkeypatch.setattr(torch.cuda, 'is_available', lambda: False)
+    planner = DevicePlanner(num_threads=3)
+    assert planner.get_device('model') == 'cpu'
+    assert planner.get_device('autoencoder') == 'cpu'
+    assert cpu_threads == [3, 3]
+
+
+@pytest.mark.parametrize('nvml', [make_fake_nvml([4, 8]), make_fake_nvml([]), make_fake_nvml([40], fail_init=True)])
+def test_planner_falls_back_to_the_cpu_without_a_usable_gpu(monkeypatch, cpu_threads, nvml):
+    monkeypatch.setattr(torch.cuda, 'is_available', lambda: True)
+    monkeypatch.setitem(sys.modules, 'pynvml', nvml)
+    monkeypatch.setattr(gpu_utils, 'get_available_cpu_count', lambda: 5)
+
+    assert DevicePlanner(min_memory=10).get_device() == 'cpu'
+    assert cpu_threads == [5]
+
+
+def test_planner_picks_the_gpu_with_the_most_free_memory(monkeypatch, cpu_threads):
+    nvml = make_fake_nvml([12, 30, 20])
+    monkeypatch.setattr(torch.cuda, 'is_available', lambda: True)
+    monkeypatch.setitem(sys.modules, 'pynvml', nvml)
+
+    assert find_gpu_with_most_memory(min_memory=10) == 'cuda:1'
+    assert nvml.shutdown_calls == 1
+    assert DevicePlanner(min_memory=10).get_device() == 'cuda:1'
+    assert cpu_threads == []
+
+
+def test_roles_are_planned_once(monkeypatch, cpu_threads):
+    planned_devices = iter(['cuda:0', 'cpu'])
+    monkeypatch.setattr(gpu_utils, 'find_gpu_with_most_memory', lambda min_memory: next(planned_devices))
+    planner = DevicePlanner()
+
+    assert planner.get_device('model') == 'cuda:0'
+    assert planner.get_device('model') == 'cuda:0'
+    assert planner.get_device('autoencoder') == 'cpu'
+    assert DevicePlanner(device='cuda:2').get_device('model') == 'cuda:2'
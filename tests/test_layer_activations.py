@@ -0,0 +1,82 @@
+import torch
+
+from conftest import make_tiny_model
+
+from reward_analyzer.internal_representations.activations_extractor import ActivationsExtractor
+from reward_analyzer.sparse_codes_training.experiment_helpers.layer_activations_handler import LayerActivationsHandler
+
+LAYER_NAMES = ['layers.0.mlp', 'layers.1.mlp']
+
+
+def get_activations(handler, texts, tokenizer, hyperparameters):
+    return handler.get_multi_layer_activations(
+        layer_names=LAYER_NAMES, input_texts=texts, tokenizer=tokenizer, device='cpu',
+        hyperparameters=hyperparameters, return_offsets=True
+    )
+
+
+def test_packed_activations_match_unpacked_tokens(tiny_model, tokenizer, texts, hyperparameters):
+    handler = LayerActivationsHandler(tiny_model)
+    unpacked, unpacked_offsets = get_activations(handler, texts[:6], tokenizer, hyperparameters)
+    packed, sequence_offsets = get_activations(handler, texts[:6], tokenizer, {**hyperparameters, 'pack_tokens': True})
+
+    attention_mask = tokenizer(texts[:6], return_tensors='pt', padding=True)['attention_mask'].bool()
+    assert unpacked_offsets is None
+    assert sequence_offsets.tolist() == [0, *attention_mask.sum(dim=1).cumsum(dim=0).tolist()]
+    for layer_name in LAYER_NAMES:
+        assert packed[layer_name].shape == (attention_mask.sum(), unpacked[layer_name].size(-1))
+        assert torch.allclose(packed[layer_name], unpacked[layer_name][attention_mask], atol=1e-6)
+
+
+def test_early_exit_activations_match_full_forward(tiny_model, tokenizer, texts, hyperparameters):
+    handler = LayerActivationsHandler(tiny_model)
+    full, _ = get_activations(handler, texts[:6], tokenizer, hyperparameters)
+    early_exit, _ = get_activations(handler, texts[:6], tokenizer, {**hyperparameters, 'early_exit': True})
+
+    for layer_name in LAYER_NAMES:
+        assert torch.equal(full[layer_name], early_exit[layer_name])
+    assert not handler.hook_manager.get_live_hooks()
+
+
+def test_extractor_batches_match_single_texts_without_pad_token(tiny_model, tokenizer, texts):
+    extractor = ActivationsExtractor(tiny_model, tokenizer, LAYER_NAMES)
+    batched = extractor.compute_activations_from_raw_texts(texts[:8])
+    batched = {layer_name: list(activations) for layer_name, activations in batched.items()}
+    extractor.remove_hooks()
+
+    tokenizer.pad_token = None
+    extractor = ActivationsExtractor(tiny_model, tokenizer, LAYER_NAMES)
+    assert extractor.max_batch_size == 1
+    single = extractor.compute_activations_from_raw_texts(texts[:8])
+    extractor.remove_hooks()
+
+    for layer_name in LAYER_NAMES:
+        for batched_activations, single_activations in zip(batched[layer_name], single[layer_name]):
+            assert torch.allclose(batched_activations, single_activations, atol=1e-5)
+
+
+def test_padded_target_positions_follow_the_attention_mask():
+    attention_mask = torch.tensor([[0, 0, 1, 1, 1], [1, 1, 1, 1, 1], [1, 1, 1, 0, 0]])
+    target_positions = torch.tensor([1, 4, 2])
+    padded_positions = ActivationsExtractor.get_padded_target_positions(attention_mask, target_positions)
+    assert padded_positions.tolist() == [3, 4, 2]
+
+
+def test_paired_activations_match_separate_extraction(tokenizer, texts, hyperparameters):
+    base_handler = LayerActivationsHandler(make_tiny_model(seed=0))
+    rlhf_handler = LayerActivationsHandler(make_tiny_model(seed=1))
+    packed_hyperparameters = {**hyperparameters, 'pack_tokens': True}
+
+    paired_batches = list(base_handler.iterate_paired_multi_layer_activations(
+        other_handler=rlhf_handler, layer_names=LAYER_NAMES, input_texts=texts, tokenizer=tokenizer,
+        device='cpu', other_device='cpu', hyperparameters=packed_hyperparameters
+    ))
+    for source, handler in (('base', base_handler), ('rlhf', rlhf_handler)):
+        batches = list(handler.iterate_multi_layer_activations(
+            layer_names=LAYER_NAMES, input_texts=texts, tokenizer=tokenizer, device='cpu',
+            hyperparameters=packed_hyperparameters
+        ))
+        assert len(batches) == len(paired_batches)
+        for batch, paired_batch in zip(batches, paired_batches):
+            for layer_name in LAYER_NAMES:
+                assert torch.equal(batch[layer_name], paired_batch[source][layer_name])
@@ -0,0 +1,90 @@
+import json
+import sqlite3
+import threading
+
+import torch
+
+from reward_analyzer.utils import metrics_sink
+from reward_analyzer.utils.metrics_sink import MetricsBackend, MetricsSink
+
+
+class RecordingBackend(MetricsBackend):
+    def __init__(self):
+        self.batches = []
+        self.closed = False
+        self.written = threading.Event()
+
+    def write(self, records):
+        self.batches.append(records)
+        self.written.set()
+
+    def close(self):
+        self.closed = True
+
+    @property
+    def records(self):
+        return [record for batch in self.batches for record in batch]
+
+
+def test_close_flushes_every_record_in_order():
+    backend = RecordingBackend()
+    sink = MetricsSink([backend], flush_interval=60, max_buffer_size=10 ** 6)
+    for step in range(250):
+        sink.log({'loss': torch.tensor(float(step)), 'step_squared': step ** 2})
+    sink.close()
+
+    assert backend.closed
+    assert [record['step'] for record in backend.records] == list(range(250))
+    assert [record['metrics']['loss'] for record in backend.records] == [float(step) for step in range(250)]
+    assert all(isinstance(record['metrics']['loss'], float) for record in backend.records)
+
+    # Closing twice neither rewrites nor fails.
+    sink.close()
+    assert len(backend.records) == 250
+
+
+def test_full_buffer_is_written_in_batches_by_the_background_thread():
+    backend = RecordingBackend()
+    sink = MetricsSink([backend], flush_interval=60, max_buffer_size=8)
+    for step in range(8):
+        sink.log({'loss': step})
+
+    assert backend.written.wait(timeout=5)
+    assert backend.records[0]['step'] == 0
+    sink.close()
+    assert [record['step'] for record in backend.records] == list(range(8))
+
+
+def test_flush_interval_writes_without_close():
+    backend = RecordingBackend()
+    sink = MetricsSink([backend], flush_interval=0.01, max_buffer_size=10 ** 6)
+    sink.log({'loss': 1.0})
+    assert backend.written.wait(timeout=5)
+    sink.close()
+    assert len(backend.records) == 1
+
+
+def test_file_backends_store_all_records(tmp_path):
+    sink = MetricsSink.from_backend_names(['jsonl', 'sqlite'], metrics_dir=str(tmp_path), run_name='run')
+    for step in range(5):
+        sink.log({'loss': float(step), 'per_layer': {'1': step}})
+    sink.close()
+
+    with open(tmp_path / 'run.jsonl') as f_in:
+        records = [json.loads(line) for line in f_in]
+    assert [record['metrics']['loss'] for record in records] == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+    connection = sqlite3.connect(str(tmp_path / 'run.sqlite'))
+    rows = connection.execute("SELECT step, value FROM metrics WHERE name = 'loss' ORDER BY step").fetchall()
+    connection.close()
+    assert rows == [(step, float(step)) for step in range(5)]
+
+
+def test_default_sink_has_no_backends(monkeypatch):
+    monkeypatch.setattr(metrics_sink, '_metrics_sink', None)
+    default_sink = metrics_sink.get_metrics_sink()
+    try:
+        assert default_sink.backends == []
+        metrics_sink.log_metrics({'loss': 1.0})
+    finally:
+        default_sink.close()
@@ -0,0 +1,88 @@
+import pytest
+import torch
+
+from reward_analyzer.sparse_codes_training.models.multi_sparse_autoencoder import MultiSparseAutoencoder
+from reward_analyzer.sparse_codes_training.models.sparse_autoencoder import SparseAutoencoder
+from reward_analyzer.utils import metrics_sink
+from reward_analyzer.utils.metrics_sink import MetricsSink
+
+LABELS = ['x1_l1_0.001', 'x2_l1_0.001', 'x1_l1_0.01']
+
+
+def make_multi_autoencoder(**kwargs):
+    torch.manual_seed(0)
+    return MultiSparseAutoencoder(input_size=8, hidden_sizes=[16, 32, 16], l1_coefs=[1e-3, 1e-3, 1e-2], **kwargs)
+
+
+@pytest.fixture
+def recorded_metrics(monkeypatch):
+    records = []
+    sink = MetricsSink([], flush_interval=60)
+    monkeypatch.setattr(sink, 'log', records.append)
+    monkeypatch.setattr(metrics_sink, '_metrics_sink', sink)
+    yield records
+    sink.close()
+
+
+def test_split_autoencoders_match_the_stacked_forward():
+    multi_autoencoder = make_multi_autoencoder(sparse_decode_min_sparsity=0.5)
+    x = torch.randn(10, 8)
+    all_features, all_reconstructions = multi_autoencoder(x)
+    autoencoders = multi_autoencoder.to_autoencoders()
+
+    for group_index, members in enumerate(multi_autoencoder.group_members):
+        for member_index, index in enumerate(members):
+            features, reconstruction = autoencoders[index](x)
+            assert autoencoders[index].sparse_decode_min_sparsity == 0.5
+            assert torch.allclose(features, all_features[group_index][member_index], atol=1e-6)
+            assert torch.allclose(reconstruction, all_reconstructions[group_index][member_index], atol=1e-6)
+
+
+def test_sparse_decode_matches_dense_outputs_and_gradients():
+    multi_autoencoder = make_multi_autoencoder()
+    with torch.no_grad():
+        for encoder_bias in multi_autoencoder.encoder_biases:
+            encoder_bias.fill_(-0.5)
+    x = torch.randn(10, 8)
+
+    results = {}
+    for sparse in (False, True):
+        multi_autoencoder.zero_grad()
+        _, all_reconstructions = multi_autoencoder(x, sparse=sparse)
+        sum(reconstruction.pow(2).sum() for reconstruction in all_reconstructions).backward()
+        results[sparse] = all_reconstructions + [parameter.grad.clone() for parameter in multi_autoencoder.parameters()]
+
+    for dense_value, sparse_value in zip(results[False], results[True]):
+        assert torch.allclose(dense_value, sparse_value, atol=1e-5)
+
+
+def test_sparse_decode_setting_is_measured_once_per_forward():
+    multi_autoencoder = make_multi_autoencoder(sparse_decode_min_sparsity=0.0, sparse_decode_check_interval=2)
+    multi_autoencoder(torch.randn(10, 8))
+    assert multi_autoencoder.num_decodes == 1
+    assert multi_autoencoder.measured_sparsity is not None
+    assert make_multi_autoencoder().use_sparse_decode([torch.zeros(2, 3)]) is False
+
+
+def test_training_steps_log_each_autoencoder_under_its_label(recorded_metrics):
+    multi_autoencoder = make_multi_autoencoder()
+    optimizer = torch.optim.Adam(multi_autoencoder.parameters(), lr=1e-3)
+    multi_autoencoder.start_epoch(metrics_flush_steps=2)
+    for _ in range(4):
+        multi_autoencoder.training_step(torch.randn(10, 8), optimizer=optimizer, label=LABELS)
+
+    assert len(recorded_metrics) == 2
+    for label in LABELS:
+        for metric_name in MultiSparseAutoencoder.metric_names:
+            assert f'{metric_name}_{label}' in recorded_metrics[0]
+
+
+def test_single_autoencoder_logs_the_same_metric_names(recorded_metrics):
+    torch.manual_seed(0)
+    autoencoder = SparseAutoencoder(input_size=8, hidden_size=16, l1_coef=1e-3)
+    optimizer = torch.optim.Adam(autoencoder.parameters(), lr=1e-3)
+    autoencoder.start_epoch(metrics_flush_steps=1)
+    autoencoder.training_step(torch.randn(10, 8), optimizer=optimizer, label='single')
+
+    assert set(recorded_metrics[0]) == {f'{metric_name}_single' for metric_name in SparseAutoencoder.metric_names}
+    assert recorded_metrics[0]['loss_single'] == pytest.approx(autoencoder.last_metrics[0].item())
@@ -0,0 +1,60 @@
+import pytest
+import torch
+
+from reward_analyzer.sparse_codes_training.models.sparse_autoencoder import SparseAutoencoder
+
+
+def make_autoencoder(**kwargs):
+    torch.manual_seed(0)
+    return SparseAutoencoder(input_size=16, hidden_size=64, l1_coef=1e-3, tied_weights=True, **kwargs)
+
+
+def make_sparse_features(shape, density=0.05, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    features = torch.rand(*shape, generator=generator)
+    return features * (torch.rand(*shape, generator=generator) < density)
+
+
+@pytest.mark.parametrize('shape', [(32, 16), (4, 8, 16)])
+def test_sparse_decode_matches_dense_outputs_and_gradients(shape):
+    autoencoder = make_autoencoder()
+    with torch.no_grad():
+        # Most features stay below zero, as in a trained dictionary.
+        autoencoder.encoder[0].bias.fill_(-1.0)
+    generator = torch.Generator().manual_seed(0)
+    inputs, targets = torch.randn(*shape, generator=generator), torch.randn(*shape, generator=generator)
+
+    results = {}
+    for sparse in (False, True):
+        autoencoder.zero_grad()
+        features = autoencoder.encode(inputs)
+        reconstruction = autoencoder.decode(features, sparse=sparse)
+        torch.nn.functional.mse_loss(reconstruction, targets).backward()
+        results[sparse] = [reconstruction.detach()] + [parameter.grad.clone() for parameter in autoencoder.parameters()]
+
+    assert (autoencoder.encode(inputs) == 0).float().mean() > 0.5
+    for dense_value, sparse_value in zip(results[False], results[True]):
+        assert torch.allclose(dense_value, sparse_value, atol=1e-6)
+
+
+def test_sparse_decode_is_disabled_by_default():
+    autoencoder = make_autoencoder()
+    features = make_sparse_features((32, 64))
+    assert not autoencoder.use_sparse_decode(features)
+    assert autoencoder.measured_sparsity is None
+
+
+def test_sparse_decode_follows_measured_sparsity_at_the_check_interval():
+    autoencoder = make_autoencoder(sparse_decode_min_sparsity=0.9, sparse_decode_check_interval=2)
+    assert autoencoder.use_sparse_decode(make_sparse_features((32, 64), density=0.05))
+    # Measured sparsity is reused until the next check.
+    assert autoencoder.use_sparse_decode(torch.ones(32, 64))
+    assert not autoencoder.use_sparse_decode(torch.ones(32, 64))
+
+
+def test_untied_autoencoder_always_decodes_densely():
+    torch.manual_seed(0)
+    autoencoder = SparseAutoencoder(
+        input_size=16, hidden_size=64, l1_coef=1e-3, tied_weights=False, sparse_decode_min_sparsity=0.0
+    )
+    assert not autoencoder.use_sparse_decode(make_sparse_features((32, 64)))
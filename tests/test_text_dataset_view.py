@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from datasets import Dataset
+
+from reward_analyzer.sparse_codes_training.experiment_helpers.text_dataset_view import (
+    TextDatasetView, reservoir_sample_indices
+)
+
+
+@pytest.mark.parametrize('population_size, k', [(1000, 10), (1000, 999), (50, 50), (10, 30)])
+def test_reservoir_sample_has_k_distinct_indices(population_size, k):
+    sample = reservoir_sample_indices(population_size, k=k, seed=0)
+    assert len(sample) == min(k, population_size)
+    assert len(set(sample.tolist())) == len(sample)
+    assert sample.min() >= 0 and sample.max() < population_size
+
+
+def test_reservoir_sample_is_deterministic_given_the_seed():
+    sample = reservoir_sample_indices(10000, k=100, seed=3)
+    assert np.array_equal(sample, reservoir_sample_indices(10000, k=100, seed=3))
+    assert not np.array_equal(sample, reservoir_sample_indices(10000, k=100, seed=4))
+
+
+def test_reservoir_sample_is_uniform_over_a_small_stream():
+    population_size, k, num_samples = 10, 3, 20000
+    counts = np.zeros(population_size)
+    first_counts = np.zeros(population_size)
+    for seed in range(num_samples):
+        sample = reservoir_sample_indices(population_size, k=k, seed=seed)
+        counts[sample] += 1
+        first_counts[sample[0]] += 1
+
+    # Every index is in a sample with probability k / population_size, and first with probability 1 / population_size.
+    assert np.allclose(counts / num_samples, k / population_size, atol=0.02)
+    assert np.allclose(first_counts / num_samples, 1 / population_size, atol=0.015)
+
+
+@pytest.fixture
+def dataset():
+    return Dataset.from_dict({
+        'chosen': [f'chosen {row}' for row in range(20)], 'rejected': [f'rejected {row}' for row in range(20)],
+        'other': list(range(20))
+    })
+
+
+def test_view_reads_the_sampled_texts_of_every_column(dataset):
+    view = TextDatasetView.sample(dataset, columns=['chosen', 'rejected'], k=15, seed=0)
+    expected = [
+        dataset[int(item_index) // 2][['chosen', 'rejected'][item_index % 2]] for item_index in view.item_indices
+    ]
+    assert len(view) == 15
+    assert list(view) == expected
+    assert view[3] == expected[3]
+    assert view[2:6] == expected[2:6]
+    assert view[[5, 1]] == [expected[5], expected[1]]
+    assert list(view.select(range(4))) == expected[:4]
+    assert list(TextDatasetView.sample(dataset, columns=['chosen', 'rejected'], k=15, seed=0)) == expected
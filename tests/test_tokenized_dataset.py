@@ -0,0 +1,31 @@
+import torch
+
+from reward_analyzer.sparse_codes_training.experiment_helpers.tokenized_dataset import TokenizedDataset
+
+
+def test_batches_match_the_tokenizer(tokenizer, texts):
+    tokenized_dataset = TokenizedDataset.from_texts(texts, tokenizer=tokenizer, max_input_length=16)
+    for padding_side in ('right', 'left'):
+        tokenizer.padding_side = padding_side
+        tokenized_dataset.padding_side = padding_side
+        input_ids, attention_mask = tokenized_dataset.get_batch([0, 5, 3])
+        expected = tokenizer([texts[0], texts[5], texts[3]], return_tensors='pt', padding=True)
+        assert torch.equal(input_ids, expected['input_ids'])
+        assert torch.equal(attention_mask, expected['attention_mask'])
+
+
+def test_saved_dataset_is_reloaded_only_for_the_same_padding(tmp_path, tokenizer, texts):
+    built = TokenizedDataset.load_or_build(texts, tokenizer=tokenizer, max_input_length=16, cache_dir=str(tmp_path))
+    reloaded = TokenizedDataset.load_or_build(texts, tokenizer=tokenizer, max_input_length=16, cache_dir=str(tmp_path))
+    assert reloaded.key == built.key
+    assert torch.equal(reloaded.get_batch([1, 2])[0], built.get_batch([1, 2])[0])
+
+    tokenizer.padding_side = 'left'
+    left_padded = TokenizedDataset.load_or_build(texts, tokenizer=tokenizer, max_input_length=16, cache_dir=str(tmp_path))
+    assert left_padded.key != built.key
+    assert left_padded.padding_side == 'left'
+
+    tokenizer.add_special_tokens({'pad_token': '<extra_pad>'})
+    repadded = TokenizedDataset.load_or_build(texts, tokenizer=tokenizer, max_input_length=16, cache_dir=str(tmp_path))
+    assert repadded.key not in (built.key, left_padded.key)
+    assert repadded.pad_token_id == tokenizer.pad_token_id
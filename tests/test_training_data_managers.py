@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import torch
+
+from reward_analyzer.internal_representations.training_data_managers import AutoencoderManager
+from reward_analyzer.sparse_codes_training.models.sparse_autoencoder import SparseAutoencoder
+
+LAYER_NAMES = ['layers.0.mlp', 'layers.2.mlp']
+
+
+@pytest.fixture
+def autoencoder_manager():
+    torch.manual_seed(0)
+    autoencoders_dict = {}
+    for layer_name in LAYER_NAMES:
+        autoencoder = SparseAutoencoder(input_size=16, hidden_size=48, l1_coef=1e-3)
+        with torch.no_grad():
+            # Negative biases leave most features at zero, as in a trained autoencoder.
+            autoencoder.encoder[0].bias.fill_(-0.3)
+        autoencoders_dict[layer_name] = autoencoder
+    return AutoencoderManager(model=None, tokenizer=None, autoencoders_dict=autoencoders_dict)
+
+
+def get_dense_features(autoencoder_manager, activations, layer_name):
+    features, _ = autoencoder_manager.get_dictionary_features(activations, layer_name)
+    return features.reshape(-1, features.size(-1)).numpy()
+
+
+def test_sparse_features_match_the_dense_forward_across_batches(autoencoder_manager):
+    activations = torch.randn(3, 11, 16)
+    sparse_features = autoencoder_manager.get_sparse_dictionary_features(activations, 'layers.0.mlp', batch_size=8)
+    dense_features = get_dense_features(autoencoder_manager, activations, 'layers.0.mlp')
+
+    assert sparse_features.shape == (33, 48)
+    assert 0 < sparse_features.nnz < dense_features.size
+    assert sparse_features.nnz == np.count_nonzero(dense_features)
+    assert np.allclose(sparse_features.toarray(), dense_features, atol=1e-6)
+
+    numpy_features = autoencoder_manager.get_sparse_dictionary_features(activations.numpy(), 'layers.0.mlp')
+    assert np.allclose(numpy_features.toarray(), sparse_features.toarray(), atol=1e-6)
+
+
+def test_top_k_keeps_the_largest_features_of_each_row(autoencoder_manager):
+    activations = torch.randn(20, 16)
+    sparse_features = autoencoder_manager.get_sparse_dictionary_features(activations, 'layers.2.mlp', top_k=3)
+    dense_features = get_dense_features(autoencoder_manager, activations, 'layers.2.mlp')
+
+    for row, dense_row in zip(sparse_features.toarray(), dense_features):
+        top = np.argsort(-dense_row)[:3]
+        top = top[dense_row[top] > 0]
+        assert np.array_equal(np.flatnonzero(row), np.sort(top))
+        assert np.allclose(row[top], dense_row[top], atol=1e-6)
+    assert sparse_features.has_sorted_indices
+
+
+def test_stacked_features_have_one_row_per_sample(autoencoder_manager):
+    activations_dict_list = [
+        {layer_name: [torch.randn(1, 16)] for layer_name in LAYER_NAMES} for _ in range(5)
+    ]
+    stacked_features = autoencoder_manager.get_all_dictionary_features_for_list(activations_dict_list)
+
+    for activations_dict, point_features in zip(activations_dict_list, stacked_features):
+        expected = autoencoder_manager.get_all_dictionary_features_for_point(activations_dict)
+        for layer_name in LAYER_NAMES:
+            dense_features = get_dense_features(autoencoder_manager, activations_dict[layer_name][0], layer_name)
+            assert point_features[layer_name].shape == (1, 48)
+            assert np.allclose(point_features[layer_name].toarray(), expected[layer_name].toarray(), atol=1e-6)
+            assert np.allclose(point_features[layer_name].toarray(), dense_features, atol=1e-6)
@@ -0,0 +1,175 @@
+import math
+
+import pytest
+import torch
+
+from reward_analyzer.sparse_codes_training.experiment_helpers.activation_cache import ActivationCache
+from reward_analyzer.sparse_codes_training.experiment_helpers.layer_activations_handler import LayerActivationsHandler
+from reward_analyzer.sparse_codes_training.experiment_helpers.sharded_activation_loader import ShardedActivationLoader
+from reward_analyzer.sparse_codes_training.experiment_helpers.training_checkpointer import TrainingCheckpointer
+from reward_analyzer.sparse_codes_training.models.sparse_autoencoder import SparseAutoencoder
+
+NUM_SHARDS, SHARD_ROWS, DIM = 5, 12, 4
+
+
+@pytest.fixture
+def loader_cache(tmp_path):
+    """
+    Two aligned entries, whose rows hold their global token index in the first column.
+    """
+    activation_cache = ActivationCache(str(tmp_path))
+    cache_keys = {('base', 'layers.0.mlp'): 'base', ('rlhf', 'layers.0.mlp'): 'rlhf'}
+    for source, scale in (('base', 1), ('rlhf', -1)):
+        activation_cache.start_entry(source)
+        for shard_index in range(NUM_SHARDS):
+            token_indices = torch.arange(shard_index * SHARD_ROWS, (shard_index + 1) * SHARD_ROWS, dtype=torch.float32)
+            activation_cache.write_shard(source, shard_index, scale * token_indices.unsqueeze(1).repeat(1, DIM))
+        activation_cache.mark_complete(source, num_shards=NUM_SHARDS)
+    return activation_cache, cache_keys
+
+
+def read_epoch(loader, epoch):
+    loader.set_epoch(epoch)
+    return [{name: rows[:, 0].tolist() for name, rows in batch.items()} for batch in loader]
+
+
+def make_loader(loader_cache, num_workers=2, seed=0):
+    activation_cache, cache_keys = loader_cache
+    storage_formats = {name: 'float32' for name in cache_keys}
+    return ShardedActivationLoader(
+        activation_cache, cache_keys, storage_formats, batch_size=8, shuffle_buffer_size=16,
+        num_workers=num_workers, seed=seed
+    )
+
+
+def test_loader_covers_every_token_once_in_aligned_batches(loader_cache):
+    batches = read_epoch(make_loader(loader_cache), epoch=0)
+    assert len(batches) == len(make_loader(loader_cache))
+
+    base_tokens = [token for batch in batches for token in batch[('base', 'layers.0.mlp')]]
+    assert sorted(base_tokens) == list(range(NUM_SHARDS * SHARD_ROWS))
+    for batch in batches:
+        assert batch[('rlhf', 'layers.0.mlp')] == [-token for token in batch[('base', 'layers.0.mlp')]]
+
+
+def test_loader_order_depends_only_on_seed_and_epoch(loader_cache):
+    first_epoch = read_epoch(make_loader(loader_cache, num_workers=1), epoch=0)
+    assert read_epoch(make_loader(loader_cache, num_workers=3), epoch=0) == first_epoch
+    assert read_epoch(make_loader(loader_cache), epoch=1) != first_epoch
+    assert read_epoch(make_loader(loader_cache, seed=1), epoch=0) != first_epoch
+
+
+@pytest.mark.parametrize('batch_size, shuffle_buffer_size', [(8, 16), (5, 4), (7, 40)])
+def test_loader_resumes_the_same_batch_sequence_without_reading_earlier_shards(
+        loader_cache, batch_size, shuffle_buffer_size, monkeypatch
+):
+    loader = make_loader(loader_cache)
+    loader.batch_size, loader.shuffle_buffer_size = batch_size, shuffle_buffer_size
+    batches = read_epoch(loader, epoch=1)
+
+    read_shards = []
+    read_shard = loader.read_shard
+
+    def recording_read_shard(shard_index):
+        read_shards.append(shard_index)
+        return read_shard(shard_index)
+    monkeypatch.setattr(loader, 'read_shard', recording_read_shard)
+    for start_batch in range(len(batches) + 1):
+        read_shards.clear()
+        resumed = [
+            {name: rows[:, 0].tolist() for name, rows in batch.items()} for batch in loader.iterate(start_batch)
+        ]
+        assert resumed == batches[start_batch:]
+        assert len(read_shards) <= NUM_SHARDS + 1
+
+    # Resuming at the last batch only reads the shards of the tokens still in the buffer.
+    read_shards.clear()
+    list(loader.iterate(len(batches) - 1))
+    assert len(set(read_shards)) <= math.ceil(shuffle_buffer_size / SHARD_ROWS) + 1
+
+
+def test_extraction_resumes_without_running_the_model_on_earlier_batches(tiny_model, tokenizer, texts, hyperparameters):
+    handler = LayerActivationsHandler(tiny_model)
+    layer_names = ['layers.0.mlp', 'layers.2.mlp']
+
+    def iterate(start_batch=0):
+        return list(handler.iterate_multi_layer_activations(
+            layer_names=layer_names, input_texts=texts, tokenizer=tokenizer, device='cpu',
+            hyperparameters=hyperparameters, start_batch=start_batch
+        ))
+
+    batches = iterate()
+    num_forward_passes = 0
+    run_forward = handler.hook_manager.run_forward
+
+    def counting_run_forward(*args, **kwargs):
+        nonlocal num_forward_passes
+        num_forward_passes += 1
+        return run_forward(*args, **kwargs)
+    handler.hook_manager.run_forward = counting_run_forward
+
+    resumed = iterate(start_batch=4)
+    assert num_forward_passes == len(batches) - 4
+    for batch, resumed_batch in zip(batches[4:], resumed, strict=True):
+        for layer_name in layer_names:
+            assert torch.equal(batch[layer_name], resumed_batch[layer_name])
+
+
+def test_resumed_extraction_leaves_the_cache_entries_unwritten(
+        tmp_path, tiny_model, tokenizer, texts, hyperparameters
+):
+    activation_cache = ActivationCache(str(tmp_path))
+    handler = LayerActivationsHandler(tiny_model)
+    list(handler.iterate_layer_activations(
+        'layers.1.mlp', texts, tokenizer, 'cpu', hyperparameters, activation_cache=activation_cache, start_batch=2
+    ))
+    cache_keys = handler.get_cache_keys(['layers.1.mlp'], texts, tokenizer, hyperparameters, activation_cache)
+    assert not activation_cache.is_complete(cache_keys['layers.1.mlp'])
+
+
+class Interrupted(Exception):
+    pass
+
+
+def train(tmp_path, tiny_model, tokenizer, texts, hyperparameters, interrupt_after_steps=None):
+    torch.manual_seed(0)
+    activation_cache = None
+    if hyperparameters.get('shuffle_buffer_tokens'):
+        activation_cache = ActivationCache(str(tmp_path / 'cache'))
+    autoencoder = SparseAutoencoder(input_size=16, hidden_size=32, l1_coef=hyperparameters['l1_coef'])
+    checkpointer = TrainingCheckpointer(str(tmp_path), run_config=hyperparameters, checkpoint_every_steps=2)
+
+    if interrupt_after_steps is not None:
+        training_step = autoencoder.training_step
+        num_steps = 0
+
+        def interrupting_training_step(*args, **kwargs):
+            nonlocal num_steps
+            if num_steps == interrupt_after_steps:
+                raise Interrupted()
+            num_steps += 1
+            return training_step(*args, **kwargs)
+        autoencoder.training_step = interrupting_training_step
+
+    autoencoder.train_model(
+        input_texts=texts, hyperparameters=hyperparameters, model_device='cpu', autoencoder_device='cpu',
+        label='test', activations_handler=LayerActivationsHandler(tiny_model), tokenizer=tokenizer,
+        layer_name='layers.1.mlp', activation_cache=activation_cache, checkpointer=checkpointer
+    )
+    return autoencoder
+
+
+@pytest.mark.parametrize('shuffle_buffer_tokens', [None, 100])
+def test_checkpointed_training_resumes_mid_epoch_to_identical_weights(
+        tmp_path, tiny_model, tokenizer, texts, hyperparameters, shuffle_buffer_tokens
+):
+    hyperparameters = {**hyperparameters, 'shuffle_buffer_tokens': shuffle_buffer_tokens, 'loader_batch_tokens': 32}
+    uninterrupted = train(tmp_path / 'uninterrupted', tiny_model, tokenizer, texts, hyperparameters)
+
+    # 6 batches per epoch, so this stops in the second epoch, 1 step after its checkpoint at batch 2.
+    with pytest.raises(Interrupted):
+        train(tmp_path / 'resumed', tiny_model, tokenizer, texts, hyperparameters, interrupt_after_steps=9)
+    resumed = train(tmp_path / 'resumed', tiny_model, tokenizer, texts, hyperparameters)
+
+    for name, tensor in uninterrupted.state_dict().items():
+        assert torch.equal(tensor, resumed.state_dict()[name]), name